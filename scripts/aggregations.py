@@ -1,4 +1,5 @@
 import turkey_vulture
+from turkey_vulture import pipeline
 import ConfigParser
 
 VULTURE_CONFIG_FILE = '../config/vulture.ini'
@@ -19,9 +20,13 @@ def main():
     database_handler = turkey_vulture.DatabaseHandler(mongo_url, mongo_database, thread_id=thread_id)
     database_handler.authenticate(mongo_username, mongo_password)
 
-    database_handler.posts_links_aggregation()
-    database_handler.posts_by_user_aggregation()
-    database_handler.close()
+    try:
+        for report in pipeline.AggregationRunner(database_handler).run():
+            print('%(name)-20s %(status)-8s %(seconds).2fs' % report)
+            if 'error' in report:
+                print(report['error'])
+    finally:
+        database_handler.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,21 @@
+from turkey_vulture import analytics
+import sys
+
+
+def main():
+
+    if len(sys.argv) != 2:
+        sys.exit('Usage: analyze_export.py <export_directory>')
+
+    # Everything is computed in this process, so an export can be analyzed without a database
+    post_analytics = analytics.PostAnalytics()
+    post_analytics.add_export(sys.argv[1])
+
+    print('{0} posts, {1} posts with links'.format(post_analytics.posts, len(post_analytics.links())))
+    for word, count in post_analytics.top_words(limit=20):
+        print(u'{0:<30} {1:>8}'.format(word, count))
+    for domain in post_analytics.top_domains(limit=20):
+        print(u'{0:<30} {1:>8}'.format(domain['_id'], domain['count']))
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,70 @@
+"""Compares the time spent decoding stored posts as full dicts, as projected dicts and as raw documents
+
+The posts are encoded to BSON up front, the way the server sends them, so only the driver's decoding is timed.
+
+Usage: bson_decode_benchmark.py [post_count]
+"""
+import turkey_vulture
+from bson.codec_options import CodecOptions
+import bson
+import datetime
+import sys
+import time
+
+DEFAULT_POST_COUNT = 1000000
+SENDER_COUNT = 12
+BATCH_SIZE = turkey_vulture.SCAN_BATCH_SIZE
+
+
+def stored_post(post_number, fields=None):
+    sender = post_number % SENDER_COUNT
+    document = {
+        '_id': u'999_%d' % post_number,
+        'seq': post_number,
+        'sender': u'%d' % sender,
+        'created_time': datetime.datetime(2010, 1, 23) + datetime.timedelta(seconds=post_number),
+        'message': u'Message number %d, with a little more text than that so it looks like a chat line' % post_number,
+        'session': post_number // 50,
+    }
+    if fields is not None:
+        document = dict((field, document[field]) for field in fields)
+    return document
+
+
+def encode_batches(post_count, fields=None):
+    batches = []
+    for batch_start in xrange(0, post_count, BATCH_SIZE):
+        batch_end = min(batch_start + BATCH_SIZE, post_count)
+        batches.append(''.join(bson.BSON.encode(stored_post(post_number, fields))
+                               for post_number in xrange(batch_start, batch_end)))
+    return batches
+
+
+def time_decode(batches, codec_options):
+    started = time.time()
+    for batch in batches:
+        for document in bson.decode_all(batch, codec_options):
+            document['created_time']
+    return time.time() - started
+
+
+def main():
+    post_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_POST_COUNT
+
+    full_batches = encode_batches(post_count)
+    projected_batches = encode_batches(post_count, ('sender', 'created_time'))
+    full_seconds = time_decode(full_batches, CodecOptions())
+    projected_seconds = time_decode(projected_batches, CodecOptions())
+
+    print('posts:          %d' % post_count)
+    print('full dicts:     %.2fs (%d bytes)' % (full_seconds, sum(len(batch) for batch in full_batches)))
+    print('projected:      %.2fs (%d bytes)' % (projected_seconds, sum(len(batch) for batch in projected_batches)))
+    if turkey_vulture.RawBSONDocument is None:
+        print('raw documents:  unavailable, pymongo 3.2 or later is needed')
+        return
+    raw_options = CodecOptions(document_class=turkey_vulture.RawBSONDocument)
+    print('raw full:       %.2fs' % time_decode(full_batches, raw_options))
+    print('raw projected:  %.2fs' % time_decode(projected_batches, raw_options))
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
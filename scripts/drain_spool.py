@@ -0,0 +1,36 @@
+import turkey_vulture
+from turkey_vulture import hooks
+from turkey_vulture import spool
+import ConfigParser
+import os
+
+VULTURE_CONFIG_FILE = '../config/vulture.ini'
+
+
+def main():
+
+    config = ConfigParser.ConfigParser()
+    config.read(VULTURE_CONFIG_FILE)
+
+    thread_id = config.get('graph.facebook.com', 'ThreadId')
+
+    mongo_url = config.get('db', 'mongo_url')
+    mongo_database = config.get('db', 'database')
+    mongo_username = config.get('db', 'username')
+    mongo_password = config.get('db', 'password')
+
+    search_directory = config.get('search', 'Directory')
+
+    database_handler = turkey_vulture.DatabaseHandler(mongo_url, mongo_database, thread_id=thread_id)
+    database_handler.authenticate(mongo_username, mongo_password)
+    hooks.register_default_hooks(database_handler, os.path.join(search_directory, thread_id))
+
+    drainer = spool.SpoolDrainer(config.get('spool', 'Directory'), database_handler,
+                                 batch_posts=config.getint('spool', 'BatchPosts'))
+    try:
+        drainer.run(poll_seconds=config.getfloat('spool', 'PollSeconds'))
+    finally:
+        database_handler.close()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
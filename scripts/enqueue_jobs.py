@@ -0,0 +1,55 @@
+"""Adds jobs for the thread in the config file to the shared job queue
+
+Usage:
+    enqueue_jobs.py backfill <since YYYY-MM-DD> <until YYYY-MM-DD>
+    enqueue_jobs.py update
+    enqueue_jobs.py aggregation <links|words_by_user|activity|reply_latency|sessions|word_sketches|cardinality|
+                                 reposts|trending>
+"""
+import turkey_vulture
+from turkey_vulture import jobs
+import ConfigParser
+import datetime
+import sys
+
+VULTURE_CONFIG_FILE = '../config/vulture.ini'
+
+
+def main():
+
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+
+    config = ConfigParser.ConfigParser()
+    config.read(VULTURE_CONFIG_FILE)
+
+    thread_id = config.get('graph.facebook.com', 'ThreadId')
+
+    mongo_url = config.get('db', 'mongo_url')
+    mongo_database = config.get('db', 'database')
+    mongo_username = config.get('db', 'username')
+    mongo_password = config.get('db', 'password')
+
+    database_handler = turkey_vulture.DatabaseHandler(mongo_url, mongo_database, thread_id=thread_id)
+    database_handler.authenticate(mongo_username, mongo_password)
+
+    queue = jobs.JobQueue(database_handler)
+    try:
+        if sys.argv[1] == jobs.BACKFILL_JOB:
+            since, until = [datetime.datetime.strptime(day, '%Y-%m-%d') for day in sys.argv[2:4]]
+            job_ids = jobs.enqueue_backfill(queue, thread_id, since, until)
+        elif sys.argv[1] == jobs.UPDATE_JOB:
+            job_ids = [queue.enqueue(jobs.UPDATE_JOB, thread_id)]
+        elif sys.argv[1] == jobs.AGGREGATION_JOB:
+            job_ids = [queue.enqueue(jobs.AGGREGATION_JOB, thread_id, {'name': sys.argv[2]})]
+        else:
+            sys.exit(__doc__)
+        if sys.argv[1] != jobs.BACKFILL_JOB:
+            # Updates and aggregations recur under a fixed id, so a finished one is scheduled again
+            queue.requeue(job_ids[0])
+        print('Enqueued %d jobs' % len(job_ids))
+    finally:
+        database_handler.close()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,34 @@
+import turkey_vulture
+from turkey_vulture import transfer
+import ConfigParser
+import sys
+
+VULTURE_CONFIG_FILE = '../config/vulture.ini'
+
+
+def main():
+
+    if len(sys.argv) != 2:
+        sys.exit('Usage: export_thread.py <export_directory>')
+    export_directory = sys.argv[1]
+
+    config = ConfigParser.ConfigParser()
+    config.read(VULTURE_CONFIG_FILE)
+
+    thread_id = config.get('graph.facebook.com', 'ThreadId')
+
+    mongo_url = config.get('db', 'mongo_url')
+    mongo_database = config.get('db', 'database')
+    mongo_username = config.get('db', 'username')
+    mongo_password = config.get('db', 'password')
+
+    database_handler = turkey_vulture.DatabaseHandler(mongo_url, mongo_database, thread_id=thread_id)
+    database_handler.authenticate(mongo_username, mongo_password)
+
+    try:
+        transfer.export_thread(database_handler, export_directory)
+    finally:
+        database_handler.close()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
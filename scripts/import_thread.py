@@ -0,0 +1,49 @@
+import turkey_vulture
+from turkey_vulture import transfer
+from turkey_vulture import words
+from turkey_vulture import cardinality
+from turkey_vulture import reposts
+from turkey_vulture import search
+from turkey_vulture import trending
+import ConfigParser
+import os
+import sys
+
+VULTURE_CONFIG_FILE = '../config/vulture.ini'
+
+
+def main():
+
+    if len(sys.argv) != 2:
+        sys.exit('Usage: import_thread.py <export_directory>')
+    export_directory = sys.argv[1]
+
+    config = ConfigParser.ConfigParser()
+    config.read(VULTURE_CONFIG_FILE)
+
+    thread_id = config.get('graph.facebook.com', 'ThreadId')
+
+    mongo_url = config.get('db', 'mongo_url')
+    mongo_database = config.get('db', 'database')
+    mongo_username = config.get('db', 'username')
+    mongo_password = config.get('db', 'password')
+
+    search_directory = config.get('search', 'Directory')
+
+    database_handler = turkey_vulture.DatabaseHandler(mongo_url, mongo_database, thread_id=thread_id)
+    database_handler.authenticate(mongo_username, mongo_password)
+    database_handler.add_ingest_hook(database_handler.update_activity_rollups)
+    database_handler.add_ingest_hook(database_handler.update_domain_rollups)
+    database_handler.add_ingest_hook(words.WordSketches(database_handler).update)
+    database_handler.add_ingest_hook(cardinality.DistinctCounters(database_handler).update)
+    database_handler.add_ingest_hook(reposts.RepostIndex(database_handler).update)
+    database_handler.add_ingest_hook(search.SearchIndex(os.path.join(search_directory, thread_id)).update)
+    database_handler.add_ingest_hook(trending.TrendingTerms(database_handler).update)
+
+    try:
+        transfer.import_thread(database_handler, export_directory)
+    finally:
+        database_handler.close()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,40 @@
+import turkey_vulture
+from turkey_vulture import interactions
+import ConfigParser
+import sys
+
+VULTURE_CONFIG_FILE = '../config/vulture.ini'
+
+
+def main():
+
+    if len(sys.argv) != 2:
+        sys.exit('Usage: interaction_graph.py <graph_file.npz>')
+    graph_path = sys.argv[1]
+
+    config = ConfigParser.ConfigParser()
+    config.read(VULTURE_CONFIG_FILE)
+
+    thread_id = config.get('graph.facebook.com', 'ThreadId')
+
+    mongo_url = config.get('db', 'mongo_url')
+    mongo_database = config.get('db', 'database')
+    mongo_username = config.get('db', 'username')
+    mongo_password = config.get('db', 'password')
+
+    database_handler = turkey_vulture.DatabaseHandler(mongo_url, mongo_database, thread_id=thread_id)
+    database_handler.authenticate(mongo_username, mongo_password)
+
+    try:
+        graph = interactions.InteractionGraph.build(database_handler)
+    finally:
+        database_handler.close()
+    graph.save(graph_path)
+
+    names = dict(zip(graph.sender_ids, graph.sender_names))
+    for sender_id, score in graph.centrality():
+        partners = ', '.join(names[partner_id] or partner_id for partner_id, _ in graph.top_partners(sender_id, k=3))
+        print(u'{0:<30} {1:.4f}  {2}'.format(names[sender_id] or sender_id, score, partners))
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,62 @@
+"""Compares the memory used by raw Graph Api post dicts and compact Post objects
+
+Usage: post_memory_benchmark.py [post_count]
+"""
+import turkey_vulture
+import gc
+import sys
+
+DEFAULT_POST_COUNT = 1000000
+SENDER_COUNT = 12
+
+
+def graph_post(post_number):
+    sender = post_number % SENDER_COUNT
+    # The Graph Api hands every post its own freshly decoded strings, so nothing is shared between dicts
+    return {
+        u'id': u'999_%d' % post_number,
+        u'from': {u'id': u'%d' % sender, u'name': u'Person %d' % sender},
+        u'message': u'Message number %d' % post_number,
+        u'created_time': u'2010-01-23T14:%02d:%02d+0000' % (post_number // 60 % 60, post_number % 60),
+    }
+
+
+def deep_size(objects):
+    """Sums the size of every object reachable from objects, counting shared objects once"""
+    seen = set()
+    stack = list(objects)
+    total = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+        elif hasattr(item, '__slots__'):
+            stack.extend(getattr(item, slot) for slot in item.__slots__)
+    return total
+
+
+def main():
+    post_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_POST_COUNT
+
+    dict_posts = [graph_post(post_number) for post_number in xrange(post_count)]
+    dict_bytes = deep_size(dict_posts)
+    del dict_posts
+    gc.collect()
+
+    compact_posts = [turkey_vulture.Post.from_graph(graph_post(post_number)) for post_number in xrange(post_count)]
+    compact_bytes = deep_size(compact_posts)
+
+    print('posts:         %d' % post_count)
+    print('dict posts:    %d bytes (%.1f per post)' % (dict_bytes, float(dict_bytes) / post_count))
+    print('compact posts: %d bytes (%.1f per post)' % (compact_bytes, float(compact_bytes) / post_count))
+    print('saved:         %.1f%%' % (100.0 * (dict_bytes - compact_bytes) / dict_bytes))
+
+if __name__ == "__main__":
+    main()
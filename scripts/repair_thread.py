@@ -0,0 +1,43 @@
+import turkey_vulture
+from turkey_vulture import repair
+import facebook
+import ConfigParser
+import datetime
+
+VULTURE_CONFIG_FILE = '../config/vulture.ini'
+
+# Two posts further apart than this are reported, since a silence that long may hide missing posts
+MAX_TIME_JUMP = datetime.timedelta(days=30)
+
+
+def main():
+
+    config = ConfigParser.ConfigParser()
+    config.read(VULTURE_CONFIG_FILE)
+
+    access_token = config.get('graph.facebook.com', 'AccessToken')
+    thread_id = config.get('graph.facebook.com', 'ThreadId')
+
+    mongo_url = config.get('db', 'mongo_url')
+    mongo_database = config.get('db', 'database')
+    mongo_username = config.get('db', 'username')
+    mongo_password = config.get('db', 'password')
+
+    database_handler = turkey_vulture.DatabaseHandler(mongo_url, mongo_database, thread_id=thread_id)
+    database_handler.authenticate(mongo_username, mongo_password)
+
+    graph = facebook.GraphAPI(access_token=access_token, timeout=60)
+    thread = turkey_vulture.FacebookThread(graph, thread_id, latest_post_id=database_handler.most_recent_post_id)
+
+    try:
+        database_handler.add_sequence_ids()
+        gaps = database_handler.find_gaps(max_time_jump=MAX_TIME_JUMP)
+        for gap in gaps:
+            print('%(kind)s: %(missing)d posts between %(after_seq)d and %(before_seq)d' % gap)
+        fetched = repair.repair_gaps(thread, database_handler, gaps)
+        print('Fetched %d posts, %d gaps remain' % (fetched, len(database_handler.find_gaps())))
+    finally:
+        database_handler.close()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
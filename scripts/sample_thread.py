@@ -0,0 +1,47 @@
+"""Estimates the top words and domains of the thread in the config file from a sample of its posts
+
+Usage:
+    sample_thread.py <fraction> [random|partition] [partition]
+"""
+import turkey_vulture
+from turkey_vulture import analytics
+import ConfigParser
+import sys
+
+VULTURE_CONFIG_FILE = '../config/vulture.ini'
+
+
+def main():
+
+    if not 2 <= len(sys.argv) <= 4:
+        sys.exit(__doc__)
+
+    config = ConfigParser.ConfigParser()
+    config.read(VULTURE_CONFIG_FILE)
+
+    thread_id = config.get('graph.facebook.com', 'ThreadId')
+
+    mongo_url = config.get('db', 'mongo_url')
+    mongo_database = config.get('db', 'database')
+    mongo_username = config.get('db', 'username')
+    mongo_password = config.get('db', 'password')
+
+    database_handler = turkey_vulture.DatabaseHandler(mongo_url, mongo_database, thread_id=thread_id)
+    database_handler.authenticate(mongo_username, mongo_password)
+
+    try:
+        method = sys.argv[2] if len(sys.argv) > 2 else 'random'
+        partition = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+        sampled_analytics = analytics.SampledAnalytics.build(database_handler, float(sys.argv[1]), method, partition)
+    finally:
+        database_handler.close()
+
+    print('{0} posts sampled, {1:.2%} of the thread, {2:.0%} intervals'.format(
+        sampled_analytics.posts, sampled_analytics.fraction, sampled_analytics.confidence))
+    for document in sampled_analytics.word_counts()[:20] + sampled_analytics.top_domains(limit=20):
+        name = document['_id']['word'] if isinstance(document['_id'], dict) else document['_id']
+        print(u'{0:<30} {1:>8} [{2}, {3}]'.format(name, document['count'], document['count_low'],
+                                                 document['count_high']))
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
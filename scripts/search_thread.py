@@ -0,0 +1,50 @@
+"""Searches the messages of the thread in the config file
+
+Usage:
+    search_thread.py rebuild
+    search_thread.py <query>
+"""
+import turkey_vulture
+from turkey_vulture import search
+import ConfigParser
+import os
+import sys
+
+VULTURE_CONFIG_FILE = '../config/vulture.ini'
+
+
+def main():
+
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+
+    config = ConfigParser.ConfigParser()
+    config.read(VULTURE_CONFIG_FILE)
+
+    thread_id = config.get('graph.facebook.com', 'ThreadId')
+
+    mongo_url = config.get('db', 'mongo_url')
+    mongo_database = config.get('db', 'database')
+    mongo_username = config.get('db', 'username')
+    mongo_password = config.get('db', 'password')
+
+    search_index = search.SearchIndex(os.path.join(config.get('search', 'Directory'), thread_id))
+
+    database_handler = turkey_vulture.DatabaseHandler(mongo_url, mongo_database, thread_id=thread_id)
+    database_handler.authenticate(mongo_username, mongo_password)
+
+    try:
+        if sys.argv[1:] == ['rebuild']:
+            search_index.rebuild(database_handler)
+            return
+        sender_names = database_handler.sender_names
+        seqs = search_index.search(' '.join(sys.argv[1:]).decode('utf-8'), limit=20)
+        for post in search.find_posts(database_handler, seqs):
+            print(u'{0} {1}: {2}'.format(post['created_time'], sender_names.get(post['sender'], post['sender']),
+                                         post.get('message', u'')))
+    finally:
+        search_index.close()
+        database_handler.close()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
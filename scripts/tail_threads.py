@@ -0,0 +1,54 @@
+import turkey_vulture
+from turkey_vulture import hooks
+from turkey_vulture import tail
+import facebook
+import ConfigParser
+import os
+
+VULTURE_CONFIG_FILE = '../config/vulture.ini'
+
+
+def main():
+
+    config = ConfigParser.ConfigParser()
+    config.read(VULTURE_CONFIG_FILE)
+
+    access_token = config.get('graph.facebook.com', 'AccessToken')
+    # ThreadId can hold a comma separated list of threads to tail
+    thread_ids = [thread_id.strip() for thread_id in config.get('graph.facebook.com', 'ThreadId').split(',')]
+
+    mongo_url = config.get('db', 'mongo_url')
+    mongo_database = config.get('db', 'database')
+    mongo_username = config.get('db', 'username')
+    mongo_password = config.get('db', 'password')
+
+    requests_per_hour = config.getfloat('tail', 'RequestsPerHour')
+    min_interval = config.getfloat('tail', 'MinInterval')
+    max_interval = config.getfloat('tail', 'MaxInterval')
+
+    search_directory = config.get('search', 'Directory')
+
+    graph = facebook.GraphAPI(access_token=access_token, timeout=60)
+    daemon = tail.TailDaemon(tail.RequestBudget(requests_per_hour),
+                             interval_factory=lambda: tail.AdaptiveInterval(min_interval, max_interval))
+
+    database_handlers = []
+    try:
+        for thread_id in thread_ids:
+            database_handler = turkey_vulture.DatabaseHandler(mongo_url, mongo_database, thread_id=thread_id)
+            database_handler.authenticate(mongo_username, mongo_password)
+            hooks.register_default_hooks(database_handler, os.path.join(search_directory, thread_id))
+            database_handlers.append(database_handler)
+
+            thread = turkey_vulture.FacebookThread(graph, thread_id,
+                                                   latest_post_id=database_handler.most_recent_post_id,
+                                                   latest_post_time=database_handler.most_recent_post_time)
+            daemon.add_thread(thread, database_handler)
+
+        daemon.run()
+    finally:
+        for database_handler in database_handlers:
+            database_handler.close()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,35 @@
+import turkey_vulture
+from turkey_vulture import trending
+import ConfigParser
+import sys
+
+VULTURE_CONFIG_FILE = '../config/vulture.ini'
+
+
+def main():
+
+    if len(sys.argv) > 2:
+        sys.exit('Usage: trending_terms.py [recent_hours]')
+    recent_hours = int(sys.argv[1]) if len(sys.argv) == 2 else 24
+
+    config = ConfigParser.ConfigParser()
+    config.read(VULTURE_CONFIG_FILE)
+
+    thread_id = config.get('graph.facebook.com', 'ThreadId')
+
+    mongo_url = config.get('db', 'mongo_url')
+    mongo_database = config.get('db', 'database')
+    mongo_username = config.get('db', 'username')
+    mongo_password = config.get('db', 'password')
+
+    database_handler = turkey_vulture.DatabaseHandler(mongo_url, mongo_database, thread_id=thread_id)
+    database_handler.authenticate(mongo_username, mongo_password)
+
+    try:
+        for term, count, score in trending.TrendingTerms(database_handler).trending(recent_buckets=recent_hours):
+            print(u'{0:<30} {1:>8} {2:8.1f}'.format(term, count, score))
+    finally:
+        database_handler.close()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -1,4 +1,5 @@
 import turkey_vulture
+from turkey_vulture import spool
 import facebook
 import ConfigParser
 import time
@@ -23,26 +24,33 @@ def main():
     database_handler.authenticate(mongo_username, mongo_password)
 
     graph = facebook.GraphAPI(access_token=access_token, timeout=60)
-    thread = turkey_vulture.FacebookThread(graph, thread_id, latest_post_id=database_handler.most_recent_post_id)
-
-    #TODO: Make way to update participants
-    more_posts_exist = thread.update_thread()
-
-    while more_posts_exist:
-        try:
-            more_posts_exist = thread.update_thread()
-            if thread.posts:
-                database_handler.add_posts(thread.pop_posts())
-        except facebook.GraphAPIError as fb_error:
-            if fb_error.result['error']['code'] == 613:
-                time.sleep(100)
-            elif fb_error.result['error']['code'] == 190:
-                new_token = str(raw_input('Please input a new access_token'))
-                thread.change_access_token(new_token)
-            else:
-                raise fb_error
-        finally:
-            database_handler.close()
+    thread = turkey_vulture.FacebookThread(graph, thread_id, latest_post_id=database_handler.most_recent_post_id,
+                                           latest_post_time=database_handler.most_recent_post_time)
+
+    # The database is only read for the latest post, new posts are written by drain_spool.py
+    database_handler.close()
+    post_spool = spool.PostSpool(config.get('spool', 'Directory'))
+
+    try:
+        thread.update_participants()
+        post_spool.append_participants(thread.participants)
+        while True:
+            try:
+                # Only posts newer than the stored ones are fetched, and usually there are none
+                thread.delta_update()
+                break
+            except facebook.GraphAPIError as fb_error:
+                if fb_error.result['error']['code'] == 613:
+                    time.sleep(100)
+                elif fb_error.result['error']['code'] == 190:
+                    new_token = str(raw_input('Please input a new access_token'))
+                    thread.change_access_token(new_token)
+                else:
+                    raise fb_error
+        if thread.posts:
+            post_spool.append_posts(thread.pop_posts())
+    finally:
+        post_spool.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,48 @@
+import turkey_vulture
+from turkey_vulture import similarity
+import ConfigParser
+import datetime
+import sys
+
+VULTURE_CONFIG_FILE = '../config/vulture.ini'
+
+
+def main():
+
+    if len(sys.argv) not in (2, 3):
+        sys.exit('Usage: vocabulary_similarity.py <result_directory> [window_days]')
+    result_directory = sys.argv[1]
+
+    config = ConfigParser.ConfigParser()
+    config.read(VULTURE_CONFIG_FILE)
+
+    thread_id = config.get('graph.facebook.com', 'ThreadId')
+
+    mongo_url = config.get('db', 'mongo_url')
+    mongo_database = config.get('db', 'database')
+    mongo_username = config.get('db', 'username')
+    mongo_password = config.get('db', 'password')
+
+    database_handler = turkey_vulture.DatabaseHandler(mongo_url, mongo_database, thread_id=thread_id)
+    database_handler.authenticate(mongo_username, mongo_password)
+
+    try:
+        if len(sys.argv) == 3:
+            window = datetime.timedelta(days=int(sys.argv[2]))
+            results = similarity.VocabularySimilarity.windows(database_handler, result_directory, window)
+        else:
+            results = [(None, similarity.VocabularySimilarity.cached(database_handler, result_directory))]
+        names = database_handler.sender_names
+    finally:
+        database_handler.close()
+
+    for start, result in results:
+        if start is not None:
+            print(start.strftime('%Y-%m-%d'))
+        for sender_id in result.sender_ids:
+            partners = ', '.join(u'{0} {1:.2f}'.format(names.get(partner_id) or partner_id, score)
+                                 for partner_id, score in result.most_similar(sender_id, k=3))
+            print(u'{0:<30} {1}'.format(names.get(sender_id) or sender_id, partners))
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,86 @@
+import turkey_vulture
+from turkey_vulture import jobs
+from turkey_vulture import hooks
+from turkey_vulture import latency
+from turkey_vulture import sessions
+from turkey_vulture import words
+from turkey_vulture import cardinality
+from turkey_vulture import reposts
+from turkey_vulture import trending
+import facebook
+import ConfigParser
+import os
+
+VULTURE_CONFIG_FILE = '../config/vulture.ini'
+
+AGGREGATIONS = {
+    'links': turkey_vulture.DatabaseHandler.posts_links_aggregation,
+    'words_by_user': turkey_vulture.DatabaseHandler.posts_by_user_aggregation,
+    'activity': turkey_vulture.DatabaseHandler.rebuild_activity_rollups,
+    'reply_latency': latency.update_reply_latency,
+    'sessions': sessions.update_sessions,
+    'word_sketches': lambda database_handler: words.WordSketches(database_handler).rebuild(),
+    'cardinality': lambda database_handler: cardinality.DistinctCounters(database_handler).rebuild(),
+    'reposts': lambda database_handler: reposts.RepostIndex(database_handler).rebuild(),
+    'trending': lambda database_handler: trending.TrendingTerms(database_handler).rebuild(),
+}
+
+
+def main():
+
+    config = ConfigParser.ConfigParser()
+    config.read(VULTURE_CONFIG_FILE)
+
+    access_token = config.get('graph.facebook.com', 'AccessToken')
+
+    mongo_url = config.get('db', 'mongo_url')
+    mongo_database = config.get('db', 'database')
+    mongo_username = config.get('db', 'username')
+    mongo_password = config.get('db', 'password')
+
+    search_directory = config.get('search', 'Directory')
+
+    graph = facebook.GraphAPI(access_token=access_token, timeout=60)
+    database_handlers = {}
+
+    def database_handler_for(thread_id):
+        if thread_id not in database_handlers:
+            database_handler = turkey_vulture.DatabaseHandler(mongo_url, mongo_database, thread_id=thread_id)
+            database_handler.authenticate(mongo_username, mongo_password)
+            hooks.register_default_hooks(database_handler, os.path.join(search_directory, thread_id))
+            database_handlers[thread_id] = database_handler
+        return database_handlers[thread_id]
+
+    def backfill(job):
+        database_handler = database_handler_for(job['thread_id'])
+        # A latest post id keeps the thread from fetching the newest page, which a backfill does not need
+        thread = turkey_vulture.FacebookThread(graph, job['thread_id'], latest_post_id='0')
+        window_posts = thread.fetch_window(job['payload']['since'], job['payload']['until'])
+        if window_posts:
+            database_handler.add_posts(window_posts, ignore_duplicates=True)
+        return len(window_posts)
+
+    def update(job):
+        database_handler = database_handler_for(job['thread_id'])
+        thread = turkey_vulture.FacebookThread(graph, job['thread_id'],
+                                               latest_post_id=database_handler.most_recent_post_id,
+                                               latest_post_time=database_handler.most_recent_post_time)
+        new_posts = thread.delta_update()
+        if new_posts:
+            database_handler.add_posts(thread.pop_posts(), ignore_duplicates=True)
+        return len(new_posts)
+
+    def aggregation(job):
+        AGGREGATIONS[job['payload']['name']](database_handler_for(job['thread_id']))
+
+    queue = jobs.JobQueue(database_handler_for(config.get('graph.facebook.com', 'ThreadId')))
+    queue.ensure_indexes()
+    worker = jobs.Worker(queue, {jobs.BACKFILL_JOB: backfill, jobs.UPDATE_JOB: update, jobs.AGGREGATION_JOB: aggregation})
+    try:
+        worker.run()
+    finally:
+        for database_handler in database_handlers.values():
+            database_handler.close()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
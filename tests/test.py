@@ -1,8 +1,41 @@
 import unittest
 import turkey_vulture
+from turkey_vulture import tail
+from turkey_vulture import spool
+from turkey_vulture import jobs
+from turkey_vulture import pipeline
+from turkey_vulture import cache
+from turkey_vulture import latency
+from turkey_vulture import sketches
+from turkey_vulture import interactions
+from turkey_vulture import sessions
+from turkey_vulture import words
+from turkey_vulture import cardinality
+from turkey_vulture import links
+from turkey_vulture import reposts
+from turkey_vulture import search
+from turkey_vulture import similarity
+from turkey_vulture import trending
+from turkey_vulture import analytics
+from turkey_vulture import transfer
+from turkey_vulture import archive
+from turkey_vulture import repair
+from turkey_vulture import hooks
+from turkey_vulture.models import Post
 import data
 import facebook
 import re
+import datetime
+import calendar
+import copy
+import collections
+import os
+import shutil
+import tempfile
+import numpy
+import pymongo
+import math
+import scipy.stats
 
 
 # TODO: Add test for big update
@@ -10,6 +43,7 @@ class MockGraphAPI(facebook.GraphAPI):
     def __init__(self):
         facebook.GraphAPI.__init__(self, "access_token", 60)
         self._thread_order = {}
+        self.requests = []
         self.use_default_order()
         self._api_version_regex = re.compile('/v\d\.\d/')
 
@@ -40,6 +74,7 @@ class MockGraphAPI(facebook.GraphAPI):
         }
 
     def get_object(self, id, **kwargs):
+        self.requests.append((id, kwargs))
         id_array = re.sub(self._api_version_regex, '', id).split('/')
 
         thread_id = id_array[0]
@@ -52,7 +87,8 @@ class MockGraphAPI(facebook.GraphAPI):
         thread_page = self._thread_order[thread_id][until]
         for path in data_path:
             thread_page = thread_page.get(path)
-        return thread_page
+        # Callers such as add_posts change the posts in place, the shared test data has to stay as it is
+        return copy.deepcopy(thread_page)
 
 
 class FacebookThreadTestCase(unittest.TestCase):
@@ -172,4 +208,1557 @@ class TestUpdateThreadIdConstructor(UpdateThreadConstructorTestCase):
         self.test_thread._graph.use_partial_update_order()
         self.assertTrue(self.test_thread.update_thread())
         self.assertFalse(self.test_thread.update_thread())
-        self.assertEqual(6, len(self.test_thread.posts))
\ No newline at end of file
+        self.assertEqual(6, len(self.test_thread.posts))
+
+
+class TestCompactPosts(unittest.TestCase):
+    def setUp(self):
+        self.test_thread = turkey_vulture.FacebookThread(MockGraphAPI(), '999', compact_posts=True)
+
+    def test_posts_are_compact(self):
+        self.assertEqual(25, len(self.test_thread.posts))
+        self.assertTrue(all(isinstance(post, turkey_vulture.Post) for post in self.test_thread.posts))
+        self.assertEqual(12, self.test_thread.posts[0].post_id)
+
+    def test_participants_are_compact(self):
+        self.assertEqual(8, len(self.test_thread.participants))
+        self.assertEqual(turkey_vulture.Participant('1', 'Person One'), self.test_thread.participants[0])
+
+    def test_get_next_page(self):
+        self.assertTrue(self.test_thread.get_next_page())
+        self.assertEqual(36, len(self.test_thread.posts))
+        self.assertEqual(1, self.test_thread.posts[0].post_id)
+
+    def test_sender_is_shared(self):
+        senders = [post.sender_id for post in self.test_thread.posts if post.sender_id == '8']
+        self.assertTrue(all(sender is senders[0] for sender in senders))
+
+    def test_graph_round_trip(self):
+        self.assertEqual(data.START_999_JSON['comments']['data'][0], self.test_thread.posts[0].to_graph())
+
+    def test_document_round_trip(self):
+        post = self.test_thread.posts[0]
+        document = post.to_document()
+        self.assertEqual('999_12', document['_id'])
+        self.assertEqual('8', document['sender'])
+        self.assertNotIn('from', document)
+        self.assertEqual(post, turkey_vulture.Post.from_document(document, {'8': 'Person Eight'}))
+
+    def test_post_transform(self):
+        post = self.test_thread.posts[0]
+        self.assertEqual(post.to_document(), turkey_vulture.DatabaseHandler.post_transform(post))
+        self.assertEqual(post.to_document(), turkey_vulture.DatabaseHandler.post_transform(post.to_graph()))
+
+    def test_post_untransform(self):
+        post = self.test_thread.posts[0]
+        self.assertEqual(post.to_graph(),
+                         turkey_vulture.DatabaseHandler.post_untransform(post.to_document(), {'8': 'Person Eight'}))
+
+
+class TestDeltaUpdate(UpdateThreadTestCase):
+    def test_no_delta(self):
+        self.assertListEqual([], self.test_thread.delta_update())
+        self.assertEqual(1, len(self.test_thread._graph.requests) - 3)
+
+    def test_delta_uses_since(self):
+        self.test_thread.delta_update()
+        request_id, request_query = self.test_thread._graph.requests[-1]
+        self.assertEqual('999/comments', request_id)
+        self.assertEqual(1264255200, request_query['since'])
+
+    def test_full_delta(self):
+        self.test_thread._graph.use_full_update_order()
+        new_posts = self.test_thread.delta_update()
+        self.assertEqual(25, len(new_posts))
+        self.assertEqual('999_37', new_posts[0]['id'])
+        self.assertEqual('999_61', new_posts[-1]['id'])
+        self.assertEqual(61, len(self.test_thread.posts))
+        self.assertEqual('61', self.test_thread._latest_post_id)
+
+    def test_partial_delta(self):
+        self.test_thread._graph.use_partial_update_order()
+        new_posts = self.test_thread.delta_update()
+        self.assertListEqual(['999_%d' % post_id for post_id in range(37, 43)], [post['id'] for post in new_posts])
+        self.assertEqual(42, len(self.test_thread.posts))
+
+
+class TestDeltaUpdateIdConstructor(unittest.TestCase):
+    def setUp(self):
+        self.test_thread = turkey_vulture.FacebookThread(MockGraphAPI(), '999', '9')
+
+    def test_delta_without_time(self):
+        new_posts = self.test_thread.delta_update()
+        self.assertNotIn('since', self.test_thread._graph.requests[0][1])
+        self.assertEqual(27, len(new_posts))
+        self.assertEqual('999_10', new_posts[0]['id'])
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class MockDatabaseHandler:
+    def __init__(self):
+        self.posts = []
+        self.participants = []
+
+    def add_posts(self, post_list, ignore_duplicates=False):
+        self.posts.extend(post_list)
+
+    def set_participants(self, participants_list):
+        self.participants = participants_list
+
+    def update_participants(self, participants_list):
+        self.participants = participants_list
+
+    def get_participants(self, include_former=False):
+        return self.participants
+
+    @property
+    def sender_names(self):
+        return dict((participant['id'], participant['name']) for participant in self.participants)
+
+    def iter_posts(self, after_seq=None, batch_size=1000, projection=None):
+        documents = [turkey_vulture.DatabaseHandler.post_transform(copy.deepcopy(post)) for post in self.posts]
+        return sorted((document for document in documents if after_seq is None or document['seq'] > after_seq),
+                      key=lambda document: document['seq'])
+
+    def scan_posts(self, fields, query=None, sort=None, batch_size=None, raw=False):
+        for post in self.posts:
+            document = turkey_vulture.DatabaseHandler.post_transform(copy.deepcopy(post))
+            yield dict((field, document[field]) for field in fields if field in document)
+
+
+class MockStateCollection:
+    """Passes every call through to a real collection, except replace_one"""
+
+    def __init__(self, collection, replace_one):
+        self._collection = collection
+        self.replace_one = replace_one
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+
+class TestAdaptiveInterval(unittest.TestCase):
+    def setUp(self):
+        self.interval = tail.AdaptiveInterval(min_seconds=10, max_seconds=80, tighten_factor=0.5, backoff_factor=2)
+
+    def test_backs_off_when_idle(self):
+        self.assertEqual(20, self.interval.record(0))
+        self.assertEqual(40, self.interval.record(0))
+        self.assertEqual(80, self.interval.record(0))
+        self.assertEqual(80, self.interval.record(0))
+
+    def test_tightens_on_new_posts(self):
+        self.interval.back_off_fully()
+        self.assertEqual(40, self.interval.record(3))
+        self.assertEqual(20, self.interval.record(1))
+        self.assertEqual(10, self.interval.record(1))
+        self.assertEqual(10, self.interval.record(1))
+
+
+class TestRequestBudget(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.budget = tail.RequestBudget(3600, burst=2, clock=self.clock)
+
+    def test_burst(self):
+        self.assertEqual(0, self.budget.wait_time())
+        self.budget.spend(2)
+        self.assertEqual(1, self.budget.wait_time())
+
+    def test_refill(self):
+        self.budget.spend(2)
+        self.clock.sleep(1)
+        self.assertEqual(0, self.budget.wait_time())
+
+
+class TestTailDaemon(UpdateThreadTestCase):
+    def setUp(self):
+        super(TestTailDaemon, self).setUp()
+        self.test_thread.pop_posts()
+        self.clock = FakeClock()
+        self.database_handler = MockDatabaseHandler()
+        self.daemon = tail.TailDaemon(tail.RequestBudget(3600, clock=self.clock), clock=self.clock,
+                                      sleep=self.clock.sleep)
+        self.daemon.add_thread(self.test_thread, self.database_handler)
+
+    def test_idle_thread_backs_off(self):
+        self.assertEqual(('999', 0), self.daemon.poll_next())
+        self.assertEqual(('999', 0), self.daemon.poll_next())
+        self.assertEqual(20, self.daemon.intervals['999'].seconds)
+        self.assertEqual(1010, self.clock.now)
+
+    def test_new_posts_are_flushed(self):
+        self.test_thread._graph.use_full_update_order()
+        self.assertEqual(('999', 25), self.daemon.poll_next())
+        self.assertEqual(25, len(self.database_handler.posts))
+        self.assertEqual([], self.test_thread.posts)
+
+    def test_failed_write_backs_off_and_is_retried(self):
+        self.test_thread._graph.use_full_update_order()
+
+        def fail(post_list, ignore_duplicates=False):
+            raise pymongo.errors.AutoReconnect('connection lost')
+        self.database_handler.add_posts = fail
+        self.assertEqual(('999', 0), self.daemon.poll_next())
+        self.assertEqual(10, self.daemon.intervals['999'].seconds)
+        self.assertEqual(25, len(self.test_thread.posts))
+        del self.database_handler.add_posts
+        self.daemon.poll_next()
+        self.assertEqual(25, len(self.database_handler.posts))
+        self.assertEqual([], self.test_thread.posts)
+        self.assertEqual(1010, self.clock.now)
+
+    def test_failed_request_backs_off_fully(self):
+        def fail(page_limit=None):
+            raise facebook.GraphAPIError({'error': {'code': 1, 'message': 'An unknown error occurred'}})
+        self.test_thread.delta_update = fail
+        self.assertEqual(('999', 0), self.daemon.poll_next())
+        self.assertEqual(self.daemon.intervals['999'].max_seconds, self.daemon.intervals['999'].seconds)
+
+
+class TestFetchWindow(UpdateThreadConstructorTestCase):
+    def test_fetch_window(self):
+        window_time = datetime.datetime(2010, 1, 23, 14, 0)
+        self.test_thread._graph._thread_order['999'][1264255201] = data.START_999_JSON
+        window_posts = self.test_thread.fetch_window(window_time, window_time)
+        self.assertEqual(35, len(window_posts))
+        self.assertEqual('999_1', window_posts[0]['id'])
+        self.assertEqual(1264255200, self.test_thread._graph.requests[0][1]['since'])
+        self.assertListEqual([], self.test_thread.posts)
+        self.assertEqual('36', self.test_thread._latest_post_id)
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.spool_directory = tempfile.mkdtemp()
+        self.database_handler = MockDatabaseHandler()
+        self.drainer = spool.SpoolDrainer(self.spool_directory, self.database_handler, batch_posts=20)
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_directory)
+
+    def spool_pages(self, *pages):
+        post_spool = spool.PostSpool(self.spool_directory)
+        for page in pages:
+            post_spool.append_posts(copy.deepcopy(page['comments']['data']))
+        post_spool.close()
+
+    def test_drain(self):
+        self.spool_pages(data.START_999_JSON, data.UNTIL_12_999_JSON)
+        self.assertTrue(self.drainer.drain())
+        self.assertEqual(36, len(self.database_handler.posts))
+        self.assertTrue(self.drainer.drain())
+        self.assertEqual(36, len(self.database_handler.posts))
+
+    def test_drain_participants(self):
+        post_spool = spool.PostSpool(self.spool_directory)
+        post_spool.append_participants(data.START_999_JSON['to']['data'])
+        post_spool.close()
+        self.drainer.drain()
+        self.assertEqual(8, len(self.database_handler.participants))
+
+    def test_drain_skips_torn_record(self):
+        self.spool_pages(data.START_999_JSON)
+        with open(os.path.join(self.spool_directory, spool.SEGMENT_FILE_FORMAT.format(0)), 'ab') as segment:
+            segment.write('{"kind": "posts", "val')
+        self.spool_pages(data.UNTIL_12_999_JSON)
+        self.drainer.drain()
+        self.assertEqual(36, len(self.database_handler.posts))
+
+    def test_drained_segments_are_removed(self):
+        self.spool_pages(data.START_999_JSON)
+        self.spool_pages(data.UNTIL_12_999_JSON)
+        self.drainer.drain()
+        self.assertListEqual([spool.CHECKPOINT_FILE, spool.SEGMENT_FILE_FORMAT.format(1)],
+                             sorted(os.listdir(self.spool_directory)))
+
+    def test_appends_are_synced(self):
+        post_spool = spool.PostSpool(self.spool_directory)
+        post_spool.append_posts(copy.deepcopy(data.START_999_JSON['comments']['data']))
+        self.assertEqual(0, post_spool._unsynced_records)
+        post_spool.close()
+        batched_spool = spool.PostSpool(self.spool_directory, fsync_records=100, fsync_seconds=3600)
+        batched_spool.append_posts(copy.deepcopy(data.UNTIL_12_999_JSON['comments']['data']))
+        self.assertEqual(1, batched_spool._unsynced_records)
+        batched_spool.flush()
+        self.assertEqual(0, batched_spool._unsynced_records)
+        batched_spool.close()
+
+
+class TestTransfer(unittest.TestCase):
+    def setUp(self):
+        self.export_directory = tempfile.mkdtemp()
+        self.database_handler = MockDatabaseHandler()
+        self.database_handler.set_participants(data.START_999_JSON['to']['data'])
+        self.database_handler.add_posts(copy.deepcopy(data.START_999_JSON['comments']['data']))
+
+    def tearDown(self):
+        shutil.rmtree(self.export_directory)
+
+    def export(self):
+        return transfer.export_thread(self.database_handler, self.export_directory, chunk_size=10, processes=1)
+
+    def test_round_trip(self):
+        self.assertEqual(25, self.export())
+        self.assertEqual(['999_{0}'.format(seq) for seq in range(12, 37)],
+                         [post['id'] for post in transfer.iter_export(self.export_directory)])
+        imported_handler = MockDatabaseHandler()
+        self.assertEqual(25, transfer.import_thread(imported_handler, self.export_directory, batch_size=7))
+        self.assertEqual(self.database_handler.participants, imported_handler.participants)
+        self.assertEqual(list(self.database_handler.iter_posts()), list(imported_handler.iter_posts()))
+
+    def test_resume_picks_up_posts_added_since(self):
+        self.export()
+        later_post = copy.deepcopy(data.START_999_JSON['comments']['data'][0])
+        # 999_100 sorts before 999_36 as a string, but it is the newest post
+        later_post['id'] = '999_100'
+        self.database_handler.add_posts(copy.deepcopy(data.UPDATE_999_JSON['comments']['data']) + [later_post])
+        self.assertEqual(26, self.export())
+        exported_ids = [post['id'] for post in transfer.iter_export(self.export_directory)]
+        self.assertEqual(51, len(exported_ids))
+        self.assertEqual('999_100', exported_ids[-1])
+
+    def test_import_skips_imported_chunks(self):
+        self.export()
+        imported_handler = MockDatabaseHandler()
+        transfer.import_thread(imported_handler, self.export_directory)
+        self.assertEqual(0, transfer.import_thread(imported_handler, self.export_directory))
+        self.assertEqual(25, len(imported_handler.posts))
+
+
+class MockAnalyticsHandler:
+    def __init__(self):
+        self.posts_watermark = {'seq': 36, 'count': 36}
+        self.aggregation_runs = {'words_by_user': datetime.datetime(2015, 6, 1)}
+        self.words = [('lorem', 36)]
+        self.calls = 0
+
+    def top_words(self, sender=None, limit=10):
+        self.calls += 1
+        return list(self.words[:limit])
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        lru = cache.LRUCache(2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        lru.get('a')
+        lru.put('c', 3)
+        self.assertEqual(1, lru.get('a'))
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(2, len(lru))
+
+
+class TestAnalyticsCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.database_handler = MockAnalyticsHandler()
+        self.cache_directory = tempfile.mkdtemp()
+        self.cache = cache.AnalyticsCache(self.database_handler, directory=self.cache_directory, clock=self.clock)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_directory)
+
+    def test_repeated_reads_are_cached(self):
+        self.assertEqual([('lorem', 36)], self.cache.top_words())
+        self.assertEqual([('lorem', 36)], self.cache.top_words())
+        self.assertEqual(1, self.database_handler.calls)
+        self.assertEqual(1, self.cache.hits)
+
+    def test_new_posts_invalidate(self):
+        self.cache.top_words()
+        self.database_handler.posts_watermark = {'seq': 61, 'count': 61}
+        self.database_handler.words = [('lorem', 61)]
+        self.assertEqual([('lorem', 36)], self.cache.top_words())
+        self.clock.sleep(1)
+        self.assertEqual([('lorem', 61)], self.cache.top_words())
+        self.assertEqual(2, self.database_handler.calls)
+
+    def test_aggregation_run_invalidates(self):
+        # New posts land before the aggregation that top_words reads has run again
+        self.database_handler.posts_watermark = {'seq': 61, 'count': 61}
+        self.assertEqual([('lorem', 36)], self.cache.top_words())
+        self.database_handler.words = [('lorem', 61)]
+        self.database_handler.aggregation_runs = {'words_by_user': datetime.datetime(2015, 6, 2)}
+        self.clock.sleep(1)
+        self.assertEqual([('lorem', 61)], self.cache.top_words())
+
+    def test_results_are_copied(self):
+        self.cache.top_words().append(('ipsum', 1))
+        self.assertEqual([('lorem', 36)], self.cache.top_words())
+        self.cache.top_words().append(('ipsum', 1))
+        self.assertEqual([('lorem', 36)], self.cache.top_words())
+
+    def test_disk_tier_is_shared(self):
+        self.cache.top_words(limit=1)
+        other_cache = cache.AnalyticsCache(self.database_handler, directory=self.cache_directory, clock=self.clock)
+        self.assertEqual([('lorem', 36)], other_cache.top_words(limit=1))
+        self.assertEqual(1, self.database_handler.calls)
+
+
+class TestActivityBucket(unittest.TestCase):
+    def test_buckets(self):
+        created_time = datetime.datetime(2010, 1, 23, 14, 35, 12)
+        self.assertEqual(datetime.datetime(2010, 1, 23, 14),
+                         turkey_vulture.DatabaseHandler._activity_bucket(created_time, 'hour'))
+        self.assertEqual(datetime.datetime(2010, 1, 23),
+                         turkey_vulture.DatabaseHandler._activity_bucket(created_time, 'day'))
+        self.assertEqual(datetime.datetime(2010, 1, 18),
+                         turkey_vulture.DatabaseHandler._activity_bucket(created_time, 'week'))
+
+
+class TestQuantileSketch(unittest.TestCase):
+    def setUp(self):
+        self.sketch = sketches.QuantileSketch(relative_accuracy=0.01)
+        for value in range(1, 1001):
+            self.sketch.add(value)
+
+    def test_quantile_is_within_relative_accuracy(self):
+        for q, expected in [(0.5, 500.5), (0.9, 900.1), (0.99, 990.01)]:
+            self.assertAlmostEqual(expected, self.sketch.quantile(q), delta=expected * 0.01)
+
+    def test_zero_values(self):
+        sketch = sketches.QuantileSketch()
+        sketch.add(0, count=3)
+        sketch.add(10)
+        self.assertEqual(0.0, sketch.quantile(0.5))
+        self.assertAlmostEqual(10, sketch.quantile(1), delta=0.1)
+
+    def test_merge_and_document_round_trip(self):
+        other = sketches.QuantileSketch(relative_accuracy=0.01)
+        for value in range(1001, 2001):
+            other.add(value)
+        self.sketch.merge(sketches.QuantileSketch.from_document(other.to_document()))
+        self.assertEqual(2000, self.sketch.count)
+        self.assertAlmostEqual(1000.5, self.sketch.quantile(0.5), delta=10.005)
+        self.assertRaises(ValueError, self.sketch.merge, sketches.QuantileSketch(relative_accuracy=0.05))
+
+
+class TestInteractionGraph(unittest.TestCase):
+    def setUp(self):
+        self.graph = interactions.InteractionGraph(
+            ['1', '2', '3'], [u'One', u'Two', None],
+            numpy.array([[0, 4, 1], [3, 0, 0], [1, 1, 0]]), numpy.array([[0, 2, 0], [2, 0, 0], [0, 0, 0]]), 300)
+
+    def test_top_partners(self):
+        self.assertEqual([('2', 9.0), ('3', 2.0)], self.graph.top_partners('1'))
+        self.assertEqual([('2', 9.0)], self.graph.top_partners('1', k=1))
+        self.assertEqual([('1', 2.0), ('2', 1.0)], self.graph.top_partners('3'))
+
+    def test_centrality(self):
+        ranking = self.graph.centrality()
+        self.assertEqual(['1', '2', '3'], [sender_id for sender_id, _ in ranking])
+        self.assertAlmostEqual(1.0, sum(score for _, score in ranking))
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'interactions.npz')
+            self.graph.save(path)
+            loaded = interactions.InteractionGraph.load(path)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(self.graph.sender_ids, loaded.sender_ids)
+        self.assertEqual(self.graph.sender_names, loaded.sender_names)
+        self.assertTrue((self.graph.transitions == loaded.transitions).all())
+        self.assertTrue((self.graph.co_activity == loaded.co_activity).all())
+        self.assertEqual(300, loaded.window_seconds)
+
+
+class TestPostArchive(unittest.TestCase):
+    # Each tuple is the post id, sender and message, in the order the posts are stored, which is not time order
+    POSTS = [('999_3', '2', u'caf\xe9 au lait', '2015-06-03T10:00:00+0000'),
+             ('999_1', '1', u'first', '2015-06-01T10:00:00+0000'),
+             ('999_2', '1', None, '2015-06-02T10:00:00+0000'),
+             ('999_4', '1', u'last', '2015-06-04T10:00:00+0000')]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database_handler = MockDatabaseHandler()
+        self.database_handler.set_participants([{'id': '1', 'name': 'User 1'}, {'id': '2', 'name': 'User 2'}])
+        for post_id, sender, message, created_time in self.POSTS:
+            post = {'id': post_id, 'from': {'id': sender}, 'created_time': created_time}
+            if message is not None:
+                post['message'] = message
+            self.database_handler.posts.append(post)
+        self.archive = archive.PostArchive.write(self.database_handler, self.directory)
+
+    def tearDown(self):
+        self.archive.close()
+        shutil.rmtree(self.directory)
+
+    def test_write_and_open(self):
+        loaded = archive.PostArchive(self.directory)
+        try:
+            self.assertEqual(4, len(loaded))
+            self.assertEqual([1, 2, 3, 4], list(loaded.post_id))
+            self.assertEqual([{'id': '2', 'name': 'User 2'}, {'id': '1', 'name': 'User 1'}], loaded.senders)
+            self.assertEqual([u'first', u'', u'caf\xe9 au lait', u'last'],
+                             [loaded.message(row) for row in range(len(loaded))])
+        finally:
+            loaded.close()
+
+    def test_time_range(self):
+        self.assertEqual(slice(1, 3), self.archive.time_range(datetime.datetime(2015, 6, 2),
+                                                              datetime.datetime(2015, 6, 3, 12)))
+        self.assertEqual(slice(0, 4), self.archive.time_range())
+        self.assertEqual(slice(4, 4), self.archive.time_range(start=datetime.datetime(2016, 1, 1)))
+
+    def test_counts_by_sender(self):
+        self.assertEqual([1, 3], list(self.archive.counts_by_sender()))
+        self.assertEqual([1, 1], list(self.archive.counts_by_sender(start=datetime.datetime(2015, 6, 2, 12))))
+
+
+class TestTokenize(unittest.TestCase):
+    def test_tokenize(self):
+        self.assertEqual(['lorem', 'ipsum', 'dolor'],
+                         turkey_vulture.DatabaseHandler.tokenize(' Lorem, ipsum...  DOLOR? '))
+        self.assertEqual([], turkey_vulture.DatabaseHandler.tokenize(' !? '))
+
+
+class TestSpaceSaving(unittest.TestCase):
+    STREAM = ['a'] * 50 + ['b'] * 30 + ['c'] * 20 + ['d', 'e', 'f', 'g', 'h'] * 2
+
+    def test_heavy_hitters_are_kept(self):
+        summary = sketches.SpaceSaving(capacity=4)
+        for item in self.STREAM:
+            summary.add(item)
+        top = summary.top(3)
+        self.assertEqual(['a', 'b', 'c'], [item for item, _, _ in top])
+        for item, count, error in top:
+            self.assertTrue(count - error <= self.STREAM.count(item) <= count)
+
+    def test_merge_and_document_round_trip(self):
+        first = sketches.SpaceSaving(capacity=4)
+        second = sketches.SpaceSaving(capacity=4)
+        for index, item in enumerate(self.STREAM):
+            (first if index % 2 else second).add(item)
+        first.merge(sketches.SpaceSaving.from_document(second.to_document()))
+        self.assertEqual(len(self.STREAM), first.total)
+        for item, count, error in first.top(3):
+            self.assertTrue(count - error <= self.STREAM.count(item) <= count)
+
+
+class TestCountMinSketch(unittest.TestCase):
+    def test_estimates_never_undercount(self):
+        sketch = sketches.CountMinSketch.from_error(epsilon=0.01, delta=0.01)
+        counts = dict((u'word{0}'.format(index), index % 7 + 1) for index in range(500))
+        sketch.update(counts)
+        sketch.add(u'word0', 3)
+        counts[u'word0'] += 3
+        self.assertEqual(sum(counts.values()), sketch.total)
+        for word, count in counts.items():
+            self.assertTrue(count <= sketch.estimate(word) <= count + 0.01 * sketch.total)
+
+    def test_merge_and_document_round_trip(self):
+        sketch = sketches.CountMinSketch(100, 4)
+        sketch.add(u'lorem', 2)
+        other = sketches.CountMinSketch(100, 4)
+        other.add(u'lorem', 3)
+        sketch.merge(sketches.CountMinSketch.from_document(other.to_document()))
+        self.assertEqual(5, sketch.estimate(u'lorem'))
+        self.assertRaises(ValueError, sketch.merge, sketches.CountMinSketch(50, 4))
+
+
+class TestHyperLogLog(unittest.TestCase):
+    def test_estimates(self):
+        for size in [0, 10, 1000, 50000]:
+            sketch = sketches.HyperLogLog()
+            sketch.update(u'item{0}'.format(index) for index in range(size))
+            sketch.update(u'item{0}'.format(index) for index in range(size // 2))
+            self.assertAlmostEqual(size, sketch.estimate(), delta=size * 0.05)
+
+    def test_merge_and_document_round_trip(self):
+        first = sketches.HyperLogLog(precision=10)
+        first.update(u'item{0}'.format(index) for index in range(3000))
+        second = sketches.HyperLogLog(precision=10)
+        second.update(u'item{0}'.format(index) for index in range(2000, 5000))
+        first.merge(sketches.HyperLogLog.from_document(second.to_document()))
+        self.assertAlmostEqual(5000, first.estimate(), delta=5000 * 0.1)
+        self.assertRaises(ValueError, first.merge, sketches.HyperLogLog(precision=12))
+
+
+class TestUrlCanonicalizer(unittest.TestCase):
+    def test_variants_share_a_canonical_form(self):
+        canonicalizer = links.UrlCanonicalizer()
+        for url in [u'http://x.com/a', u'x.com/a/', u'HTTP://X.com:80/a#top', u'http://x.com./a?utm_source=feed',
+                    u'http://x.com/a?fbclid=abc&UTM_MEDIUM=social']:
+            self.assertEqual(u'http://x.com/a', canonicalizer.canonicalize(url))
+
+    def test_meaningful_parts_are_kept(self):
+        self.assertEqual(u'https://x.com:8443/a?id=2&page=1',
+                         links.canonicalize_url(u'https://x.com:8443/a/?page=1&id=2'))
+        self.assertEqual(u'https://x.com/caf\xe9?q=%E2%9C%93',
+                         links.canonicalize_url(u'https://x.com/caf\xe9?q=%E2%9C%93'))
+        self.assertEqual(u'https://github.com/a/b?ref=master',
+                         links.canonicalize_url(u'https://github.com/a/b?ref=master&utm_source=feed'))
+        self.assertEqual(u'http://[::1]:8080/a', links.canonicalize_url(u'http://[::1]:8080/a/'))
+        self.assertEqual(u'http://[fe80::1]/a', links.canonicalize_url(u'[FE80::1]:80/a'))
+        self.assertEqual(u'x.com', links.url_domain(u'HTTPS://X.com/a'))
+
+    def test_cache(self):
+        canonicalizer = links.UrlCanonicalizer(capacity=1)
+        canonicalizer.canonicalize(u'x.com/a')
+        canonicalizer.canonicalize(u'x.com/a')
+        canonicalizer.canonicalize(u'x.com/b')
+        canonicalizer.canonicalize(u'x.com/a')
+        self.assertEqual((1, 3), (canonicalizer.hits, canonicalizer.misses))
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom_filter = sketches.BloomFilter.for_capacity(1000, false_positive_rate=0.01)
+        for index in range(1000):
+            bloom_filter.add(u'link{0}'.format(index))
+        self.assertTrue(all(u'link{0}'.format(index) in bloom_filter for index in range(1000)))
+        false_positives = sum(u'other{0}'.format(index) in bloom_filter for index in range(1000))
+        self.assertLess(false_positives, 30)
+
+    def test_merge_and_document_round_trip(self):
+        bloom_filter = sketches.BloomFilter(1024, 3)
+        bloom_filter.add(u'a')
+        other = sketches.BloomFilter(1024, 3)
+        other.add(u'b')
+        bloom_filter.merge(sketches.BloomFilter.from_document(other.to_document()))
+        self.assertTrue(u'a' in bloom_filter and u'b' in bloom_filter)
+        self.assertRaises(ValueError, bloom_filter.merge, sketches.BloomFilter(512, 3))
+
+
+class TestSearchIndex(unittest.TestCase):
+    MESSAGES = [u'Pizza on Friday night?', u'friday is fine', u'NIGHT pizza friday', u'tacos, not pizza',
+                u'pizza friday night again', u'']
+
+    def setUp(self):
+        self.index_directory = tempfile.mkdtemp()
+        self.search_index = search.SearchIndex(self.index_directory, merge_factor=2)
+        # Posts arrive out of order and in small batches, so segments overlap and get merged
+        for seqs in ([3, 1], [2], [6, 4], [5]):
+            self.search_index.update([{'seq': seq, 'sender': str(seq % 2), 'message': self.MESSAGES[seq - 1],
+                                       'created_time': datetime.datetime(2015, 6, seq)} for seq in seqs])
+
+    def tearDown(self):
+        self.search_index.close()
+        shutil.rmtree(self.index_directory)
+
+    def test_varints_round_trip(self):
+        values = numpy.array([0, 1, 127, 128, 300, 2 ** 40], dtype=numpy.int64)
+        numpy.testing.assert_array_equal(values, search._decode_varints(search._encode_varints(values)))
+
+    def test_boolean_queries(self):
+        self.assertEqual(6, len(self.search_index))
+        self.assertEqual([5, 3, 1], self.search_index.search(u'pizza friday'))
+        self.assertEqual([5, 4, 3, 2, 1], self.search_index.search(u'pizza OR friday'))
+        self.assertEqual([6, 4, 2], self.search_index.search(u'-night'))
+        self.assertEqual([4], self.search_index.search(u'pizza -friday'))
+        self.assertEqual([], self.search_index.search(u'pizza burrito'))
+
+    def test_phrase_queries(self):
+        self.assertEqual([5, 1], self.search_index.search(u'"friday night"'))
+        self.assertEqual([5], self.search_index.search(u'"pizza friday night"'))
+        self.assertEqual([3], self.search_index.search(u'pizza -"friday night" night'))
+
+    def test_filters(self):
+        self.assertEqual([5, 3], self.search_index.search(u'pizza', sender='1', start=datetime.datetime(2015, 6, 2)))
+        self.assertEqual([3, 1], self.search_index.search(u'pizza', end=datetime.datetime(2015, 6, 4), limit=2))
+        self.assertEqual([], self.search_index.search(u'pizza', sender='2'))
+
+    def test_optimize(self):
+        self.search_index.optimize()
+        self.assertEqual(1, len(self.search_index._read_manifest()['segments']))
+        self.assertEqual([5, 1], self.search_index.search(u'"friday night"'))
+        self.assertEqual([5, 4, 3, 1], search.SearchIndex(self.index_directory).search(u'pizza'))
+
+    def test_levels_of_exact_powers(self):
+        search_index = search.SearchIndex(self.index_directory, merge_factor=10)
+        self.assertEqual([0, 0, 1, 1, 2, 2, 3, 3, 6],
+                         [search_index._level(posts) for posts in (0, 9, 10, 99, 100, 999, 1000, 9999, 10 ** 6)])
+
+    def test_posts_indexed_twice_are_found_once(self):
+        self.search_index.update([{'seq': 5, 'sender': '1', 'message': self.MESSAGES[4],
+                                   'created_time': datetime.datetime(2015, 6, 5)}])
+        self.assertEqual([5, 1], self.search_index.search(u'"friday night"'))
+        self.search_index.optimize()
+        self.assertEqual(6, len(self.search_index))
+        self.assertEqual([5, 1], self.search_index.search(u'"friday night"'))
+        self.assertEqual([5, 4, 3, 2, 1], self.search_index.search(u'pizza OR friday'))
+
+
+class TestVocabularySimilarity(unittest.TestCase):
+    def setUp(self):
+        self.similarity = similarity.VocabularySimilarity._from_pairs([
+            ('1', u'pizza', 5), ('1', u'the', 9), ('2', u'pizza', 2), ('2', u'the', 7), ('2', u'tacos', 1),
+            ('3', u'the', 3), ('3', u'chess', 4), ('1', u'pizza', 1)])
+
+    def test_counts(self):
+        self.assertEqual((3, 4), self.similarity.counts.shape)
+        self.assertEqual(6, self.similarity.counts[0, self.similarity.terms.index(u'pizza')])
+
+    def test_similarity(self):
+        scores = self.similarity.similarity()
+        numpy.testing.assert_allclose(numpy.ones(3), numpy.diag(scores))
+        numpy.testing.assert_allclose(scores, scores.T)
+        self.assertEqual(['2', '3'], [sender_id for sender_id, _ in self.similarity.most_similar('1')])
+        self.assertEqual([], self.similarity.most_similar('4'))
+        self.assertEqual(u'chess', self.similarity.distinctive_terms('3', k=1)[0][0])
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'similarity.npz')
+            self.similarity.save(path)
+            loaded = similarity.VocabularySimilarity.load(path)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(self.similarity.sender_ids, loaded.sender_ids)
+        self.assertEqual(self.similarity.terms, loaded.terms)
+        self.assertEqual(0, (self.similarity.counts != loaded.counts).nnz)
+        numpy.testing.assert_allclose(self.similarity.similarity(), loaded.similarity())
+
+
+class TestPostAnalytics(unittest.TestCase):
+    def setUp(self):
+        self.graph_posts = copy.deepcopy(data.START_999_JSON['comments']['data'])
+        self.graph_posts[0]['message'] = u'Lorem http://x.com/a?utm_source=feed and https://Y.org/b/'
+        self.post_analytics = analytics.PostAnalytics()
+        self.post_analytics.add_participants(data.START_999_JSON['to']['data'])
+        self.post_analytics.add_posts(self.graph_posts)
+
+    def test_any_post_shape_gives_the_same_results(self):
+        from_posts = analytics.PostAnalytics()
+        from_posts.add_posts([Post.from_graph(post) for post in self.graph_posts])
+        from_documents = analytics.PostAnalytics()
+        from_documents.add_posts([turkey_vulture.DatabaseHandler.post_transform(copy.deepcopy(post))
+                                  for post in self.graph_posts])
+        from_documents.sender_names = self.post_analytics.sender_names
+        for other in (from_posts, from_documents):
+            self.assertEqual(self.post_analytics.words_by_user(), other.words_by_user())
+            self.assertEqual(self.post_analytics.links(), other.links())
+            self.assertEqual(self.post_analytics.domains(), other.domains())
+        self.assertEqual(u'Lorem http://x.com/a?utm_source=feed and https://Y.org/b/', self.graph_posts[0]['message'])
+
+    def test_replayed_posts_are_counted_once(self):
+        words_by_user = self.post_analytics.words_by_user()
+        self.post_analytics.add_posts(copy.deepcopy(self.graph_posts[:10]))
+        self.assertEqual(25, self.post_analytics.posts)
+        self.assertEqual(words_by_user, self.post_analytics.words_by_user())
+
+    def test_words(self):
+        expected = collections.Counter()
+        for post in self.graph_posts:
+            expected.update(turkey_vulture.DatabaseHandler.tokenize(post.get('message', u'')))
+        self.assertEqual(sorted(expected.items()),
+                         sorted((document['_id']['word'], document['count'])
+                                for document in self.post_analytics.word_counts()))
+        self.assertEqual(expected.most_common(1)[0][1], self.post_analytics.top_words(limit=1)[0][1])
+        sender = self.graph_posts[0]['from']['id']
+        document = [document for document in self.post_analytics.words_by_user()
+                    if document['_id'] == {'sender': sender, 'word': u'lorem'}][0]
+        self.assertEqual(self.graph_posts[0]['from']['name'], document['name'])
+
+    def test_links(self):
+        links = self.post_analytics.links_in_range()
+        self.assertEqual([[u'http://x.com/a', u'https://y.org/b']], [document['links'] for document in links])
+        self.assertNotIn('message', links[0])
+        self.assertEqual([u'x.com', u'y.org'], sorted(domain['_id'] for domain in self.post_analytics.top_domains()))
+        self.assertEqual([], self.post_analytics.links_in_range(start=datetime.datetime(2030, 1, 1)))
+
+
+class TestSampledAnalytics(unittest.TestCase):
+    def setUp(self):
+        self.graph_posts = copy.deepcopy(data.START_999_JSON['comments']['data'])
+        self.graph_posts[0]['message'] = u'Lorem lorem http://x.com/a and http://x.com/b'
+        self.post_analytics = analytics.PostAnalytics()
+        self.post_analytics.add_posts(self.graph_posts)
+
+    def test_full_sample_is_exact(self):
+        sampled_analytics = analytics.SampledAnalytics(1.0)
+        sampled_analytics.add_posts(self.graph_posts)
+        for exact, estimated in ((self.post_analytics.words_by_user(), sampled_analytics.words_by_user()),
+                                 (self.post_analytics.word_counts(), sampled_analytics.word_counts()),
+                                 (self.post_analytics.domains(), sampled_analytics.domains())):
+            for document in estimated:
+                self.assertEqual(document['count'], document.pop('count_low'))
+                self.assertEqual(document['count'], document.pop('count_high'))
+            self.assertEqual(exact, estimated)
+        self.assertEqual(self.post_analytics.top_words(), sampled_analytics.top_words())
+
+    def test_estimates_are_scaled(self):
+        sampled_analytics = analytics.SampledAnalytics(0.25, confidence=0.9)
+        sampled_analytics.add_posts(self.graph_posts + self.graph_posts[:3])
+        self.assertEqual(len(self.graph_posts), sampled_analytics.posts)
+        domain = sampled_analytics.domains()[0]
+        # Both links of the first post are on x.com, so its squared count is 4 and the variance is 0.75 * 4 / 0.25^2
+        half_width = scipy.stats.norm.ppf(0.95) * math.sqrt(0.75 * 4) / 0.25
+        self.assertEqual((u'x.com', 8, int(math.ceil(8 + half_width))),
+                         (domain['_id'], domain['count'], domain['count_high']))
+        self.assertEqual(2, domain['count_low'])
+        sender = self.graph_posts[0]['from']['id']
+        exact_counts = dict(self.post_analytics.top_words(sender, limit=None))
+        for word, count in sampled_analytics.top_words(sender, limit=None):
+            self.assertEqual(4 * exact_counts[word], count)
+        for document in sampled_analytics.word_counts():
+            self.assertTrue(document['count_low'] <= document['count'] <= document['count_high'])
+
+    def test_fraction_is_checked(self):
+        self.assertRaises(ValueError, analytics.SampledAnalytics, 0)
+        self.assertRaises(ValueError, analytics.SampledAnalytics, 1.5)
+
+    def test_estimates_are_not_saved(self):
+        self.assertRaises(NotImplementedError, analytics.SampledAnalytics(0.5).save, MockDatabaseHandler())
+
+
+# Tests that need a database run against the mongod in TURKEY_VULTURE_TEST_MONGO_URL, such as mongodb://localhost:27017
+TEST_MONGO_URL = os.environ.get('TURKEY_VULTURE_TEST_MONGO_URL')
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.queue = jobs.JobQueue(self.database_handler, collection_name='test_jobs', max_attempts=2)
+        self.database_handler._db()['test_jobs'].drop()
+
+    def tearDown(self):
+        self.database_handler._db()['test_jobs'].drop()
+        self.database_handler.close()
+
+    def test_enqueue_is_idempotent(self):
+        self.assertEqual(self.queue.enqueue(jobs.UPDATE_JOB, '999'), self.queue.enqueue(jobs.UPDATE_JOB, '999'))
+        self.assertEqual({jobs.PENDING: 1}, self.queue.counts())
+
+    def test_claim_is_exclusive(self):
+        self.queue.enqueue(jobs.UPDATE_JOB, '999')
+        job = self.queue.claim('worker-1')
+        self.assertEqual('worker-1', job['lease_owner'])
+        self.assertIsNone(self.queue.claim('worker-2'))
+
+    def test_expired_lease_is_claimed_again(self):
+        self.queue.enqueue(jobs.UPDATE_JOB, '999')
+        stale_job = self.queue.claim('worker-1', lease_seconds=-1)
+        job = self.queue.claim('worker-2')
+        self.assertEqual('worker-2', job['lease_owner'])
+        self.assertFalse(self.queue.heartbeat(stale_job))
+        self.assertRaises(jobs.LeaseLostError, self.queue.complete, stale_job)
+        self.queue.complete(job)
+        self.assertEqual({jobs.DONE: 1}, self.queue.counts())
+
+    def test_failed_job_is_retried_until_attempts_run_out(self):
+        self.queue.enqueue(jobs.UPDATE_JOB, '999')
+        self.queue.fail(self.queue.claim('worker-1'), 'error')
+        self.queue.fail(self.queue.claim('worker-1'), 'error')
+        self.assertIsNone(self.queue.claim('worker-1'))
+        self.assertEqual({jobs.FAILED: 1}, self.queue.counts())
+
+    def test_worker_runs_job(self):
+        job_ids = jobs.enqueue_backfill(self.queue, '999', datetime.datetime(2010, 1, 1), datetime.datetime(2010, 1, 15))
+        worker = jobs.Worker(self.queue, {jobs.BACKFILL_JOB: lambda job: job['payload']['since'].day})
+        self.assertEqual(job_ids[0], worker.run_one()['_id'])
+        self.assertEqual(job_ids[1], worker.run_one()['_id'])
+        self.assertIsNone(worker.run_one())
+        self.assertEqual({jobs.DONE: 2}, self.queue.counts())
+
+    def test_expired_last_attempt_is_failed(self):
+        self.queue.enqueue(jobs.UPDATE_JOB, '999')
+        self.queue.fail(self.queue.claim('worker-1'), 'error')
+        self.queue.claim('worker-1', lease_seconds=-1)
+        self.assertIsNone(self.queue.claim('worker-2'))
+        self.assertEqual({jobs.FAILED: 1}, self.queue.counts())
+
+    def test_worker_survives_a_lost_lease(self):
+        self.queue.enqueue(jobs.UPDATE_JOB, '999')
+
+        def slow_handler(job):
+            # Another worker takes the job over while this one is still working on it
+            self.queue._collection.update_one({'_id': job['_id']}, {'$set': {'lease_owner': 'worker-2'}})
+        worker = jobs.Worker(self.queue, {jobs.UPDATE_JOB: slow_handler})
+        self.assertIsNotNone(worker.run_one())
+        self.assertEqual({jobs.RUNNING: 1}, self.queue.counts())
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestAggregationRunner(unittest.TestCase):
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.add_posts(copy.deepcopy(data.START_999_JSON['comments']['data']))
+        self.calls = []
+
+        def failing_job(database_handler):
+            raise ValueError('failed')
+
+        self.runner = pipeline.AggregationRunner(self.database_handler, [
+            pipeline.AggregationJob('first', [pipeline.POSTS_INPUT], lambda handler: self.calls.append('first')),
+            pipeline.AggregationJob('second', [pipeline.POSTS_INPUT], lambda handler: self.calls.append('second')),
+            pipeline.AggregationJob('joined', ['first', 'second'], lambda handler: self.calls.append('joined')),
+            pipeline.AggregationJob('failing', [pipeline.POSTS_INPUT], failing_job),
+            pipeline.AggregationJob('after_failing', ['failing'], lambda handler: self.calls.append('after_failing')),
+        ])
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def statuses(self):
+        return dict((report['name'], report['status']) for report in self.runner.run())
+
+    def test_run(self):
+        self.assertDictEqual({'first': pipeline.RAN, 'second': pipeline.RAN, 'joined': pipeline.RAN,
+                              'failing': pipeline.FAILED, 'after_failing': pipeline.BLOCKED}, self.statuses())
+        self.assertEqual('joined', self.calls[-1])
+
+    def test_skip_if_unchanged(self):
+        self.runner.run()
+        self.assertEqual(pipeline.SKIPPED, self.statuses()['joined'])
+        self.database_handler.add_posts(copy.deepcopy(data.UNTIL_12_999_JSON['comments']['data']))
+        self.assertEqual(pipeline.RAN, self.statuses()['joined'])
+
+    def test_unknown_input(self):
+        self.assertRaises(ValueError, pipeline.AggregationRunner, self.database_handler,
+                          [pipeline.AggregationJob('orphan', ['missing'], lambda handler: None)])
+
+    def test_failed_state_write_is_reported(self):
+        def fail_write(*args, **kwargs):
+            raise pymongo.errors.AutoReconnect('connection lost')
+        self.runner._state_collection = MockStateCollection(self.runner._state_collection, fail_write)
+        statuses = self.statuses()
+        self.assertEqual(pipeline.FAILED, statuses['first'])
+        self.assertEqual(pipeline.BLOCKED, statuses['joined'])
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestActivityRollups(unittest.TestCase):
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.add_ingest_hook(self.database_handler.update_activity_rollups)
+        self.database_handler.add_posts(copy.deepcopy(data.START_999_JSON['comments']['data']))
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def test_duplicates_are_not_counted(self):
+        self.database_handler.add_posts(copy.deepcopy(data.START_999_JSON['comments']['data']), ignore_duplicates=True)
+        self.assertEqual([(datetime.datetime(2010, 1, 23), 24), (datetime.datetime(2015, 6, 12), 1)],
+                         self.database_handler.activity('day'))
+
+    def test_rebuild_matches_incremental(self):
+        incremental = self.database_handler.activity('hour')
+        heatmap = self.database_handler.activity_heatmap()
+        self.database_handler.rebuild_activity_rollups(batch_size=7)
+        self.assertEqual(incremental, self.database_handler.activity('hour'))
+        self.assertEqual(heatmap, self.database_handler.activity_heatmap())
+        self.assertEqual(24, heatmap[5][14])
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestReplyLatency(unittest.TestCase):
+    # Each tuple is the sender and the minute the post is created at
+    POSTS = [('1', 0), ('2', 1), ('2', 2), ('1', 5), ('2', 7), ('1', 600), ('2', 610)]
+
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        start = datetime.datetime(2015, 6, 1)
+        self.posts = [{'id': '999_{0}'.format(seq + 1), 'from': {'id': sender, 'name': 'User ' + sender},
+                       'created_time': turkey_vulture.format_graph_time(start + datetime.timedelta(minutes=minute))}
+                      for seq, (sender, minute) in enumerate(self.POSTS)]
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def test_latencies(self):
+        self.database_handler.add_posts(self.posts)
+        self.assertEqual(7, latency.update_reply_latency(self.database_handler, max_reply_seconds=3600))
+        users = dict((stats['sender'], stats) for stats in latency.reply_latency(self.database_handler))
+        self.assertEqual((4, 3, 3), (users['2']['posts'], users['2']['turns'], users['2']['replies']))
+        self.assertEqual((3, 3, 1), (users['1']['posts'], users['1']['turns'], users['1']['replies']))
+        pair = latency.pair_latency(self.database_handler, from_sender='1', to_sender='2')[0]
+        self.assertEqual(3, pair['replies'])
+        self.assertAlmostEqual(120, pair['p50'], delta=1.2)
+
+    def test_interaction_graph(self):
+        self.database_handler.add_posts(self.posts)
+        graph = interactions.InteractionGraph.build(self.database_handler, window_seconds=5 * 60)
+        self.assertEqual(['1', '2'], graph.sender_ids)
+        self.assertEqual([[0, 3], [2, 0]], graph.transitions.tolist())
+        self.assertEqual([[0, 3], [2, 0]], graph.co_activity.tolist())
+
+    def test_continuation_matches_single_pass(self):
+        self.database_handler.add_posts(self.posts[:3])
+        latency.update_reply_latency(self.database_handler)
+        self.database_handler.add_posts(self.posts[3:])
+        self.assertEqual(4, latency.update_reply_latency(self.database_handler))
+        continued = sorted(latency.pair_latency(self.database_handler))
+        self.assertEqual(7, latency.update_reply_latency(self.database_handler, rebuild=True))
+        self.assertEqual(continued, sorted(latency.pair_latency(self.database_handler)))
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestSessions(unittest.TestCase):
+    # Each tuple is the sender and the minute the post is created at
+    POSTS = [('1', 0), ('2', 1), ('2', 20), ('1', 45), ('2', 50), ('1', 600), ('2', 610)]
+
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        start = datetime.datetime(2015, 6, 1)
+        self.posts = [{'id': '999_{0}'.format(seq + 1), 'from': {'id': sender, 'name': 'User ' + sender},
+                       'created_time': turkey_vulture.format_graph_time(start + datetime.timedelta(minutes=minute)),
+                       'message': 'see http://example.com/{0}'.format(seq + 1)}
+                      for seq, (sender, minute) in enumerate(self.POSTS)]
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def test_sessions(self):
+        self.database_handler.add_posts(self.posts)
+        self.assertEqual(7, sessions.update_sessions(self.database_handler, gap_seconds=30 * 60))
+        summaries = sessions.sessions_in_range(self.database_handler)
+        self.assertEqual([(0, 5, 1, 5), (1, 2, 6, 7)],
+                         [(summary['_id'], summary['posts'], summary['first_seq'], summary['last_seq'])
+                          for summary in summaries])
+        self.assertEqual(['1', '2'], summaries[1]['participants'])
+        self.assertEqual(['http://example.com/6', 'http://example.com/7'], summaries[1]['links'])
+        self.assertEqual([6, 7], [post['seq'] for post in sessions.session_posts(self.database_handler, 1)])
+        self.assertEqual([summaries[1]], sessions.sessions_in_range(self.database_handler,
+                                                                    start=datetime.datetime(2015, 6, 1, 9)))
+
+    def test_continuation_extends_last_session(self):
+        self.database_handler.add_posts(self.posts[:4])
+        sessions.update_sessions(self.database_handler)
+        self.database_handler.add_posts(self.posts[4:])
+        self.assertEqual(3, sessions.update_sessions(self.database_handler))
+        continued = sessions.sessions_in_range(self.database_handler)
+        self.assertEqual(7, sessions.update_sessions(self.database_handler, rebuild=True))
+        self.assertEqual(continued, sessions.sessions_in_range(self.database_handler))
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestWordSketches(unittest.TestCase):
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.word_sketches = words.WordSketches(self.database_handler, capacity=200)
+        self.database_handler.add_ingest_hook(self.word_sketches.update)
+        self.database_handler.add_posts(copy.deepcopy(data.START_999_JSON['comments']['data']))
+        self.database_handler.add_posts(copy.deepcopy(data.UNTIL_12_999_JSON['comments']['data']))
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def exact_counts(self, query=None):
+        counts = {}
+        for post in self.database_handler._posts_collection().find(query or {}):
+            for word in turkey_vulture.DatabaseHandler.tokenize(post.get('message', '')):
+                counts[word] = counts.get(word, 0) + 1
+        return counts
+
+    def test_top_words_match_exact_counts(self):
+        exact_counts = self.exact_counts()
+        for word, count in self.word_sketches.top_words(limit=5):
+            self.assertEqual(exact_counts[word], count)
+        self.assertEqual(max(exact_counts.values()), self.word_sketches.top_words(limit=1)[0][1])
+
+    def test_sender_and_month_partitions(self):
+        exact_counts = self.exact_counts({'sender': '8', 'created_time': {'$lt': datetime.datetime(2010, 2, 1)}})
+        top_words = self.word_sketches.top_words(sender='8', end=datetime.datetime(2010, 2, 1))
+        self.assertEqual(sorted(exact_counts.values(), reverse=True)[:10], [count for _, count in top_words])
+        self.assertEqual(exact_counts['lorem'], self.word_sketches.word_count('Lorem', sender='8',
+                                                                             end=datetime.datetime(2010, 2, 1)))
+
+    def test_rebuild_matches_incremental(self):
+        incremental = self.word_sketches.top_words(limit=20)
+        self.word_sketches.rebuild(batch_size=7)
+        self.assertEqual(incremental, self.word_sketches.top_words(limit=20))
+
+    def test_concurrent_update_is_retried(self):
+        posts = list(self.database_handler._posts_collection().find({'sender': '8', 'message': {'$exists': True}})
+                     .sort('seq', pymongo.ASCENDING).limit(3))
+        word = turkey_vulture.DatabaseHandler.tokenize(posts[0]['message'])[0]
+        batch_count = sum(turkey_vulture.DatabaseHandler.tokenize(post['message']).count(word) for post in posts)
+        expected = self.word_sketches.word_count(word) + 2 * batch_count
+
+        other_worker = words.WordSketches(self.database_handler, capacity=200)
+        collection = self.word_sketches._collection
+        replace_one = collection.replace_one
+
+        def racing_replace_one(*args, **kwargs):
+            collection.replace_one = replace_one
+            other_worker.update(copy.deepcopy(posts))
+            return replace_one(*args, **kwargs)
+
+        collection.replace_one = racing_replace_one
+        self.word_sketches.update(posts)
+        self.assertEqual(expected, self.word_sketches.word_count(word))
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestDistinctCounters(unittest.TestCase):
+    # Each tuple is the sender, the day in June 2015 the post is created on and its message
+    POSTS = [('1', 1, 'lorem ipsum http://example.com/a'), ('2', 1, 'lorem dolor example.com/b'),
+             ('1', 20, 'sit amet http://example.com/a'), ('2', 30, 'Lorem http://example.com/c')]
+
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.counters = cardinality.DistinctCounters(self.database_handler)
+        self.database_handler.add_ingest_hook(self.counters.update)
+        posts = [{'id': '999_{0}'.format(seq + 1), 'from': {'id': sender, 'name': 'User ' + sender},
+                  'created_time': turkey_vulture.format_graph_time(datetime.datetime(2015, 6, day)), 'message': message}
+                 for seq, (sender, day, message) in enumerate(self.POSTS)]
+        posts.append({'id': '999_5', 'from': {'id': '1', 'name': 'User 1'}, 'message': 'consectetur example.com/d',
+                      'created_time': turkey_vulture.format_graph_time(datetime.datetime(2015, 7, 1))})
+        self.database_handler.add_posts(posts)
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def test_distinct_counts(self):
+        self.assertEqual(13, self.counters.distinct_words())
+        self.assertEqual(10, self.counters.distinct_words(sender='1'))
+        self.assertEqual(4, self.counters.distinct_links())
+        self.assertEqual(3, self.counters.distinct_links(end=datetime.datetime(2015, 7, 1)))
+        self.assertEqual(2, self.counters.distinct_links(sender='1'))
+        self.assertEqual([('2015-06', 3), ('2015-07', 1)], self.counters.distinct_links_by_month())
+
+    def test_rebuild_matches_incremental(self):
+        self.counters.rebuild(batch_size=2)
+        self.assertEqual(13, self.counters.distinct_words())
+        self.assertEqual([('2015-06', 1), ('2015-07', 1)], self.counters.distinct_links_by_month(sender='1'))
+
+    def test_concurrent_update_is_retried(self):
+        posts = [{'_id': '999_6', 'seq': 6, 'sender': '1', 'created_time': datetime.datetime(2015, 6, 2),
+                  'message': 'adipiscing http://example.com/e'}]
+        racing_posts = [{'_id': '999_7', 'seq': 7, 'sender': '1', 'created_time': datetime.datetime(2015, 6, 3),
+                         'message': 'elit http://example.com/f'}]
+        other_worker = cardinality.DistinctCounters(self.database_handler)
+        collection = self.counters._collection
+        replace_one = collection.replace_one
+
+        def racing_replace_one(*args, **kwargs):
+            collection.replace_one = replace_one
+            other_worker.update(racing_posts)
+            return replace_one(*args, **kwargs)
+
+        collection.replace_one = racing_replace_one
+        self.counters.update(posts)
+        self.assertEqual(17, self.counters.distinct_words())
+        self.assertEqual(6, self.counters.distinct_links())
+        self.assertEqual(3, self.counters.distinct_links(sender='1', end=datetime.datetime(2015, 7, 1)))
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestDomainRollups(unittest.TestCase):
+    MESSAGES = ['see http://x.com/a', 'same as x.com/a/ and https://y.org', 'lorem ipsum', 'X.com/b?utm_source=feed']
+
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.posts = [{'id': '999_{0}'.format(seq + 1), 'from': {'id': '1', 'name': 'User 1'}, 'message': message,
+                       'created_time': turkey_vulture.format_graph_time(datetime.datetime(2015, 6, seq + 1))}
+                      for seq, message in enumerate(self.MESSAGES)]
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def test_incremental_rollups(self):
+        self.database_handler.add_ingest_hook(self.database_handler.update_domain_rollups)
+        self.database_handler.add_posts(self.posts[:2])
+        self.database_handler.add_posts(self.posts[2:])
+        top_domains = self.database_handler.top_domains()
+        self.assertEqual([(u'x.com', 3), (u'y.org', 1)], [(domain['_id'], domain['count']) for domain in top_domains])
+        self.assertEqual((datetime.datetime(2015, 6, 1), datetime.datetime(2015, 6, 4)),
+                         (top_domains[0]['first_seen'], top_domains[0]['last_seen']))
+        self.assertEqual([u'y.org'], [domain['_id'] for domain in self.database_handler.domains_first_seen(
+            start=datetime.datetime(2015, 6, 2))])
+
+    def test_canonical_links(self):
+        self.database_handler.add_posts(self.posts)
+        self.assertEqual([[u'http://x.com/a'], [u'http://x.com/a', u'https://y.org'], [], [u'http://x.com/b']],
+                         [turkey_vulture.DatabaseHandler.find_links(message) for message in self.MESSAGES])
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestRepostIndex(unittest.TestCase):
+    # Each tuple is the day in June 2015 the post is created on, its sender and its message, in the order they are added
+    POSTS = [(3, '2', 'see http://x.com/a'), (4, '1', 'same as x.com/a/ and https://y.org'), (5, '3', 'lorem ipsum'),
+             (1, '1', 'X.com/a?utm_source=feed first')]
+
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.repost_index = reposts.RepostIndex(self.database_handler, expected_links=1000)
+        self.database_handler.add_ingest_hook(self.repost_index.update)
+        for day, sender, message in self.POSTS:
+            self.database_handler.add_posts([{
+                'id': '999_{0}'.format(day), 'from': {'id': sender, 'name': 'User ' + sender}, 'message': message,
+                'created_time': turkey_vulture.format_graph_time(datetime.datetime(2015, 6, day))}])
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def test_first_share_is_the_earliest(self):
+        first_share = self.repost_index.first_share(u'HTTP://x.com/a/')
+        self.assertEqual(('999_1', '1', datetime.datetime(2015, 6, 1), 2),
+                         (first_share['post_id'], first_share['sender'], first_share['created_time'],
+                          first_share['repeats']))
+        self.assertEqual(datetime.datetime(2015, 6, 4), first_share['last_seen'])
+
+    def test_unseen_links_skip_the_database(self):
+        self.assertIsNone(self.repost_index.first_share(u'never.example.com'))
+        self.assertEqual(1, self.repost_index.lookups_skipped)
+
+    def test_reposts_in(self):
+        post = self.database_handler._posts_collection().find_one({'_id': '999_4'})
+        self.assertEqual([u'http://x.com/a'], [url for url, _ in self.repost_index.reposts_in(post)])
+        self.repost_index.rebuild()
+        self.assertEqual(0, self.repost_index.first_share(u'https://y.org')['repeats'])
+
+    def test_links_stored_elsewhere_are_found_once_the_filter_is_stale(self):
+        now = [0.0]
+        query_index = reposts.RepostIndex(self.database_handler, expected_links=1000, filter_seconds=60,
+                                          clock=lambda: now[0])
+        self.assertIsNone(query_index.first_share(u'z.net'))
+        self.database_handler.add_posts([{
+            'id': '999_10', 'from': {'id': '2', 'name': 'User 2'}, 'message': 'look at z.net',
+            'created_time': turkey_vulture.format_graph_time(datetime.datetime(2015, 6, 10))}])
+        now[0] = 30.0
+        self.assertIsNone(query_index.first_share(u'z.net'))
+        now[0] = 60.0
+        queries = []
+        find = query_index._collection.find
+
+        def recording_find(query, *args, **kwargs):
+            queries.append(query)
+            return find(query, *args, **kwargs)
+        query_index._collection.find = recording_find
+        self.assertEqual('999_10', query_index.first_share(u'z.net')['post_id'])
+        self.assertEqual(2, query_index.lookups_skipped)
+        self.assertEqual([['stored_at'], ['_id']], [list(query) for query in queries])
+        self.assertNotIn('stored_at', query_index.first_share(u'z.net'))
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestVocabularySimilarityWindows(unittest.TestCase):
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.add_posts(copy.deepcopy(data.START_999_JSON['comments']['data']))
+        self.result_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.result_directory)
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def test_build(self):
+        result = similarity.VocabularySimilarity.build(self.database_handler)
+        self.assertEqual(25, result.posts)
+        self.assertEqual(6, len(result.sender_ids))
+        words_by_user = self.database_handler._db()[self.database_handler._posts_collection_name + '_words_by_user']
+        words_by_user.insert_many([{'_id': {'sender': sender_id, 'word': result.terms[term]},
+                                    'count': int(result.counts[row, term])}
+                                   for row, sender_id in enumerate(result.sender_ids)
+                                   for term in result.counts.getrow(row).indices])
+        from_collection = similarity.VocabularySimilarity.from_words_by_user(self.database_handler)
+        self.assertEqual(result.counts.sum(), from_collection.counts.sum())
+        first, second = [from_collection.sender_ids.index(sender_id) for sender_id in result.sender_ids[:2]]
+        self.assertAlmostEqual(result.similarity()[0, 1], from_collection.similarity()[first, second])
+
+    def test_windows_are_cached(self):
+        windows = similarity.VocabularySimilarity.windows(self.database_handler, self.result_directory,
+                                                          datetime.timedelta(days=365))
+        self.assertEqual([24, 0, 0, 0, 0, 1], [result.posts for _, result in windows])
+        window_start = windows[0][0]
+        cached = similarity.VocabularySimilarity.cached(self.database_handler, self.result_directory, window_start,
+                                                        window_start + datetime.timedelta(days=365))
+        numpy.testing.assert_allclose(windows[0][1].similarity(), cached.similarity())
+        self.database_handler.add_posts([{'id': '999_100', 'from': {'id': '1', 'name': 'User 1'}, 'message': u'new',
+                                          'created_time': turkey_vulture.format_graph_time(window_start)}])
+        cached = similarity.VocabularySimilarity.cached(self.database_handler, self.result_directory, window_start,
+                                                        window_start + datetime.timedelta(days=365))
+        self.assertEqual(25, cached.posts)
+        self.assertIn(u'new', cached.terms)
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestTrendingTerms(unittest.TestCase):
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.trending_terms = trending.TrendingTerms(self.database_handler, ring_buckets=4)
+        self.database_handler.add_ingest_hook(self.trending_terms.update)
+        # Ten hours of small talk and then an hour about the game, added newest first like a backfill would
+        posts = [(hour, u'the lunch was fine') for hour in range(10)] + [(10, u'the game the game what a game')]
+        for seq, (hour, message) in reversed(list(enumerate(posts, 1))):
+            self.database_handler.add_posts([{
+                'id': '999_{0}'.format(seq), 'from': {'id': '1', 'name': 'User 1'}, 'message': message,
+                'created_time': turkey_vulture.format_graph_time(datetime.datetime(2015, 6, 1, hour))}])
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def _ring(self):
+        return sorted((document['_id']['bucket'], document['_id']['term'], document['count'])
+                      for document in self.trending_terms._buckets.find())
+
+    def test_trending(self):
+        self.assertEqual([(u'game', 3)], [(term, count) for term, count, _ in
+                                          self.trending_terms.trending(recent_buckets=1, min_count=3)])
+        self.assertEqual([], self.trending_terms.trending(recent_buckets=1, min_count=4))
+        self.assertEqual([], self.trending_terms.trending(now=datetime.datetime(2015, 6, 1, 5), min_count=1))
+
+    def test_ring_keeps_the_newest_buckets(self):
+        ring = self._ring()
+        self.assertEqual(4, len(set(bucket for bucket, _, _ in ring)))
+        baseline = self.trending_terms._baseline.find_one({'_id': u'the'})
+        self.assertEqual(12, baseline['count'])
+        self.trending_terms.rebuild(batch_size=3)
+        self.assertEqual(ring, self._ring())
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestPostAnalyticsMatchesAggregations(unittest.TestCase):
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.post_analytics = analytics.PostAnalytics()
+        self.database_handler.add_ingest_hook(self.post_analytics.add_posts)
+        self.database_handler.set_participants(data.START_999_JSON['to']['data'])
+        self.post_analytics.add_participants(data.START_999_JSON['to']['data'])
+        posts = copy.deepcopy(data.START_999_JSON['comments']['data'])
+        posts[3]['message'] = u'see x.com/a and http://y.org'
+        self.database_handler.add_posts(posts)
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def _collection(self, suffix, sort):
+        return list(self.database_handler._db()[self.database_handler._posts_collection_name + suffix].find(
+            sort=sort))
+
+    def test_same_documents(self):
+        self.database_handler.posts_by_user_aggregation()
+        self.database_handler.posts_links_aggregation()
+        words_key = lambda document: (document['_id']['sender'], document['_id']['word'])
+        self.assertEqual(sorted(self._collection('_words_by_user', None), key=words_key),
+                         sorted(self.post_analytics.words_by_user(), key=words_key))
+        self.assertEqual(sorted(self._collection('_word_counts', None), key=lambda document: document['_id']['word']),
+                         sorted(self.post_analytics.word_counts(), key=lambda document: document['_id']['word']))
+        self.assertEqual(self._collection('_links', [('created_time', 1)]), self.post_analytics.links())
+        self.assertEqual(self._collection('_domains', [('_id', 1)]),
+                         sorted(self.post_analytics.domains(), key=lambda domain: domain['_id']))
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestScanPosts(unittest.TestCase):
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.add_posts(copy.deepcopy(data.START_999_JSON['comments']['data']))
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def test_strict_projection(self):
+        posts = list(self.database_handler.scan_posts(('sender', 'created_time')))
+        self.assertEqual(len(data.START_999_JSON['comments']['data']), len(posts))
+        self.assertEqual([set(['sender', 'created_time'])], list(set(frozenset(post.keys()) for post in posts)))
+        self.assertEqual(set(['_id', 'message']),
+                         set(next(iter(self.database_handler.scan_posts(('_id', 'message')))).keys()))
+
+    def test_raw_documents_read_the_same(self):
+        fields = ('_id', 'sender', 'created_time', 'message')
+        sort = [('_id', 1)]
+        self.assertEqual(list(self.database_handler.scan_posts(fields, sort=sort)),
+                         [dict(post) for post in self.database_handler.scan_posts(fields, sort=sort, raw=True)])
+
+    def test_export_leaves_out_derived_fields(self):
+        posts = list(self.database_handler.iter_posts(projection=transfer.EXPORT_PROJECTION))
+        self.assertEqual(sorted(post['seq'] for post in posts), [post['seq'] for post in posts])
+        self.assertFalse(any('seq' in post or 'session' in post
+                             for post in map(turkey_vulture.DatabaseHandler.post_untransform, posts)))
+        self.assertEqual([posts[-1]['seq']], [post['seq'] for post in self.database_handler.iter_posts(
+            after_seq=posts[-2]['seq'])])
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestSampledScans(unittest.TestCase):
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.set_participants(data.START_999_JSON['to']['data'])
+        self.database_handler.add_posts(copy.deepcopy(data.START_999_JSON['comments']['data']))
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def test_partitions_split_the_thread(self):
+        partitions = [analytics.SampledAnalytics.build(self.database_handler, 0.3, method='partition',
+                                                       partition=partition) for partition in range(3)]
+        self.assertEqual([1.0 / 3] * 3, [partition.fraction for partition in partitions])
+        self.assertEqual(len(data.START_999_JSON['comments']['data']),
+                         sum(partition.posts for partition in partitions))
+        self.assertEqual(partitions[1].words_by_user(), analytics.SampledAnalytics.build(
+            self.database_handler, 0.3, method='partition', partition=1).words_by_user())
+
+    def test_unknown_method(self):
+        self.assertRaises(ValueError, analytics.SampledAnalytics.build, self.database_handler, 0.5, method='every')
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestRecordSenders(unittest.TestCase):
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.posts = copy.deepcopy(data.START_999_JSON['comments']['data'][:2])
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def test_nameless_senders(self):
+        for post in self.posts:
+            del post['from']['name']
+        self.database_handler.add_posts(copy.deepcopy(self.posts))
+        self.assertEqual(2, self.database_handler._posts_collection().count())
+        self.assertEqual({}, self.database_handler.sender_names)
+
+    def test_names_are_recorded(self):
+        self.database_handler.add_posts(copy.deepcopy(self.posts))
+        sender = self.posts[0]['from']
+        self.assertEqual(sender['name'], self.database_handler.sender_names[sender['id']])
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestGapRepair(unittest.TestCase):
+    MISSING = ('999_5', '999_6', '999_7')
+
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        posts = copy.deepcopy(data.UNTIL_12_999_JSON['comments']['data'] + data.START_999_JSON['comments']['data'])
+        for post in posts:
+            # Every other post of the test data is created in this second, so the only anomaly left is the hole
+            post['created_time'] = '2010-01-23T14:00:00+0000'
+        self.database_handler.add_posts([post for post in posts if post['id'] not in self.MISSING])
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def test_find_gaps(self):
+        gaps = self.database_handler.find_gaps()
+        self.assertEqual([('missing', 3, 4, 8)],
+                         [(gap['kind'], gap['missing'], gap['after_seq'], gap['before_seq']) for gap in gaps])
+        self.database_handler._posts_collection().update_one(
+            {'_id': '999_20'}, {'$set': {'created_time': datetime.datetime(2010, 1, 23, 16, 0)}})
+        kinds = [(gap['kind'], gap['after_seq']) for gap in
+                 self.database_handler.find_gaps(max_time_jump=datetime.timedelta(hours=1))]
+        self.assertEqual([('missing', 4), ('time_jump', 19), ('out_of_order', 20)], kinds)
+
+    def test_add_sequence_ids(self):
+        self.database_handler._posts_collection().update_many({}, {'$unset': {'seq': ''}})
+        self.assertEqual([], self.database_handler.find_gaps())
+        self.database_handler.add_sequence_ids(batch_size=10)
+        self.assertEqual(0, self.database_handler._posts_collection().find({'seq': {'$exists': False}}).count())
+        self.assertEqual(36, self.database_handler._posts_collection().find_one({'_id': '999_36'})['seq'])
+        self.assertEqual(1, len(self.database_handler.find_gaps()))
+
+    def test_repair_fills_the_hole(self):
+        graph = MockGraphAPI()
+        window_time = datetime.datetime(2010, 1, 23, 14, 0)
+        graph._thread_order['999'][calendar.timegm(window_time.utctimetuple()) + 1] = data.START_999_JSON
+        thread = turkey_vulture.FacebookThread(graph, '999', '36')
+        repair.repair_gaps(thread, self.database_handler, self.database_handler.find_gaps())
+        self.assertEqual([], self.database_handler.find_gaps())
+        self.assertEqual(36, self.database_handler._posts_collection().count())
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestIngestHookRecovery(unittest.TestCase):
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.seen = {'counted': [], 'flaky': []}
+        self.failures = [ValueError('hook failed')]
+
+        def flaky(post_list):
+            if self.failures:
+                raise self.failures.pop()
+            self.seen['flaky'].extend(post['_id'] for post in post_list)
+        self.database_handler.add_ingest_hook(lambda post_list: self.seen['counted'].extend(
+            post['_id'] for post in post_list), name='counted')
+        self.database_handler.add_ingest_hook(flaky)
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+
+    def posts(self):
+        return copy.deepcopy(data.START_999_JSON['comments']['data'])
+
+    def test_replay_catches_up_failed_hooks(self):
+        self.assertRaises(ValueError, self.database_handler.add_posts, self.posts())
+        self.assertEqual(25, self.database_handler.posts_pending_hooks())
+        self.assertEqual(25, len(self.seen['counted']))
+        self.database_handler.add_posts(self.posts(), ignore_duplicates=True)
+        self.assertEqual(25, len(self.seen['counted']))
+        self.assertEqual(sorted(self.seen['counted']), sorted(self.seen['flaky']))
+        self.assertEqual(0, self.database_handler.posts_pending_hooks())
+        self.database_handler.add_posts(self.posts(), ignore_duplicates=True)
+        self.assertEqual(25, len(self.seen['flaky']))
+
+    def test_hooks_see_clean_documents(self):
+        self.failures = []
+        self.database_handler.add_posts(self.posts())
+        self.assertEqual(0, self.database_handler.posts_pending_hooks())
+        self.assertNotIn('hooks_pending', self.database_handler._posts_collection().find_one())
+
+    def test_hook_names_are_unique(self):
+        self.assertRaises(ValueError, self.database_handler.add_ingest_hook, lambda post_list: None, 'counted')
+
+
+@unittest.skipUnless(TEST_MONGO_URL, 'TURKEY_VULTURE_TEST_MONGO_URL is not set')
+class TestDefaultHooks(unittest.TestCase):
+    def setUp(self):
+        self.database_handler = turkey_vulture.DatabaseHandler(TEST_MONGO_URL, 'turkey_vulture_test', thread_id='999')
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.search_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.database_handler._db().client.drop_database('turkey_vulture_test')
+        self.database_handler.close()
+        shutil.rmtree(self.search_directory)
+
+    def test_posts_reach_every_hook(self):
+        hooks.register_default_hooks(self.database_handler, self.search_directory)
+        self.assertEqual(['DatabaseHandler.update_activity_rollups', 'DatabaseHandler.update_domain_rollups',
+                          'WordSketches.update', 'DistinctCounters.update', 'RepostIndex.update', 'SearchIndex.update',
+                          'TrendingTerms.update'],
+                         [name for name, _ in self.database_handler._ingest_hooks])
+        self.database_handler.add_posts(copy.deepcopy(data.START_999_JSON['comments']['data']))
+        self.assertEqual(self.database_handler._posts_collection().count(),
+                         len(search.SearchIndex(self.search_directory)))
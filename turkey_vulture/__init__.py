@@ -7,9 +7,26 @@ __all__ = ['pull_thread_messages']
 
 import pymongo
 import urlparse
-from datetime import datetime
 import re
 import bson
+import calendar
+from bson.codec_options import CodecOptions
+from collections import Counter
+from datetime import datetime, timedelta
+from turkey_vulture.models import Post, Participant, parse_graph_time, format_graph_time
+from turkey_vulture.links import canonicalize_url, url_domain
+
+try:
+    from bson.raw_bson import RawBSONDocument
+except ImportError:
+    # pymongo before 3.2 has no raw documents, so raw scans fall back to decoding every document into a dict
+    RawBSONDocument = None
+
+DUPLICATE_KEY_ERROR = 11000
+# Analytics scans read a handful of fields per post, so a batch this large stays far below the 16MB reply limit
+SCAN_BATCH_SIZE = 20000
+# When every aggregation last ran, shared with the job state of pipeline.AggregationRunner
+AGGREGATION_STATE_SUFFIX = "_job_state"
 
 
 class FacebookThread:
@@ -22,32 +39,40 @@ class FacebookThread:
     Attributes:
         participants (List[Dict{string}]): A json representation of the participants in the thread.
         thread_id (str): The thread id the object targets.
+        compact_posts (bool): If posts are kept as compact Post objects instead of the raw Graph Api json.
 
     """
 
-    def __init__(self, graph, thread_id, latest_post_id=None):
+    def __init__(self, graph, thread_id, latest_post_id=None, compact_posts=False, latest_post_time=None):
         """The Initializer for the FacebookThread object
 
         Args:
             :param graph: The connection to the Facebook Graph Api
             :param thread_id: The id of the thread to pull messages from
             :param latest_post_id: An optional parameter to specify the last post to start from
+            :param compact_posts: Keep posts and participants as compact Post and Participant objects
+            :param latest_post_time: The creation time of the last post, which lets delta_update ask for newer posts only
             :type graph: facebook.GraphApi
             :type thread_id: str
             :type latest_post_id: str
+            :type compact_posts: bool
+            :type latest_post_time: datetime
         """
         self._graph = graph
+        self.compact_posts = compact_posts
         if not latest_post_id:
             raw_json = self._graph.get_object(thread_id)
-            self.participants = raw_json['to']['data']
+            self.participants = self._page_participants(raw_json['to']['data'])
             self._comments_json = raw_json['comments']
-            self._posts = self._data
+            self._posts = self._page_posts(self._data)
             self._latest_post_id = self._get_post_id(self._data[-1])
+            self._latest_post_time = parse_graph_time(self._data[-1]['created_time'])
         else:
             self.participants = []
             self._comments_json = []
             self._posts = []
             self._latest_post_id = latest_post_id
+            self._latest_post_time = latest_post_time
         self._updating = False
         self.thread_id = thread_id
         self._old_latest_post_id = None
@@ -61,21 +86,30 @@ class FacebookThread:
         if self._next_page_url is None:
             return False
         else:
-            next_parse_url = urlparse.urlparse(self._next_page_url)
-            next_path = next_parse_url.path
-            next_query = dict(urlparse.parse_qsl(next_parse_url.query))
-
-            try:
-                next_query.pop('access_token')
-            except KeyError:
-                # We want to remove the access token, so if it's already been removed or it
-                # doesn't exist in the first place then we should be fine
-                pass
-
-            self._comments_json = self._graph.get_object(next_path, **next_query)
-            self._posts = self._data + self._posts
+            self._fetch_next_page()
+            self._posts = self._page_posts(self._data) + self._posts
             return True
 
+    def _fetch_next_page(self, **extra_query):
+        """Replaces the current thread json with the page its next url points to
+
+        :param extra_query: Query parameters to add to the ones in the next url
+        """
+        next_parse_url = urlparse.urlparse(self._next_page_url)
+        next_path = next_parse_url.path
+        next_query = dict(urlparse.parse_qsl(next_parse_url.query))
+
+        try:
+            next_query.pop('access_token')
+        except KeyError:
+            # We want to remove the access token, so if it's already been removed or it
+            # doesn't exist in the first place then we should be fine
+            pass
+
+        for key, value in extra_query.items():
+            next_query.setdefault(key, value)
+        self._comments_json = self._graph.get_object(next_path, **next_query)
+
     def update_thread(self):
         """Checks for new posts in reference to the latest post retrieved and adds the next 25 posts if they exist
 
@@ -86,19 +120,9 @@ class FacebookThread:
             self._old_latest_post_id = self._latest_post_id
             self._comments_json = self._graph.get_object(self.thread_id + '/comments')
             self._latest_post_id = self._get_post_id(self._data[-1])
+            self._latest_post_time = parse_graph_time(self._data[-1]['created_time'])
         else:
-            next_parse_url = urlparse.urlparse(self._next_page_url)
-            next_path = next_parse_url.path
-            next_query = dict(urlparse.parse_qsl(next_parse_url.query))
-
-            try:
-                next_query.pop('access_token')
-            except KeyError:
-                # We want to remove the access token, so if it's already been removed or it
-                # doesn't exist in the first place then we should be fine
-                pass
-
-            self._comments_json = self._graph.get_object(next_path, **next_query)
+            self._fetch_next_page()
 
         # check if there's new comments
         # If there aren't then don't bother
@@ -110,16 +134,90 @@ class FacebookThread:
         # check if it's a partial new page
         if long(self._old_latest_post_id) >= long(self._get_post_id(self._data[0])):
             # pull all posts that happened after the old latest post
-            new_post_data = [post for post in self._data if self._get_post_id(post) > self._old_latest_post_id]
-            self._posts = self._posts + new_post_data
+            new_post_data = [post for post in self._data
+                             if long(self._get_post_id(post)) > long(self._old_latest_post_id)]
+            self._posts = self._posts + self._page_posts(new_post_data)
             self._updating = False
         else:
-            self._posts = self._posts + self._data
+            self._posts = self._posts + self._page_posts(self._data)
             self._updating = True
         return True
 
+    def delta_update(self, page_limit=100):
+        """Retrieves every post created after the latest post in one call
+
+        Instead of reading the newest page and walking back until the latest post shows up, this asks the Graph Api
+        only for posts created since the latest post's creation time. A quiet thread costs a single request with an
+        empty page, and a busy one is read in pages of page_limit posts. The new posts are also added to posts.
+
+        :param page_limit: The number of posts to ask for in each request
+        :type page_limit: int
+        :return: The new posts, oldest first
+        :rtype: List
+        """
+        query = {'limit': page_limit}
+        if self._latest_post_time is not None:
+            query['since'] = calendar.timegm(self._latest_post_time.utctimetuple())
+        self._comments_json = self._graph.get_object(self.thread_id + '/comments', **query)
+
+        latest_post_id = long(self._latest_post_id)
+        new_post_data = []
+        while self._data:
+            # since only has a resolution of seconds, so posts sharing the latest post's second come back again
+            page_posts = [post for post in self._data if long(self._get_post_id(post)) > latest_post_id]
+            # Pages run from the newest posts backwards, so each older page goes in front
+            new_post_data = page_posts + new_post_data
+            if len(page_posts) < len(self._data) or self._next_page_url is None:
+                break
+            self._fetch_next_page(**query)
+
+        if new_post_data:
+            self._latest_post_id = self._get_post_id(new_post_data[-1])
+            self._latest_post_time = parse_graph_time(new_post_data[-1]['created_time'])
+            new_post_data = self._page_posts(new_post_data)
+            self._posts = self._posts + new_post_data
+        return new_post_data
+
+    def fetch_window(self, since, until, page_limit=100):
+        """Retrieves the posts created between two times without touching posts or the latest post
+
+        This is used to re-fetch a range of posts that is missing from the database.
+
+        :param since: The creation time of the first post to retrieve
+        :param until: The creation time of the last post to retrieve
+        :param page_limit: The number of posts to ask for in each request
+        :type since: datetime
+        :type until: datetime
+        :type page_limit: int
+        :return: The posts in the window, oldest first
+        :rtype: List
+        """
+        query = {'since': calendar.timegm(since.utctimetuple()),
+                 # until is exclusive while since is inclusive, and posts in the last second count
+                 'until': calendar.timegm(until.utctimetuple()) + 1,
+                 'limit': page_limit}
+        self._comments_json = self._graph.get_object(self.thread_id + '/comments', **query)
+
+        window_posts = []
+        while self._data:
+            window_posts = self._data + window_posts
+            if self._next_page_url is None:
+                break
+            self._fetch_next_page(since=query['since'])
+        window_posts = [post for post in window_posts if since <= parse_graph_time(post['created_time']) <= until]
+        return self._page_posts(window_posts)
+
     def update_participants(self):
-        self.participants = self._graph.get_object(self.thread_id + '/to/data')
+        self.participants = self._page_participants(self._graph.get_object(self.thread_id + '/to/data'))
+
+    def _page_posts(self, posts):
+        """Converts the posts of a page into the representation the thread keeps"""
+        return [Post.from_graph(post) for post in posts] if self.compact_posts else posts
+
+    def _page_participants(self, participants):
+        """Converts participants json into the representation the thread keeps"""
+        return [Participant.from_graph(participant) for participant in participants] if self.compact_posts \
+            else participants
 
     @staticmethod
     def _get_post_id(post):
@@ -144,7 +242,7 @@ class FacebookThread:
 
     @property
     def posts(self):
-        """List[Dict[str]]: The current list of posts retrieved from the thread."""
+        """List[Dict[str]]: The current list of posts retrieved from the thread, List[Post] with compact_posts."""
         return self._posts
 
     def pop_posts(self):
@@ -177,6 +275,7 @@ class DatabaseHandler:
     PARTICIPANTS_COLLECTION_BASE = 'participants'
     # Special thanks to @gruber
     URL_REGEX = re.compile("(^|\s)((https?://)?[\w-]+(\.[\w-]+)+\.?(:\d+)?(/\S*)?)", re.IGNORECASE)
+    WORD_SEPARATOR_REGEX = re.compile('[\s\.,\?!;:]+')
 
     def __init__(self, database_url, database_name, thread_id=None):
         self._db_connection = pymongo.MongoClient(database_url)
@@ -187,6 +286,7 @@ class DatabaseHandler:
         else:
             self._posts_collection_name = self.POSTS_COLLECTION_BASE
             self._participants_collection_name = self.PARTICIPANTS_COLLECTION_BASE
+        self._ingest_hooks = []
 
     def _db(self):
         return self._db_connection[self._db_name]
@@ -200,38 +300,392 @@ class DatabaseHandler:
     def authenticate(self, username, password):
         self._db().authenticate(username, password, mechanism='SCRAM-SHA-1')
 
-    def add_posts(self, post_list):
+    def add_ingest_hook(self, hook, name=None):
+        """Registers a function that add_posts calls with every batch of documents it inserted
+
+        Hooks only ever see posts that were actually inserted, so replayed or duplicate posts are never counted twice.
+        A batch is stored with the names of the hooks it still has to go through, see add_posts, so the names of the
+        hooks on a thread have to be the same in every process that adds posts to it.
+
+        :param hook: Called with the list of inserted post documents
+        :param name: The name the hook is tracked under, by default its class and method name
+        :type hook: Callable[[List[Dict]], None]
+        :type name: str
+        """
+        if name is None:
+            owner = getattr(hook, "__self__", None)
+            name = hook.__name__ if owner is None else "{0}.{1}".format(owner.__class__.__name__, hook.__name__)
+        if any(name == hook_name for hook_name, _ in self._ingest_hooks):
+            raise ValueError("An ingest hook named {0} is already registered".format(name))
+        self._ingest_hooks.append((name, hook))
+
+    def add_posts(self, post_list, ignore_duplicates=False):
+        """Stores a batch of posts and runs the ingest hooks over the ones that were inserted
+
+        Posts are inserted with a hooks_pending field that lists the hooks still to run over them. It is cleared once
+        every hook has run, and when a hook raises it is narrowed to that hook and the ones after it. Replaying the
+        batch with ignore_duplicates then runs just those hooks over the stored posts that still list them, so a
+        failed hook is caught up without counting any post twice in the hooks that did run. A process that dies while
+        hooks are running leaves every hook pending, so the hooks that had already run count those posts twice on
+        replay. Rebuild their collections instead after such a crash, which posts_pending_hooks detects.
+
+        :param post_list: The posts in the Graph Api shape or as Post objects
+        :param ignore_duplicates: Skip posts that are already stored rather than fail
+        :type post_list: List
+        :type ignore_duplicates: bool
+        """
+        # Posts only keep the sender id, so remember the names they carry before they are transformed away
+        self._record_senders(post_list)
         transformed_post_list = [DatabaseHandler.post_transform(post) for post in post_list]
-        self._posts_collection().insert_many(transformed_post_list)
+        hook_names = [hook_name for hook_name, _ in self._ingest_hooks]
+        pending_post_list = []
+        try:
+            if hook_names:
+                for post in transformed_post_list:
+                    post["hooks_pending"] = hook_names
+            if not ignore_duplicates:
+                self._posts_collection().insert_many(transformed_post_list)
+                inserted_post_list = transformed_post_list
+            else:
+                # Unordered inserts keep going past posts that are already stored, so replaying a batch is harmless
+                try:
+                    self._posts_collection().insert_many(transformed_post_list, ordered=False)
+                    inserted_post_list = transformed_post_list
+                except pymongo.errors.BulkWriteError as bulk_error:
+                    if any(error['code'] != DUPLICATE_KEY_ERROR for error in bulk_error.details['writeErrors']):
+                        raise
+                    duplicate_indexes = set(error['index'] for error in bulk_error.details['writeErrors'])
+                    inserted_post_list = [post for index, post in enumerate(transformed_post_list)
+                                          if index not in duplicate_indexes]
+                    if hook_names:
+                        # A replayed batch catches up the hooks that had not run over it yet
+                        duplicate_ids = [transformed_post_list[index]["_id"] for index in duplicate_indexes]
+                        pending_post_list = list(self._posts_collection().find(
+                            {"_id": {"$in": duplicate_ids}, "hooks_pending": {"$exists": True}}))
+        finally:
+            for post in transformed_post_list:
+                post.pop("hooks_pending", None)
+        if not inserted_post_list and not pending_post_list:
+            return
+
+        hook_post_list = inserted_post_list + pending_post_list
+        pending_hooks = [set(hook_names)] * len(inserted_post_list) + \
+            [set(post.pop("hooks_pending")) for post in pending_post_list]
+        hook_post_ids = [post["_id"] for post in hook_post_list]
+        for index, (hook_name, hook) in enumerate(self._ingest_hooks):
+            hook_posts = [post for post, pending in zip(hook_post_list, pending_hooks) if hook_name in pending]
+            if not hook_posts:
+                continue
+            try:
+                hook(hook_posts)
+            except Exception:
+                # The hooks from this one on still owe these posts, the ones before it are done with them
+                if index:
+                    self._posts_collection().update_many({"_id": {"$in": hook_post_ids}},
+                                                         {"$pullAll": {"hooks_pending": hook_names[:index]}})
+                raise
+        if any(pending - set(hook_names) for pending in pending_hooks):
+            # Hooks that are not registered here stay pending for a process that has them
+            self._posts_collection().update_many({"_id": {"$in": hook_post_ids}},
+                                                 {"$pullAll": {"hooks_pending": hook_names}})
+            self._posts_collection().update_many({"_id": {"$in": hook_post_ids}, "hooks_pending": {"$size": 0}},
+                                                 {"$unset": {"hooks_pending": ""}})
+        else:
+            self._posts_collection().update_many({"_id": {"$in": hook_post_ids}}, {"$unset": {"hooks_pending": ""}})
+
+    def posts_pending_hooks(self):
+        """Counts the stored posts that some ingest hook has not run over yet, see add_posts
+
+        :rtype: int
+        """
+        return self._posts_collection().find({"hooks_pending": {"$exists": True}}).count()
 
     @staticmethod
     def post_transform(post):
+        if isinstance(post, Post):
+            return post.to_document()
         post["_id"] = post.pop("id")
-        post["created_time"] = datetime.strptime(post["created_time"].split("+")[0], "%Y-%m-%dT%H:%M:%S")
+        post["seq"] = int(post["_id"].split("_")[1])
+        post["sender"] = post.pop("from")["id"]
+        post["created_time"] = parse_graph_time(post["created_time"])
+        return post
+
+    @staticmethod
+    def post_untransform(document, sender_names=None):
+        """Turns a stored post document back into the Graph Api shape that post_transform accepts
+
+        :param document: A post document from the posts collection
+        :param sender_names: The participant names by id, used to rebuild the from field
+        :type document: Dict
+        :type sender_names: Dict[str, str]
+        :return: The post as the Graph Api returns it
+        :rtype: Dict
+        """
+        post = dict(document)
+        post["id"] = post.pop("_id")
+        post.pop("seq", None)
+        sender = post.pop("sender")
+        post["from"] = {"id": sender, "name": (sender_names or {}).get(sender)}
+        post["created_time"] = format_graph_time(post["created_time"])
         return post
 
+    def iter_posts(self, after_seq=None, batch_size=1000, projection=None):
+        """Streams the stored posts in seq order
+
+        Posts are ordered by their sequence id rather than their _id, whose string order is not post order, so a
+        stream can be resumed after the last seq it returned.
+
+        :param after_seq: Only posts with a seq greater than this one are returned
+        :param batch_size: The number of documents the cursor pulls from the server at a time
+        :param projection: The fields to return or leave out, None for every field
+        :type after_seq: int
+        :type batch_size: int
+        :type projection: Dict[str, int]
+        :return: A cursor over the post documents
+        :rtype: pymongo.cursor.Cursor
+        """
+        query = {} if after_seq is None else {"seq": {"$gt": after_seq}}
+        cursor = self._posts_collection().find(query, projection, sort=[("seq", pymongo.ASCENDING)])
+        return cursor.batch_size(batch_size)
+
+    def scan_posts(self, fields, query=None, sort=None, batch_size=SCAN_BATCH_SIZE, raw=False):
+        """Streams the stored posts for an analytics pass, reading nothing but fields
+
+        The projection is strict, so the server only sends the fields the pass reads and the driver only decodes those.
+        _id is only returned when it is listed in fields. Projected posts are small, which is what makes the large
+        default batch size cheap.
+
+        Raw documents keep the BSON bytes they were sent as and only decode them when a field is first read, which
+        pays off for passes that skip most documents. Reading any field decodes the whole document in pure Python
+        though, so a pass that reads every document is faster with the default dicts, see bson_decode_benchmark.py.
+
+        :param fields: The names of the fields to read
+        :param query: The posts to read, None for every post
+        :param sort: The sort specification, None for natural order
+        :param batch_size: The number of documents the cursor pulls from the server at a time
+        :param raw: Return read only RawBSONDocuments, where pymongo supports them
+        :type fields: Iterable[str]
+        :type query: Dict
+        :type sort: List[Tuple[str, int]]
+        :type batch_size: int
+        :type raw: bool
+        :return: A cursor over post documents holding fields
+        :rtype: pymongo.cursor.Cursor
+        """
+        projection = dict((field, 1) for field in fields)
+        projection.setdefault("_id", 0)
+        collection = self._posts_collection()
+        if raw and RawBSONDocument is not None:
+            collection = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+        return collection.find(query or {}, projection, sort=sort).batch_size(batch_size)
+
+    def get_participants(self, include_former=False):
+        """Returns the participants of the thread in the Graph Api shape
+
+        :param include_former: Also return senders who are no longer members of the thread
+        :type include_former: bool
+        :rtype: List[Dict[str]]
+        """
+        query = {} if include_former else {"current": True}
+        return [{"id": participant["_id"], "name": participant["name"]}
+                for participant in self._participants_collection().find(query)]
+
+    @property
+    def sender_names(self):
+        """Dict[str, str]: The name of every participant and former participant, by id."""
+        return dict((participant["_id"], participant["name"])
+                    for participant in self._participants_collection().find({}, {"name": 1}))
+
     def set_participants(self, participants_list):
-        self._participants_collection().remove({})
-        self._participants_collection().insert_many(participants_list)
+        """Replaces the current members of the thread
+
+        Participants are keyed by their id. Members that are missing from participants_list are kept as former
+        participants, since their posts still need their names.
+
+        :param participants_list: The participants json or Participant objects
+        :type participants_list: List
+        """
+        participant_ids = self.update_participants(participants_list)
+        self._participants_collection().update_many({"_id": {"$nin": participant_ids}},
+                                                    {"$set": {"current": False}})
+
+    def update_participants(self, participants_list):
+        """Adds or renames participants without touching the other members of the thread
+
+        :param participants_list: The participants json or Participant objects
+        :type participants_list: List
+        :return: The ids of the given participants
+        :rtype: List[str]
+        """
+        participants_list = [participant.to_graph() if isinstance(participant, Participant) else participant
+                             for participant in participants_list]
+        if participants_list:
+            self._participants_collection().bulk_write(
+                [pymongo.UpdateOne({"_id": participant["id"]},
+                                   {"$set": {"name": participant.get("name"), "current": True}}, upsert=True)
+                 for participant in participants_list])
+        return [participant["id"] for participant in participants_list]
+
+    def _record_senders(self, post_list):
+        """Makes sure every sender of post_list can be resolved through the participants collection"""
+        senders = {}
+        for post in post_list:
+            if isinstance(post, Post):
+                senders[post.sender_id] = post.sender_name
+            elif "from" in post:
+                senders[post["from"]["id"]] = post["from"].get("name")
+        # The newest name wins, so a renamed user stays a single participant
+        operations = [pymongo.UpdateOne({"_id": sender_id},
+                                        {"$set": {"name": name}, "$setOnInsert": {"current": False}}, upsert=True)
+                      for sender_id, name in senders.items() if name is not None]
+        if operations:
+            self._participants_collection().bulk_write(operations)
+
+    def normalize_senders(self):
+        """Migrates posts stored with a whole from subdocument to a sender id
+
+        Every distinct sender is recorded in the participants collection first, then each sender's posts are rewritten
+        with a single update.
+        """
+        senders = self._posts_collection().aggregate(
+            [
+                {"$match": {"from": {"$exists": True}}},
+                {"$group": {"_id": "$from.id", "name": {"$last": "$from.name"}}}
+            ]
+        )
+        for sender in senders:
+            self._record_senders([{"from": {"id": sender["_id"], "name": sender["name"]}}])
+            self._posts_collection().update_many({"from.id": sender["_id"]},
+                                                 {"$set": {"sender": sender["_id"]}, "$unset": {"from": ""}})
+        self.ensure_indexes()
+
+    def ensure_indexes(self):
+        self._posts_collection().create_index("sender")
+        self._posts_collection().create_index("created_time")
+        self._posts_collection().create_index("seq")
+
+    def add_sequence_ids(self, batch_size=1000):
+        """Migrates posts stored without a seq field by copying the sequence part of their _id into one"""
+        update_operations = []
+        for doc in self._posts_collection().find({"seq": {"$exists": False}}, {"_id": 1}):
+            update_operations.append(pymongo.UpdateOne({"_id": doc["_id"]},
+                                                       {"$set": {"seq": int(doc["_id"].split("_")[1])}}))
+            if len(update_operations) == batch_size:
+                self._posts_collection().bulk_write(update_operations, ordered=False)
+                update_operations = []
+        if update_operations:
+            self._posts_collection().bulk_write(update_operations, ordered=False)
+        self.ensure_indexes()
+
+    def find_gaps(self, max_time_jump=None, batch_size=5000):
+        """Scans the stored posts in sequence order for missing posts and suspicious jumps in time
+
+        Only the seq and created_time fields are read, through the seq index. A gap is reported when sequence ids are
+        skipped, when a post is older than the one before it, or when two consecutive posts are further apart than
+        max_time_jump.
+
+        :param max_time_jump: The longest silence that is not suspicious, None to not check silences
+        :param batch_size: The number of documents the cursor pulls from the server at a time
+        :type max_time_jump: datetime.timedelta
+        :type batch_size: int
+        :return: The gaps, each with the seq and created_time of the posts on either side of it
+        :rtype: List[Dict]
+        """
+        gaps = []
+        previous = None
+        cursor = self._posts_collection().find({"seq": {"$exists": True}}, {"_id": 0, "seq": 1, "created_time": 1},
+                                               sort=[("seq", pymongo.ASCENDING)]).batch_size(batch_size)
+        for doc in cursor:
+            if previous is not None:
+                kind = None
+                if doc["seq"] > previous["seq"] + 1:
+                    kind = "missing"
+                elif doc["created_time"] < previous["created_time"]:
+                    kind = "out_of_order"
+                elif max_time_jump is not None and doc["created_time"] - previous["created_time"] > max_time_jump:
+                    kind = "time_jump"
+                if kind is not None:
+                    gaps.append({"kind": kind,
+                                 "missing": doc["seq"] - previous["seq"] - 1,
+                                 "after_seq": previous["seq"], "after_time": previous["created_time"],
+                                 "before_seq": doc["seq"], "before_time": doc["created_time"]})
+            previous = doc
+        return gaps
+
+    def _join_sender_names(self, collection_name, sender_field):
+        """Adds a name field to every document of a derived collection, with one update per participant"""
+        for sender_id, name in self.sender_names.items():
+            self._db()[collection_name].update_many({sender_field: sender_id}, {"$set": {"name": name}})
 
     @property
     def most_recent_post_id(self):
         # TODO: Save the _id as just the post id
-        return self._db_connection[self._db_name][self._posts_collection_name].find_one(sort=[('_id', pymongo.DESCENDING)])["_id"].split('_')[1]
+        return self._posts_collection().find_one(sort=[('seq', pymongo.DESCENDING)])["_id"].split('_')[1]
+
+    @property
+    def posts_watermark(self):
+        """Dict[str, int]: The highest stored sequence id and the number of stored posts.
+
+        The count moves when older posts are merged in by a repair, which the highest sequence id alone would miss.
+        """
+        latest_post = self._posts_collection().find_one({}, {"seq": 1}, sort=[("seq", pymongo.DESCENDING)])
+        return {"seq": latest_post.get("seq") if latest_post else None, "count": self._posts_collection().count()}
+
+    def record_aggregation_run(self, name):
+        """Stamps the time an aggregation finished rewriting its collections
+
+        The stamp is the watermark of what the aggregation wrote, which only moves when it runs, not when posts land.
+
+        :param name: The name of the aggregation, as in pipeline.default_jobs
+        :type name: str
+        """
+        self._db()[self._posts_collection_name + AGGREGATION_STATE_SUFFIX].update_one(
+            {"_id": name}, {"$set": {"last_run": datetime.utcnow()}}, upsert=True)
+
+    @property
+    def aggregation_runs(self):
+        """Dict[str, datetime]: When every aggregation last finished, by name"""
+        return dict((state["_id"], state.get("last_run")) for state in
+                    self._db()[self._posts_collection_name + AGGREGATION_STATE_SUFFIX].find({}, {"last_run": 1}))
+
+    @property
+    def most_recent_post_time(self):
+        latest_post = self._posts_collection().find_one({}, {"created_time": 1},
+                                                         sort=[("created_time", pymongo.DESCENDING)])
+        return latest_post["created_time"] if latest_post else None
+
+    @staticmethod
+    def tokenize(message):
+        """Splits a message into the lower case words every word count is made of
+
+        :param message: The text of a post
+        :type message: unicode
+        :rtype: List[unicode]
+        """
+        return DatabaseHandler.WORD_SEPARATOR_REGEX.sub(' ', message).lower().split()
+
+    @staticmethod
+    def find_links(message):
+        """Finds the links in the text of a post, in their canonical form so variants of the same link compare equal
+
+        :param message: The text of a post
+        :type message: unicode
+        :rtype: List[unicode]
+        """
+        return [canonicalize_url(match.group().strip()) for match in re.finditer(DatabaseHandler.URL_REGEX, message)]
 
     def posts_by_user_aggregation(self):
-        separator_regex = re.compile('[\s\.,\?!;:]+')
         by_user_database_name = self._posts_collection_name + "_words_by_user"
         mapper = bson.Code("""
-                           function() { emit( this.from.name, this.message ); }
+                           function() { emit( this.sender, this.message ); }
                            """)
         reducer = bson.Code("""
                             function(key, values) { return values.join(' ') + ' '; }
                             """)
 
         self._posts_collection().map_reduce(mapper, reducer, by_user_database_name)
-        for doc in self._db()[by_user_database_name].find():
-            word_array = re.sub(separator_regex, ' ', doc["value"]).lower().split(" ")
+        for doc in self._db()[by_user_database_name].find({}, {"value": 1}).batch_size(SCAN_BATCH_SIZE):
+            word_array = DatabaseHandler.tokenize(doc["value"])
             # drop value field and add messages field
             self._db()[by_user_database_name].update_one({"_id": doc['_id']},
                                                          {"$unset": {"value": ""},
@@ -239,11 +693,12 @@ class DatabaseHandler:
         self._db()[by_user_database_name].aggregate(
             [
                 {"$unwind": "$words"},
-                {"$group": {"_id": {"name": "$_id", "word": "$words"},
+                {"$group": {"_id": {"sender": "$_id", "word": "$words"},
                             "count": {"$sum": 1}}},
                 {"$out": by_user_database_name}
             ]
         )
+        self._join_sender_names(by_user_database_name, "_id.sender")
 
         self._db()[by_user_database_name].aggregate(
             [
@@ -251,12 +706,17 @@ class DatabaseHandler:
                 {"$out": self._posts_collection_name + "_word_counts"}
             ]
         )
+        # $out replaces the collections along with their indexes
+        self._db()[by_user_database_name].create_index([("_id.sender", pymongo.ASCENDING),
+                                                        ("count", pymongo.DESCENDING)])
+        self._db()[self._posts_collection_name + "_word_counts"].create_index([("count", pymongo.DESCENDING)])
+        self.record_aggregation_run("words_by_user")
 
     def posts_links_aggregation(self):
         links_database_name = self._posts_collection_name + "_links"
         self._posts_collection().aggregate(
             [
-                {"$project": {"created_time": 1, "name": "$from.name", "message": 1, "processed": {"$literal": False}}},
+                {"$project": {"created_time": 1, "sender": 1, "message": 1, "processed": {"$literal": False}}},
                 {"$match": {"message": {"$regex": DatabaseHandler.URL_REGEX}}},
                 {"$out": links_database_name}
             ]
@@ -266,12 +726,218 @@ class DatabaseHandler:
         # TODO: Make this a batch operation
         # TODO: Consider doing this in javascript
         update_operations = []
-        for doc in self._db()[links_database_name].find():
-            links = []
-            for match in re.finditer(DatabaseHandler.URL_REGEX, doc["message"]):
-                links.append(match.group().strip())
+        link_posts = []
+        links_cursor = self._db()[links_database_name].find({}, {"created_time": 1, "message": 1})
+        for doc in links_cursor.batch_size(SCAN_BATCH_SIZE):
+            links = DatabaseHandler.find_links(doc["message"])
             update_operations.append(pymongo.UpdateOne({"_id": doc["_id"]}, {"$set": {"links": links}}))
-        self._db()[links_database_name].bulk_write(update_operations)
+            link_posts.append({"created_time": doc["created_time"], "links": links})
+        if update_operations:
+            self._db()[links_database_name].bulk_write(update_operations)
+        self._join_sender_names(links_database_name, "sender")
+        self._db()[links_database_name].create_index("created_time")
+
+        self._domains_collection().drop()
+        self._update_domain_counts(link_posts)
+        self._domains_collection().create_index([("count", pymongo.DESCENDING)])
+        self._domains_collection().create_index("first_seen")
+        self.record_aggregation_run("links")
+
+    def _domains_collection(self):
+        return self._db()[self._posts_collection_name + "_domains"]
+
+    def _update_domain_counts(self, link_posts):
+        domain_counts = Counter()
+        first_seen = {}
+        last_seen = {}
+        for post in link_posts:
+            for link in post["links"]:
+                domain = url_domain(link)
+                domain_counts[domain] += 1
+                first_seen[domain] = min(first_seen.get(domain, post["created_time"]), post["created_time"])
+                last_seen[domain] = max(last_seen.get(domain, post["created_time"]), post["created_time"])
+        if domain_counts:
+            self._domains_collection().bulk_write(
+                [pymongo.UpdateOne({"_id": domain},
+                                   {"$inc": {"count": count}, "$min": {"first_seen": first_seen[domain]},
+                                    "$max": {"last_seen": last_seen[domain]}}, upsert=True)
+                 for domain, count in domain_counts.items()], ordered=False)
+
+    def update_domain_rollups(self, post_list):
+        """Adds the links of a batch of stored post documents to the domain rollup collection
+
+        The rollup holds the number of links to every domain and when the domain was first and last linked to.
+        posts_links_aggregation rebuilds it, and registering this with add_ingest_hook keeps it current in between.
+
+        :param post_list: Post documents as stored by add_posts
+        :type post_list: List[Dict]
+        """
+        self._update_domain_counts([{"created_time": post["created_time"], "links": DatabaseHandler.find_links(
+            post["message"])} for post in post_list if post.get("message")])
+
+    def top_domains(self, limit=10):
+        """Reads the most linked domains from the domain rollup collection
+
+        :param limit: The number of domains to return
+        :type limit: int
+        :return: The domain documents with _id, count, first_seen and last_seen, most linked first
+        :rtype: List[Dict]
+        """
+        return list(self._domains_collection().find(sort=[("count", pymongo.DESCENDING)]).limit(limit))
+
+    def domains_first_seen(self, start=None, end=None):
+        """Reads the domains that were linked to for the first time in [start, end)
+
+        :param start: The inclusive start of the range, None for no lower bound
+        :param end: The exclusive end of the range, None for no upper bound
+        :type start: datetime
+        :type end: datetime
+        :return: The domain documents, oldest first
+        :rtype: List[Dict]
+        """
+        time_range = {}
+        if start is not None:
+            time_range["$gte"] = start
+        if end is not None:
+            time_range["$lt"] = end
+        query = {"first_seen": time_range} if time_range else {}
+        return list(self._domains_collection().find(query, sort=[("first_seen", pymongo.ASCENDING)]))
+
+    def top_words(self, sender=None, limit=10):
+        """Reads the most used words of a sender, or of the whole thread, from posts_by_user_aggregation's output
+
+        :param sender: The id of the sender, None for the whole thread
+        :param limit: The number of words to return
+        :type sender: str
+        :type limit: int
+        :return: Pairs of word and count, most used first
+        :rtype: List[Tuple[str, int]]
+        """
+        if sender is None:
+            cursor = self._db()[self._posts_collection_name + "_word_counts"].find()
+        else:
+            cursor = self._db()[self._posts_collection_name + "_words_by_user"].find({"_id.sender": sender})
+        return [(doc["_id"]["word"], doc["count"])
+                for doc in cursor.sort([("count", pymongo.DESCENDING)]).limit(limit)]
+
+    def links_in_range(self, start=None, end=None):
+        """Reads the posts with links created in [start, end) from posts_links_aggregation's output
+
+        :param start: The inclusive start of the range, None for no lower bound
+        :param end: The exclusive end of the range, None for no upper bound
+        :type start: datetime
+        :type end: datetime
+        :return: The link documents, oldest first
+        :rtype: List[Dict]
+        """
+        time_range = {}
+        if start is not None:
+            time_range["$gte"] = start
+        if end is not None:
+            time_range["$lt"] = end
+        query = {"created_time": time_range} if time_range else {}
+        return list(self._db()[self._posts_collection_name + "_links"].find(
+            query, {"message": 0, "processed": 0}, sort=[("created_time", pymongo.ASCENDING)]))
+
+    ACTIVITY_GRANULARITIES = ('hour', 'day', 'week')
+
+    def _activity_collection(self, granularity):
+        return self._db()[self._posts_collection_name + "_activity_" + granularity]
+
+    @staticmethod
+    def _activity_bucket(created_time, granularity):
+        """Truncates a time to the start of its hour, day or week, weeks starting on Monday"""
+        if granularity == 'hour':
+            return created_time.replace(minute=0, second=0, microsecond=0)
+        day = created_time.replace(hour=0, minute=0, second=0, microsecond=0)
+        return day if granularity == 'day' else day - timedelta(days=day.weekday())
+
+    def update_activity_rollups(self, post_list):
+        """Adds a batch of stored post documents to the activity rollup collections
+
+        Each rollup document holds the post count of one sender in one hour, day or week, and the heatmap holds the
+        count of one sender in one weekday and hour. A batch costs one upsert per touched rollup document. Register this
+        with add_ingest_hook to keep the rollups current as posts are added.
+
+        :param post_list: Post documents as stored by add_posts
+        :type post_list: List[Dict]
+        """
+        counts = dict((granularity, Counter()) for granularity in self.ACTIVITY_GRANULARITIES)
+        heatmap_counts = Counter()
+        for post in post_list:
+            for granularity in self.ACTIVITY_GRANULARITIES:
+                counts[granularity][(post["sender"], self._activity_bucket(post["created_time"], granularity))] += 1
+            heatmap_counts[(post["sender"], post["created_time"].weekday(), post["created_time"].hour)] += 1
+
+        for granularity in self.ACTIVITY_GRANULARITIES:
+            if counts[granularity]:
+                self._activity_collection(granularity).bulk_write(
+                    [pymongo.UpdateOne({"_id": {"sender": sender, "bucket": bucket}}, {"$inc": {"count": count}},
+                                       upsert=True)
+                     for (sender, bucket), count in counts[granularity].items()], ordered=False)
+        if heatmap_counts:
+            self._activity_collection("heatmap").bulk_write(
+                [pymongo.UpdateOne({"_id": {"sender": sender, "weekday": weekday, "hour": hour}},
+                                   {"$inc": {"count": count}}, upsert=True)
+                 for (sender, weekday, hour), count in heatmap_counts.items()], ordered=False)
+
+    def rebuild_activity_rollups(self, batch_size=50000):
+        """Rebuilds every activity rollup collection in one pass over the posts"""
+        for granularity in self.ACTIVITY_GRANULARITIES + ("heatmap",):
+            self._activity_collection(granularity).drop()
+        batch = []
+        for post in self.scan_posts(("sender", "created_time"), batch_size=batch_size):
+            batch.append(post)
+            if len(batch) == batch_size:
+                self.update_activity_rollups(batch)
+                batch = []
+        self.update_activity_rollups(batch)
+        for granularity in self.ACTIVITY_GRANULARITIES:
+            self._activity_collection(granularity).create_index("_id.bucket")
+            self._activity_collection(granularity).create_index([("_id.sender", pymongo.ASCENDING),
+                                                                 ("_id.bucket", pymongo.ASCENDING)])
+
+    def activity(self, granularity="day", sender=None, start=None, end=None):
+        """Reads post counts per hour, day or week from the rollups
+
+        :param granularity: One of hour, day or week
+        :param sender: Only count this sender's posts, None to count everyone's
+        :param start: The inclusive start of the range, None for no lower bound
+        :param end: The exclusive end of the range, None for no upper bound
+        :type granularity: str
+        :type sender: str
+        :type start: datetime
+        :type end: datetime
+        :return: Pairs of bucket start and post count, oldest first
+        :rtype: List[Tuple[datetime, int]]
+        """
+        query = {}
+        if sender is not None:
+            query["_id.sender"] = sender
+        bucket_range = {}
+        if start is not None:
+            bucket_range["$gte"] = self._activity_bucket(start, granularity)
+        if end is not None:
+            bucket_range["$lt"] = end
+        if bucket_range:
+            query["_id.bucket"] = bucket_range
+        counts = Counter()
+        for rollup in self._activity_collection(granularity).find(query):
+            counts[rollup["_id"]["bucket"]] += rollup["count"]
+        return sorted(counts.items())
+
+    def activity_heatmap(self, sender=None):
+        """Reads the weekday by hour post counts from the rollups
+
+        :param sender: Only count this sender's posts, None to count everyone's
+        :type sender: str
+        :return: Seven rows, Monday first, of 24 hourly counts
+        :rtype: List[List[int]]
+        """
+        heatmap = [[0] * 24 for _ in range(7)]
+        for rollup in self._activity_collection("heatmap").find({"_id.sender": sender} if sender is not None else {}):
+            heatmap[rollup["_id"]["weekday"]][rollup["_id"]["hour"]] += rollup["count"]
+        return heatmap
 
     def close(self):
         self._db_connection.close()
@@ -0,0 +1,383 @@
+"""Link and word analytics computed in process, without a database
+
+PostAnalytics computes what posts_links_aggregation and posts_by_user_aggregation compute, in one streaming pass over
+any source of posts: Graph Api json, stored post documents, Post objects, FacebookThread pages or an export directory.
+Links are found with DatabaseHandler.find_links and words are split with DatabaseHandler.tokenize, so the results are
+the documents those aggregations leave in the _links, _domains, _words_by_user and _word_counts collections.
+
+It can run offline over an export, or during ingest by registering PostAnalytics.add_posts with
+DatabaseHandler.add_ingest_hook. save writes the results to a thread's collections, in place of the aggregations.
+
+SampledAnalytics estimates the same results from a sample of a thread's posts, either a random sample drawn by the
+server or one partition of the posts by seq. Counts are scaled up by the sampled fraction and come with a confidence
+interval, in the same documents the exact results use, so a dashboard can switch between the two without changes.
+They are never saved over the exact results though.
+"""
+
+import math
+from collections import Counter, defaultdict
+
+import pymongo
+import scipy.stats
+
+from turkey_vulture import SCAN_BATCH_SIZE, DatabaseHandler, transfer
+from turkey_vulture.links import url_domain
+from turkey_vulture.models import Participant, Post
+
+
+SAMPLE_METHODS = ('random', 'partition')
+SAMPLE_FIELDS = ('_id', 'sender', 'created_time', 'message')
+
+
+def _to_document(post):
+    """Turns a post of any supported shape into a stored post document"""
+    if isinstance(post, Post):
+        return post.to_document()
+    if 'from' in post:
+        # post_transform works in place, and the caller may still need the Graph Api json
+        return DatabaseHandler.post_transform(dict(post))
+    return post
+
+
+class PostAnalytics:
+    """PostAnalytics accumulates the link and word analytics of one thread
+
+    Posts are counted once by id, so overlapping pages and replayed batches give the same results as the duplicate
+    ignoring inserts of add_posts.
+
+    Attributes:
+        sender_names (Dict[str, unicode]): The name of every sender, by id, from participants and posts.
+        posts (int): The number of distinct posts added.
+
+    """
+
+    def __init__(self):
+        self.sender_names = {}
+        self.posts = 0
+        self._post_ids = set()
+        self._word_counts = defaultdict(Counter)
+        self._link_posts = []
+        self._domains = {}
+
+    def add_participants(self, participants_list):
+        """Records the names of the participants json or Participant objects"""
+        for participant in participants_list:
+            if isinstance(participant, Participant):
+                participant = participant.to_graph()
+            self.sender_names[participant['id']] = participant.get('name')
+
+    def add_posts(self, post_list):
+        """Adds a batch of posts in the Graph Api shape, as stored documents or as Post objects
+
+        :param post_list: The posts to add
+        :type post_list: List
+        """
+        for post in post_list:
+            if isinstance(post, Post):
+                sender_name = post.sender_name
+            else:
+                sender_name = post['from'].get('name') if 'from' in post else None
+            document = _to_document(post)
+            if document['_id'] in self._post_ids:
+                continue
+            self._post_ids.add(document['_id'])
+            self.posts += 1
+            if sender_name is not None:
+                self.sender_names[document['sender']] = sender_name
+
+            message = document.get('message')
+            if not message:
+                continue
+            self._word_counts[document['sender']].update(DatabaseHandler.tokenize(message))
+            if DatabaseHandler.URL_REGEX.search(message):
+                links = DatabaseHandler.find_links(message)
+                self._link_posts.append({'_id': document['_id'], 'created_time': document['created_time'],
+                                         'sender': document['sender'], 'message': message, 'processed': False,
+                                         'links': links})
+                for link in links:
+                    domain = url_domain(link)
+                    if domain not in self._domains:
+                        self._domains[domain] = {'_id': domain, 'count': 0, 'first_seen': document['created_time'],
+                                                 'last_seen': document['created_time']}
+                    counts = self._domains[domain]
+                    counts['count'] += 1
+                    counts['first_seen'] = min(counts['first_seen'], document['created_time'])
+                    counts['last_seen'] = max(counts['last_seen'], document['created_time'])
+
+    def add_thread(self, thread):
+        """Adds every post of a FacebookThread, fetching one page at a time until there are no more
+
+        Posts are popped from the thread after every page, so memory stays flat however long the thread is.
+
+        :param thread: A thread, usually just constructed
+        :type thread: turkey_vulture.FacebookThread
+        """
+        self.add_participants(thread.participants)
+        self.add_posts(thread.pop_posts())
+        while thread.get_next_page():
+            self.add_posts(thread.pop_posts())
+
+    def add_export(self, directory, batch_size=5000):
+        """Adds every post of an export directory written by transfer.export_thread
+
+        :param directory: The export directory
+        :param batch_size: The number of posts added at a time
+        :type directory: str
+        :type batch_size: int
+        """
+        self.add_participants(transfer.read_participants(directory))
+        batch = []
+        for post in transfer.iter_export(directory):
+            batch.append(post)
+            if len(batch) == batch_size:
+                self.add_posts(batch)
+                batch = []
+        self.add_posts(batch)
+
+    def _named(self, document, sender):
+        if sender in self.sender_names:
+            document['name'] = self.sender_names[sender]
+        return document
+
+    def words_by_user(self):
+        """The documents posts_by_user_aggregation writes to _words_by_user, most used first
+
+        :rtype: List[Dict]
+        """
+        documents = [self._named({'_id': {'sender': sender, 'word': word}, 'count': count}, sender)
+                     for sender, counts in self._word_counts.items() for word, count in counts.items()]
+        return sorted(documents, key=lambda document: -document['count'])
+
+    def word_counts(self):
+        """The documents posts_by_user_aggregation writes to _word_counts, most used first
+
+        :rtype: List[Dict]
+        """
+        totals = Counter()
+        for counts in self._word_counts.values():
+            totals.update(counts)
+        return [{'_id': {'word': word}, 'count': count} for word, count in totals.most_common()]
+
+    def links(self):
+        """The documents posts_links_aggregation writes to _links, oldest first
+
+        :rtype: List[Dict]
+        """
+        return [self._named(dict(link_post), link_post['sender'])
+                for link_post in sorted(self._link_posts, key=lambda link_post: link_post['created_time'])]
+
+    def domains(self):
+        """The documents posts_links_aggregation writes to _domains, most linked first
+
+        :rtype: List[Dict]
+        """
+        return sorted((dict(domain) for domain in self._domains.values()), key=lambda domain: -domain['count'])
+
+    def top_words(self, sender=None, limit=10):
+        """The most used words of a sender, or of the whole thread, see DatabaseHandler.top_words
+
+        :rtype: List[Tuple[str, int]]
+        """
+        if sender is not None:
+            return self._word_counts.get(sender, Counter()).most_common(limit)
+        return [(document['_id']['word'], document['count']) for document in self.word_counts()[:limit]]
+
+    def links_in_range(self, start=None, end=None):
+        """The posts with links created in [start, end), see DatabaseHandler.links_in_range
+
+        :rtype: List[Dict]
+        """
+        documents = []
+        for document in self.links():
+            if (start is None or document['created_time'] >= start) and \
+                    (end is None or document['created_time'] < end):
+                del document['message'], document['processed']
+                documents.append(document)
+        return documents
+
+    def top_domains(self, limit=10):
+        """The most linked domains, see DatabaseHandler.top_domains
+
+        :rtype: List[Dict]
+        """
+        return self.domains()[:limit]
+
+    def save(self, database_handler):
+        """Replaces the aggregation collections of a thread with these results, along with their indexes
+
+        :param database_handler: The handler for the thread
+        :type database_handler: turkey_vulture.DatabaseHandler
+        """
+        collections = [('_links', self.links(), ['created_time']),
+                       ('_domains', self.domains(), [[('count', pymongo.DESCENDING)], 'first_seen']),
+                       ('_words_by_user', self.words_by_user(),
+                        [[('_id.sender', pymongo.ASCENDING), ('count', pymongo.DESCENDING)]]),
+                       ('_word_counts', self.word_counts(), [[('count', pymongo.DESCENDING)]])]
+        for suffix, documents, indexes in collections:
+            collection = database_handler._db()[database_handler._posts_collection_name + suffix]
+            collection.drop()
+            if documents:
+                collection.insert_many(documents)
+            for index in indexes:
+                collection.create_index(index)
+        database_handler.record_aggregation_run('links')
+        database_handler.record_aggregation_run('words_by_user')
+
+
+class SampledAnalytics(PostAnalytics):
+    """SampledAnalytics estimates the link and word analytics of one thread from a sample of its posts
+
+    Every count document holds the estimate of the whole thread's count in count, and the bounds of its confidence
+    interval in count_low and count_high. The sampled posts are treated as drawn independently with probability
+    fraction, which gives the variance of every estimate from the sum of the squared per post counts of the sample.
+    The lower bound is never below the sampled count itself. The links are the sampled posts with links, unscaled.
+
+    Attributes:
+        fraction (float): The share of the thread's posts that was sampled.
+        confidence (float): The confidence level of the intervals.
+
+    """
+
+    def __init__(self, fraction, confidence=0.95):
+        """The Initializer for the SampledAnalytics object
+
+        Args:
+            :param fraction: The share of the thread's posts the sample was drawn with, in (0, 1]
+            :param confidence: The confidence level of the intervals, in (0, 1)
+            :type fraction: float
+            :type confidence: float
+        """
+        if not 0 < fraction <= 1:
+            raise ValueError('fraction must be greater than 0 and at most 1')
+        PostAnalytics.__init__(self)
+        self.fraction = fraction
+        self.confidence = confidence
+        self._z = scipy.stats.norm.ppf(0.5 + confidence / 2.0)
+        self._word_squares = defaultdict(Counter)
+        self._total_squares = Counter()
+        self._domain_squares = Counter()
+
+    @classmethod
+    def build(cls, database_handler, fraction, method='random', partition=0, confidence=0.95,
+              batch_size=SCAN_BATCH_SIZE):
+        """Samples the posts of a thread and estimates their analytics
+
+        The random method has the server draw round(fraction * posts) posts with $sample, a fresh sample every time.
+        The partition method reads the posts whose seq modulo round(1 / fraction) is partition, so fraction becomes
+        the nearest 1 / n. The same partition always holds the same posts, and the n partitions split the thread.
+
+        :param database_handler: The handler for the thread
+        :param fraction: The share of the posts to sample, in (0, 1]
+        :param method: random or partition, see SAMPLE_METHODS
+        :param partition: The partition to read with the partition method, from 0 to round(1 / fraction) - 1
+        :param confidence: The confidence level of the intervals
+        :param batch_size: The number of documents the cursor pulls from the server at a time
+        :type database_handler: turkey_vulture.DatabaseHandler
+        :type fraction: float
+        :type method: str
+        :type partition: int
+        :type confidence: float
+        :type batch_size: int
+        :rtype: SampledAnalytics
+        """
+        if method not in SAMPLE_METHODS:
+            raise ValueError('Unknown sample method {0}'.format(method))
+        if not 0 < fraction <= 1:
+            raise ValueError('fraction must be greater than 0 and at most 1')
+        if method == 'random':
+            posts = database_handler._posts_collection().count()
+            size = int(round(fraction * posts))
+            pipeline = [{'$sample': {'size': size}}, {'$project': dict((field, 1) for field in SAMPLE_FIELDS)}]
+            cursor = database_handler._posts_collection().aggregate(pipeline, allowDiskUse=True,
+                                                                    batchSize=batch_size) if size else []
+        else:
+            modulus = int(round(1 / fraction))
+            fraction = 1.0 / modulus
+            cursor = database_handler.scan_posts(SAMPLE_FIELDS, {'seq': {'$mod': [modulus, partition % modulus]}},
+                                                 batch_size=batch_size)
+
+        sampled_analytics = cls(fraction, confidence)
+        sampled_analytics.add_participants(database_handler.get_participants(include_former=True))
+        batch = []
+        for post in cursor:
+            batch.append(post)
+            if len(batch) == batch_size:
+                sampled_analytics.add_posts(batch)
+                batch = []
+        sampled_analytics.add_posts(batch)
+        if method == 'random' and sampled_analytics.posts:
+            # $sample can return a post more than once, so the share is that of the distinct posts it returned
+            sampled_analytics.fraction = sampled_analytics.posts / float(posts)
+        return sampled_analytics
+
+    def add_posts(self, post_list):
+        """Adds a batch of sampled posts, in any shape PostAnalytics.add_posts accepts
+
+        :param post_list: The posts to add
+        :type post_list: List
+        """
+        for post in post_list:
+            posts = self.posts
+            PostAnalytics.add_posts(self, [post])
+            document = _to_document(post)
+            # A random sample can hold a post twice, and only its first copy is counted
+            if self.posts == posts or not document.get('message'):
+                continue
+            for term, count in Counter(DatabaseHandler.tokenize(document['message'])).items():
+                self._word_squares[document['sender']][term] += count * count
+                self._total_squares[term] += count * count
+            if DatabaseHandler.URL_REGEX.search(document['message']):
+                domain_counts = Counter(url_domain(link) for link in DatabaseHandler.find_links(document['message']))
+                for domain, count in domain_counts.items():
+                    self._domain_squares[domain] += count * count
+
+    def _estimate(self, document, squares):
+        """Scales the sampled count of document up to the thread and adds the bounds of its interval"""
+        sampled_count = document['count']
+        estimate = sampled_count / self.fraction
+        half_width = self._z * math.sqrt((1 - self.fraction) * squares) / self.fraction
+        document['count'] = int(round(estimate))
+        document['count_low'] = max(sampled_count, int(math.floor(estimate - half_width)))
+        document['count_high'] = int(math.ceil(estimate + half_width))
+        return document
+
+    def words_by_user(self):
+        """Estimates of the documents posts_by_user_aggregation writes to _words_by_user, most used first
+
+        :rtype: List[Dict]
+        """
+        return [self._estimate(document, self._word_squares[document['_id']['sender']][document['_id']['word']])
+                for document in PostAnalytics.words_by_user(self)]
+
+    def word_counts(self):
+        """Estimates of the documents posts_by_user_aggregation writes to _word_counts, most used first
+
+        :rtype: List[Dict]
+        """
+        return [self._estimate(document, self._total_squares[document['_id']['word']])
+                for document in PostAnalytics.word_counts(self)]
+
+    def domains(self):
+        """Estimates of the documents posts_links_aggregation writes to _domains, most linked first
+
+        :rtype: List[Dict]
+        """
+        return [self._estimate(document, self._domain_squares[document['_id']])
+                for document in PostAnalytics.domains(self)]
+
+    def save(self, database_handler):
+        """Refuses to save, estimates written over the aggregation collections would be served as exact counts
+
+        Saving records an aggregation run, which tells the pipeline and AnalyticsCache the exact results are current.
+        """
+        raise NotImplementedError('Sampled analytics are estimates and cannot replace the aggregation collections')
+
+    def top_words(self, sender=None, limit=10):
+        """Estimates of the most used words of a sender, or of the whole thread, see DatabaseHandler.top_words
+
+        :rtype: List[Tuple[str, int]]
+        """
+        if sender is None:
+            return PostAnalytics.top_words(self, limit=limit)
+        return [(word, self._estimate({'count': count}, self._word_squares[sender][word])['count'])
+                for word, count in PostAnalytics.top_words(self, sender, limit)]
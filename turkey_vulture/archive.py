@@ -0,0 +1,167 @@
+"""A columnar, memory mapped archive of a thread's posts for offline analytics
+
+An archive directory holds one NumPy array per post field, all sorted by creation time:
+
+    post_id.npy         int64   The sequence part of the post id
+    created_time.npy    int64   Seconds since the epoch (UTC)
+    sender.npy          int32   An index into senders.json
+    message_start.npy   int64   The byte offset of the message in messages.bin
+    message_end.npy     int64   The byte offset just past the message in messages.bin
+
+messages.bin holds the utf-8 encoded messages back to back. Everything is opened with mmap, so opening an archive
+costs nothing no matter how many posts it holds and the operating system pages in only the columns a query touches.
+"""
+
+import array
+import calendar
+import json
+import mmap
+import os
+from datetime import datetime
+
+import numpy
+
+from turkey_vulture import SCAN_BATCH_SIZE
+
+SENDERS_FILE = 'senders.json'
+MESSAGES_FILE = 'messages.bin'
+COLUMNS = ('post_id', 'created_time', 'sender', 'message_start', 'message_end')
+
+
+def _to_timestamp(value):
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    return value
+
+
+class PostArchive:
+    """PostArchive is a read only, memory mapped view of an archive directory
+
+    Attributes:
+        senders (List[Dict{string}]): The id and name of every sender, in sender index order.
+        post_id (numpy.ndarray): The post id column.
+        created_time (numpy.ndarray): The creation time column in seconds since the epoch.
+        sender (numpy.ndarray): The sender index column.
+
+    """
+
+    def __init__(self, directory):
+        """The Initializer for the PostArchive object
+
+        Args:
+            :param directory: An archive directory written by PostArchive.write
+            :type directory: str
+        """
+        self.directory = directory
+        with open(os.path.join(directory, SENDERS_FILE)) as senders_file:
+            self.senders = json.load(senders_file)
+        for column in COLUMNS:
+            setattr(self, column, numpy.load(os.path.join(directory, column + '.npy'), mmap_mode='r'))
+
+        self._messages_file = open(os.path.join(directory, MESSAGES_FILE), 'rb')
+        if os.fstat(self._messages_file.fileno()).st_size:
+            self._messages = mmap.mmap(self._messages_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # mmap refuses empty files, and a thread without any message text is still a valid archive
+            self._messages = b''
+
+    @staticmethod
+    def write(database_handler, directory, batch_size=SCAN_BATCH_SIZE):
+        """Writes every post stored by database_handler into a new archive directory
+
+        Posts are streamed once with a strict projection. Fixed width fields are collected in compact arrays and
+        messages go straight to disk, so the only per post memory cost is a few machine words.
+
+        :param database_handler: The handler for the thread to archive
+        :param directory: The directory to write the archive into
+        :param batch_size: The number of documents the cursor pulls from the server at a time
+        :type database_handler: turkey_vulture.DatabaseHandler
+        :type directory: str
+        :type batch_size: int
+        :return: The newly written archive
+        :rtype: PostArchive
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        post_ids = array.array('l')
+        created_times = array.array('l')
+        senders = array.array('i')
+        message_starts = array.array('l')
+        message_ends = array.array('l')
+        sender_indexes = {}
+        sender_list = []
+        sender_names = database_handler.sender_names
+
+        offset = 0
+        with open(os.path.join(directory, MESSAGES_FILE), 'wb') as messages_file:
+            cursor = database_handler.scan_posts(('_id', 'sender', 'created_time', 'message'), batch_size=batch_size)
+            for document in cursor:
+                sender = document['sender']
+                if sender not in sender_indexes:
+                    sender_indexes[sender] = len(sender_list)
+                    sender_list.append({'id': sender, 'name': sender_names.get(sender)})
+
+                message = document.get('message', u'').encode('utf-8')
+                messages_file.write(message)
+
+                post_ids.append(int(document['_id'].split('_')[1]))
+                created_times.append(_to_timestamp(document['created_time']))
+                senders.append(sender_indexes[sender])
+                message_starts.append(offset)
+                offset += len(message)
+                message_ends.append(offset)
+
+        columns = {
+            'post_id': numpy.array(post_ids, dtype=numpy.int64),
+            'created_time': numpy.array(created_times, dtype=numpy.int64),
+            'sender': numpy.array(senders, dtype=numpy.int32),
+            'message_start': numpy.array(message_starts, dtype=numpy.int64),
+            'message_end': numpy.array(message_ends, dtype=numpy.int64),
+        }
+        # Sort on time with the post id breaking ties, so time range queries are a binary search
+        order = numpy.lexsort((columns['post_id'], columns['created_time']))
+        for column in COLUMNS:
+            numpy.save(os.path.join(directory, column + '.npy'), columns[column][order])
+        with open(os.path.join(directory, SENDERS_FILE), 'w') as senders_file:
+            json.dump(sender_list, senders_file)
+        return PostArchive(directory)
+
+    def __len__(self):
+        return len(self.post_id)
+
+    def time_range(self, start=None, end=None):
+        """Finds the rows created in [start, end)
+
+        :param start: The inclusive start of the range as a datetime or epoch seconds, None for the first post
+        :param end: The exclusive end of the range as a datetime or epoch seconds, None for the last post
+        :return: A slice that can index any of the columns
+        :rtype: slice
+        """
+        low = 0 if start is None else int(numpy.searchsorted(self.created_time, _to_timestamp(start), 'left'))
+        high = len(self) if end is None else int(numpy.searchsorted(self.created_time, _to_timestamp(end), 'left'))
+        return slice(low, max(low, high))
+
+    def counts_by_sender(self, start=None, end=None):
+        """Counts the posts of every sender in a time range
+
+        :param start: The inclusive start of the range, see time_range
+        :param end: The exclusive end of the range, see time_range
+        :return: The post count for every sender, indexed like senders
+        :rtype: numpy.ndarray
+        """
+        return numpy.bincount(self.sender[self.time_range(start, end)], minlength=len(self.senders))
+
+    def message(self, row):
+        """Decodes the message of a single row
+
+        :param row: The row to read
+        :type row: int
+        :rtype: unicode
+        """
+        return self._messages[int(self.message_start[row]):int(self.message_end[row])].decode('utf-8')
+
+    def close(self):
+        if not isinstance(self._messages, bytes):
+            self._messages.close()
+        self._messages_file.close()
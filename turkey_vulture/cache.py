@@ -0,0 +1,177 @@
+"""A result cache for the analytics queries of DatabaseHandler
+
+Results are kept in an in-memory LRU tier and, optionally, an on-disk tier shared between processes. Every key includes
+the watermark of the thread: the posts watermark, which moves the moment new posts land, and the time every aggregation
+last ran, which moves when the collections that top_words and links_in_range read are rewritten. Cached results stop
+matching as soon as anything they were computed from changes, and nothing ever has to be invalidated by hand. The
+watermark itself is re-read at most once every watermark_seconds, which is what lets repeated reads be answered without
+touching the database at all.
+
+Results are copied on the way in and out, so a caller that changes the result it was given changes nobody else's.
+"""
+
+import copy
+import cPickle as pickle
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """LRUCache is a thread safe, fixed capacity mapping that forgets the least recently used keys first"""
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._entries.pop(key, _MISSING)
+            if value is _MISSING:
+                return default
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache:
+    """DiskCache stores pickled values in a directory, one file per key
+
+    File names start with a hash of the watermark the value was computed at, so values for older watermarks can be
+    removed with nothing more than a directory listing.
+    """
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+
+    @staticmethod
+    def _hash(value):
+        return hashlib.sha1(repr(value)).hexdigest()
+
+    def _path(self, watermark, key):
+        return os.path.join(self.directory, '{0}_{1}.pickle'.format(self._hash(watermark), self._hash(key)))
+
+    def get(self, watermark, key, default=None):
+        try:
+            with open(self._path(watermark, key), 'rb') as value_file:
+                return pickle.load(value_file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return default
+
+    def put(self, watermark, key, value):
+        path = self._path(watermark, key)
+        temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as value_file:
+            pickle.dump(value, value_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, path)
+
+    def prune(self, watermark):
+        """Removes every value that was not computed at watermark"""
+        prefix = self._hash(watermark) + '_'
+        for file_name in os.listdir(self.directory):
+            if not file_name.startswith(prefix):
+                try:
+                    os.remove(os.path.join(self.directory, file_name))
+                except OSError:
+                    # Another process pruned it first
+                    pass
+
+
+class AnalyticsCache:
+    """AnalyticsCache answers DatabaseHandler analytics queries from its tiers whenever the thread has not changed
+
+    Attributes:
+        hits (int): The number of queries answered from a cache tier.
+        misses (int): The number of queries that went to the database.
+
+    """
+
+    def __init__(self, database_handler, capacity=1024, directory=None, watermark_seconds=1.0, clock=time.time):
+        """The Initializer for the AnalyticsCache object
+
+        Args:
+            :param database_handler: The handler for the thread
+            :param capacity: The number of results kept in memory
+            :param directory: The directory of the on-disk tier, None to only cache in memory
+            :param watermark_seconds: How long a read watermark is trusted before it is read again
+            :type database_handler: turkey_vulture.DatabaseHandler
+            :type capacity: int
+            :type directory: str
+            :type watermark_seconds: float
+        """
+        self._database_handler = database_handler
+        self._memory = LRUCache(capacity)
+        self._disk = DiskCache(directory) if directory is not None else None
+        self._watermark_seconds = watermark_seconds
+        self._clock = clock
+        self._watermark = None
+        self._watermark_read = None
+        self.hits = 0
+        self.misses = 0
+
+    def _current_watermark(self):
+        now = self._clock()
+        if self._watermark_read is None or now - self._watermark_read >= self._watermark_seconds:
+            posts_watermark = self._database_handler.posts_watermark
+            watermark = (posts_watermark['seq'], posts_watermark['count'],
+                         tuple(sorted(self._database_handler.aggregation_runs.items())))
+            if watermark != self._watermark and self._disk is not None:
+                self._disk.prune(watermark)
+            self._watermark = watermark
+            self._watermark_read = now
+        return self._watermark
+
+    def query(self, name, *args, **kwargs):
+        """Calls a DatabaseHandler method, or returns its cached result for the current watermark
+
+        :param name: The name of the DatabaseHandler method
+        :type name: str
+        :return: Whatever the method returns
+        """
+        watermark = self._current_watermark()
+        key = (watermark, name, args, tuple(sorted(kwargs.items())))
+        value = self._memory.get(key, _MISSING)
+        if value is _MISSING and self._disk is not None:
+            value = self._disk.get(watermark, key, _MISSING)
+            if value is not _MISSING:
+                self._memory.put(key, value)
+        if value is not _MISSING:
+            self.hits += 1
+            return copy.deepcopy(value)
+
+        self.misses += 1
+        value = getattr(self._database_handler, name)(*args, **kwargs)
+        self._memory.put(key, copy.deepcopy(value))
+        if self._disk is not None:
+            self._disk.put(watermark, key, value)
+        return value
+
+    def top_words(self, sender=None, limit=10):
+        return self.query('top_words', sender=sender, limit=limit)
+
+    def links_in_range(self, start=None, end=None):
+        return self.query('links_in_range', start=start, end=end)
+
+    def clear(self):
+        self._memory.clear()
+        self._watermark_read = None
@@ -0,0 +1,131 @@
+"""Distinct word and link counts from HyperLogLog sketches
+
+DistinctCounters keeps a HyperLogLog sketch of the words and one of the links of every sender and of the whole thread,
+both per calendar month and for all time, in the <posts>_cardinality collection. Every sketch takes a few KB whatever
+it counts. An all time count reads a single document and a count over a range of months merges one document per month,
+so none of these questions needs the _words_by_user or _links collections any more.
+
+Register DistinctCounters.update with DatabaseHandler.add_ingest_hook to keep the sketches current as posts are added.
+Several workers can run the hook at once; update_partitions retries a sketch another worker wrote in the meantime.
+"""
+
+from collections import defaultdict
+
+from bson.son import SON
+
+from turkey_vulture import DatabaseHandler
+from turkey_vulture.sketches import HyperLogLog, update_partitions
+
+CARDINALITY_SUFFIX = '_cardinality'
+MONTH_FORMAT = '%Y-%m'
+WORDS = 'words'
+LINKS = 'links'
+
+
+def _partition_id(kind, sender, month):
+    return SON([('kind', kind), ('sender', sender), ('month', month)])
+
+
+class DistinctCounters:
+    """DistinctCounters maintains and queries the distinct word and link counts of one thread
+
+    Attributes:
+        precision (int): The precision of every sketch, see HyperLogLog.
+
+    """
+
+    def __init__(self, database_handler, precision=12):
+        """The Initializer for the DistinctCounters object
+
+        Args:
+            :param database_handler: The handler for the thread
+            :param precision: The precision of every sketch, see HyperLogLog
+            :type database_handler: turkey_vulture.DatabaseHandler
+            :type precision: int
+        """
+        self._database_handler = database_handler
+        self._collection = database_handler._db()[database_handler._posts_collection_name + CARDINALITY_SUFFIX]
+        self.precision = precision
+
+    def update(self, post_list):
+        """Adds the words and links of a batch of stored post documents to the sketches
+
+        :param post_list: Post documents as stored by add_posts
+        :type post_list: List[Dict]
+        """
+        items = defaultdict(set)
+        for post in post_list:
+            if not post.get('message'):
+                continue
+            month = post['created_time'].strftime(MONTH_FORMAT)
+            for kind, post_items in ((WORDS, DatabaseHandler.tokenize(post['message'])),
+                                     (LINKS, DatabaseHandler.find_links(post['message']))):
+                for sender in (post['sender'], None):
+                    for partition_month in (month, None):
+                        items[(kind, sender, partition_month)].update(post_items)
+
+        def merge(partition_id, document):
+            key = tuple(partition_id.values())
+            sketch = HyperLogLog(self.precision) if document is None else HyperLogLog.from_document(document['sketch'])
+            sketch.update(items[key])
+            return {'sketch': sketch.to_document()}
+
+        update_partitions(self._collection, [_partition_id(*key) for key, partition_items in items.items()
+                                             if partition_items], merge)
+
+    def rebuild(self, batch_size=5000):
+        """Rebuilds every sketch in one pass over the posts"""
+        self._collection.drop()
+        batch = []
+        for post in self._database_handler.scan_posts(('sender', 'created_time', 'message'), batch_size=batch_size):
+            batch.append(post)
+            if len(batch) == batch_size:
+                self.update(batch)
+                batch = []
+        self.update(batch)
+
+    def _count(self, kind, sender, start, end):
+        if start is None and end is None:
+            document = self._collection.find_one({'_id': _partition_id(kind, sender, None)})
+            return HyperLogLog.from_document(document['sketch']).estimate() if document else 0
+        month_range = {'$ne': None}
+        if start is not None:
+            month_range['$gte'] = start.strftime(MONTH_FORMAT)
+        if end is not None:
+            month_range['$lt'] = end.strftime(MONTH_FORMAT)
+        sketch = HyperLogLog(self.precision)
+        for document in self._collection.find({'_id.kind': kind, '_id.sender': sender, '_id.month': month_range}):
+            sketch.merge(HyperLogLog.from_document(document['sketch']))
+        return sketch.estimate()
+
+    def distinct_words(self, sender=None, start=None, end=None):
+        """Estimates the number of distinct words used by a sender, or by the whole thread
+
+        :param sender: The id of the sender, None for the whole thread
+        :param start: A time in the first month to count, None for no lower bound
+        :param end: A time in the month after the last one to count, None for no upper bound
+        :type sender: str
+        :type start: datetime
+        :type end: datetime
+        :rtype: int
+        """
+        return self._count(WORDS, sender, start, end)
+
+    def distinct_links(self, sender=None, start=None, end=None):
+        """Estimates the number of distinct links shared by a sender, or by the whole thread, see distinct_words
+
+        :rtype: int
+        """
+        return self._count(LINKS, sender, start, end)
+
+    def distinct_links_by_month(self, sender=None):
+        """Estimates the number of distinct links shared in every month
+
+        :param sender: The id of the sender, None for the whole thread
+        :type sender: str
+        :return: Pairs of month, as YYYY-MM, and estimate, oldest first
+        :rtype: List[Tuple[str, int]]
+        """
+        documents = self._collection.find({'_id.kind': LINKS, '_id.sender': sender, '_id.month': {'$ne': None}})
+        return sorted((document['_id']['month'], HyperLogLog.from_document(document['sketch']).estimate())
+                      for document in documents)
@@ -0,0 +1,28 @@
+"""The ingest hooks every process that adds posts to a thread registers
+
+add_posts tracks the hooks a batch still has to go through by name, so a tail process, a spool drainer and a worker
+ingesting the same thread have to register the same hooks. register_default_hooks is the one place that list is kept.
+"""
+
+from turkey_vulture import cardinality
+from turkey_vulture import reposts
+from turkey_vulture import search
+from turkey_vulture import trending
+from turkey_vulture import words
+
+
+def register_default_hooks(database_handler, search_directory):
+    """Registers the rollups, sketches and indexes that are kept current as posts are added
+
+    :param database_handler: The handler for the thread
+    :param search_directory: The search index directory of the thread
+    :type database_handler: turkey_vulture.DatabaseHandler
+    :type search_directory: str
+    """
+    database_handler.add_ingest_hook(database_handler.update_activity_rollups)
+    database_handler.add_ingest_hook(database_handler.update_domain_rollups)
+    database_handler.add_ingest_hook(words.WordSketches(database_handler).update)
+    database_handler.add_ingest_hook(cardinality.DistinctCounters(database_handler).update)
+    database_handler.add_ingest_hook(reposts.RepostIndex(database_handler).update)
+    database_handler.add_ingest_hook(search.SearchIndex(search_directory).update)
+    database_handler.add_ingest_hook(trending.TrendingTerms(database_handler).update)
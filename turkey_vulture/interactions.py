@@ -0,0 +1,197 @@
+"""A weighted who-follows-whom graph of a thread's participants
+
+InteractionGraph holds two square matrices indexed by sender, with rows for the earlier poster and columns for the later
+one:
+
+    transitions     How often the column sender posted directly after the row sender
+    co_activity     How often the column sender posted within window_seconds after the row sender, with any posts
+                    in between
+
+Both are built with vectorized NumPy over a single columnar pass of the posts, so building the graph of a thread with
+millions of posts costs a few arrays of machine words per post. The graph is saved as a compressed .npz file.
+"""
+
+import array
+import calendar
+
+import numpy
+
+from turkey_vulture import SCAN_BATCH_SIZE
+
+DEFAULT_WINDOW_SECONDS = 5 * 60
+DEFAULT_MAX_LAG = 50
+
+
+class InteractionGraph:
+    """InteractionGraph is the interaction matrices of one thread
+
+    Attributes:
+        sender_ids (List[str]): The id of every sender, in matrix index order.
+        sender_names (List[unicode]): The name of every sender, in matrix index order.
+        transitions (numpy.ndarray): Direct follow counts, transitions[i, j] counts posts by j right after a post by i.
+        co_activity (numpy.ndarray): Windowed follow counts, co_activity[i, j] counts posts by j soon after a post by i.
+        window_seconds (int): The window co_activity was counted in.
+
+    """
+
+    def __init__(self, sender_ids, sender_names, transitions, co_activity, window_seconds):
+        self.sender_ids = list(sender_ids)
+        self.sender_names = list(sender_names)
+        self.transitions = transitions
+        self.co_activity = co_activity
+        self.window_seconds = window_seconds
+        self._sender_indexes = dict((sender_id, index) for index, sender_id in enumerate(self.sender_ids))
+
+    @classmethod
+    def build(cls, database_handler, window_seconds=DEFAULT_WINDOW_SECONDS, max_lag=DEFAULT_MAX_LAG,
+              batch_size=SCAN_BATCH_SIZE):
+        """Builds the graph of every post stored by database_handler
+
+        Senders are indexed in the order of the participants collection, former participants included.
+
+        :param database_handler: The handler for the thread
+        :param window_seconds: How soon after a post a post by someone else counts as co-activity
+        :param max_lag: The most posts after a post that are checked for co-activity, which bounds the cost of bursts
+        :param batch_size: The number of documents the cursor pulls from the server at a time
+        :type database_handler: turkey_vulture.DatabaseHandler
+        :type window_seconds: int
+        :type max_lag: int
+        :type batch_size: int
+        :rtype: InteractionGraph
+        """
+        sender_ids = []
+        sender_names = []
+        sender_indexes = {}
+        for participant in database_handler._participants_collection().find({}, {'name': 1}).sort('_id'):
+            sender_indexes[participant['_id']] = len(sender_ids)
+            sender_ids.append(participant['_id'])
+            sender_names.append(participant.get('name'))
+
+        post_ids = array.array('l')
+        created_times = array.array('l')
+        senders = array.array('i')
+        for document in database_handler.scan_posts(('seq', 'sender', 'created_time'), batch_size=batch_size):
+            sender = document['sender']
+            if sender not in sender_indexes:
+                sender_indexes[sender] = len(sender_ids)
+                sender_ids.append(sender)
+                sender_names.append(None)
+            post_ids.append(document['seq'])
+            created_times.append(calendar.timegm(document['created_time'].utctimetuple()))
+            senders.append(sender_indexes[sender])
+
+        post_ids = numpy.array(post_ids, dtype=numpy.int64)
+        created_times = numpy.array(created_times, dtype=numpy.int64)
+        senders = numpy.array(senders, dtype=numpy.int32)
+        order = numpy.lexsort((post_ids, created_times))
+        created_times = created_times[order]
+        senders = senders[order]
+
+        size = len(sender_ids)
+        transitions = numpy.zeros((size, size), dtype=numpy.int64)
+        co_activity = numpy.zeros((size, size), dtype=numpy.int64)
+        changed = senders[:-1] != senders[1:]
+        numpy.add.at(transitions, (senders[:-1][changed], senders[1:][changed]), 1)
+        for lag in range(1, min(max_lag, len(senders) - 1) + 1):
+            earlier = senders[:-lag]
+            later = senders[lag:]
+            in_window = created_times[lag:] - created_times[:-lag] <= window_seconds
+            if not in_window.any():
+                # Times are sorted, so no larger lag can be inside the window either
+                break
+            mask = in_window & (earlier != later)
+            numpy.add.at(co_activity, (earlier[mask], later[mask]), 1)
+        return cls(sender_ids, sender_names, transitions, co_activity, window_seconds)
+
+    def save(self, path):
+        """Writes the graph to a compressed .npz file"""
+        numpy.savez_compressed(path, sender_ids=numpy.array(self.sender_ids, dtype=numpy.unicode_),
+                               sender_names=numpy.array([name or u'' for name in self.sender_names],
+                                                        dtype=numpy.unicode_),
+                               transitions=self.transitions, co_activity=self.co_activity,
+                               window_seconds=numpy.array(self.window_seconds))
+
+    @classmethod
+    def load(cls, path):
+        """Reads a graph written by save
+
+        :param path: The .npz file
+        :type path: str
+        :rtype: InteractionGraph
+        """
+        saved = numpy.load(path)
+        try:
+            return cls([unicode(sender_id) for sender_id in saved['sender_ids']],
+                       [unicode(name) or None for name in saved['sender_names']],
+                       saved['transitions'], saved['co_activity'], int(saved['window_seconds']))
+        finally:
+            saved.close()
+
+    def weights(self, co_activity_weight=0.5):
+        """Combines both matrices into one weighted adjacency matrix
+
+        :param co_activity_weight: How much a windowed follow counts compared to a direct one
+        :type co_activity_weight: float
+        :rtype: numpy.ndarray
+        """
+        return self.transitions + co_activity_weight * self.co_activity
+
+    @staticmethod
+    def _top(values, k):
+        k = min(k, len(values))
+        if not k:
+            return numpy.array([], dtype=numpy.intp)
+        top = numpy.argpartition(-values, k - 1)[:k]
+        return top[numpy.argsort(-values[top], kind='mergesort')]
+
+    def top_partners(self, sender_id, k=10, co_activity_weight=0.5):
+        """Finds the senders that interact most with sender_id, in either direction
+
+        :param sender_id: The sender to find partners for
+        :param k: The number of partners to return
+        :param co_activity_weight: See weights
+        :type sender_id: str
+        :type k: int
+        :type co_activity_weight: float
+        :return: Pairs of partner id and interaction weight, heaviest first
+        :rtype: List[Tuple[str, float]]
+        """
+        weights = self.weights(co_activity_weight)
+        index = self._sender_indexes[sender_id]
+        interaction = weights[index, :] + weights[:, index]
+        interaction[index] = -1
+        return [(self.sender_ids[partner], float(interaction[partner]))
+                for partner in self._top(interaction, k) if interaction[partner] > 0]
+
+    def centrality(self, k=10, co_activity_weight=0.5, damping=0.85, iterations=100, tolerance=1e-10):
+        """Ranks senders by PageRank over the weighted graph, so being followed by central senders counts the most
+
+        :param k: The number of senders to return
+        :param co_activity_weight: See weights
+        :param damping: The PageRank damping factor
+        :param iterations: The most power iterations to run
+        :param tolerance: Stop once the scores change by less than this in total
+        :type k: int
+        :type co_activity_weight: float
+        :type damping: float
+        :type iterations: int
+        :type tolerance: float
+        :return: Pairs of sender id and score, highest first
+        :rtype: List[Tuple[str, float]]
+        """
+        size = len(self.sender_ids)
+        if not size:
+            return []
+        weights = self.weights(co_activity_weight)
+        out_weights = weights.sum(axis=1)
+        # Senders nobody follows spread their score evenly, like the teleport step does
+        transition = numpy.where(out_weights[:, numpy.newaxis] > 0,
+                                 weights / numpy.maximum(out_weights, 1e-300)[:, numpy.newaxis], 1.0 / size)
+        scores = numpy.full(size, 1.0 / size)
+        for _ in range(iterations):
+            new_scores = (1 - damping) / size + damping * scores.dot(transition)
+            converged = numpy.abs(new_scores - scores).sum() < tolerance
+            scores = new_scores
+            if converged:
+                break
+        return [(self.sender_ids[index], float(scores[index])) for index in self._top(scores, k)]
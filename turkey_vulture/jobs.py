@@ -0,0 +1,251 @@
+"""A Mongo backed work queue that lets any number of worker processes share thread ingestion
+
+Jobs live in a single collection. A worker claims a job with an atomic find-and-modify that hands it a lease, keeps the
+lease alive with heartbeats while it works and marks the job done or failed at the end. A job whose worker dies is
+claimed again by someone else once its lease expires. Job ids are derived from what the job does, so enqueuing the same
+backfill window or thread update twice only ever creates one job.
+"""
+
+import logging
+import os
+import socket
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+import pymongo
+
+JOBS_COLLECTION = 'jobs'
+
+BACKFILL_JOB = 'backfill'
+UPDATE_JOB = 'update'
+AGGREGATION_JOB = 'aggregation'
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class LeaseLostError(Exception):
+    """Raised when a worker tries to finish a job whose lease was taken over by another worker"""
+    pass
+
+
+class JobQueue:
+    """JobQueue is the shared queue of backfill, update and aggregation jobs
+
+    Attributes:
+        max_attempts (int): The number of times a job is tried before it is left failed.
+
+    """
+
+    def __init__(self, database_handler, collection_name=JOBS_COLLECTION, max_attempts=5):
+        """The Initializer for the JobQueue object
+
+        Args:
+            :param database_handler: Any handler connected to the database that holds the queue
+            :param collection_name: The name of the jobs collection
+            :param max_attempts: The number of times a job is tried before it is left failed
+            :type database_handler: turkey_vulture.DatabaseHandler
+            :type collection_name: str
+            :type max_attempts: int
+        """
+        self._collection = database_handler._db()[collection_name]
+        self.max_attempts = max_attempts
+
+    def ensure_indexes(self):
+        self._collection.create_index([('status', pymongo.ASCENDING), ('created', pymongo.ASCENDING)])
+        self._collection.create_index('lease_expires')
+
+    def enqueue(self, kind, thread_id, payload=None, job_id=None):
+        """Adds a job unless a job with the same id already exists
+
+        :param kind: What the job does, one of BACKFILL_JOB, UPDATE_JOB or AGGREGATION_JOB
+        :param thread_id: The thread the job works on
+        :param payload: The arguments of the job
+        :param job_id: The id of the job, by default built from the kind, thread and payload
+        :type kind: str
+        :type thread_id: str
+        :type payload: Dict
+        :type job_id: str
+        :return: The id of the job
+        :rtype: str
+        """
+        payload = payload or {}
+        if job_id is None:
+            job_id = ':'.join([kind, thread_id] + ['{0}={1}'.format(key, payload[key]) for key in sorted(payload)])
+        self._collection.update_one(
+            {'_id': job_id},
+            {'$setOnInsert': {'kind': kind, 'thread_id': thread_id, 'payload': payload, 'status': PENDING,
+                              'attempts': 0, 'created': datetime.utcnow()}},
+            upsert=True)
+        return job_id
+
+    def requeue(self, job_id):
+        """Makes a finished job pending again, which is how recurring updates and aggregations are scheduled"""
+        self._collection.update_one({'_id': job_id, 'status': {'$in': [DONE, FAILED]}},
+                                    {'$set': {'status': PENDING, 'attempts': 0}})
+
+    def claim(self, worker_id, lease_seconds=120, kinds=None):
+        """Atomically takes the oldest available job
+
+        A job is available when it is pending, or when it is running under a lease that has expired. A job whose lease
+        expired on its last attempt is left failed, since its worker died or hung and no attempts are left to retry it.
+
+        :param worker_id: The id of the claiming worker
+        :param lease_seconds: How long the job stays claimed without a heartbeat
+        :param kinds: Only claim jobs of these kinds
+        :type worker_id: str
+        :type lease_seconds: float
+        :type kinds: List[str]
+        :return: The claimed job, None if there is nothing to do
+        :rtype: Dict
+        """
+        now = datetime.utcnow()
+        self._collection.update_many(
+            {'status': RUNNING, 'lease_expires': {'$lt': now}, 'attempts': {'$gte': self.max_attempts}},
+            {'$set': {'status': FAILED, 'last_error': 'The lease expired on the last attempt', 'finished': now},
+             '$unset': {'lease_expires': ''}})
+        query = {'$or': [{'status': PENDING},
+                         {'status': RUNNING, 'lease_expires': {'$lt': now}}],
+                 'attempts': {'$lt': self.max_attempts}}
+        if kinds:
+            query['kind'] = {'$in': list(kinds)}
+        return self._collection.find_one_and_update(
+            query,
+            {'$set': {'status': RUNNING, 'lease_owner': worker_id,
+                      'lease_expires': now + timedelta(seconds=lease_seconds), 'started': now},
+             '$inc': {'attempts': 1}},
+            sort=[('created', pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER)
+
+    def heartbeat(self, job, lease_seconds=120):
+        """Extends the lease of a claimed job
+
+        :return: False if the lease has been lost to another worker
+        :rtype: bool
+        """
+        result = self._collection.update_one(
+            {'_id': job['_id'], 'lease_owner': job['lease_owner'], 'status': RUNNING},
+            {'$set': {'lease_expires': datetime.utcnow() + timedelta(seconds=lease_seconds)}})
+        return result.matched_count == 1
+
+    def complete(self, job, result=None):
+        self._finish(job, {'status': DONE, 'result': result, 'finished': datetime.utcnow()})
+
+    def fail(self, job, error):
+        """Gives a job back to the queue, or leaves it failed once it has used up its attempts"""
+        status = FAILED if job['attempts'] >= self.max_attempts else PENDING
+        self._finish(job, {'status': status, 'last_error': error, 'finished': datetime.utcnow()})
+
+    def _finish(self, job, fields):
+        result = self._collection.update_one(
+            {'_id': job['_id'], 'lease_owner': job['lease_owner'], 'status': RUNNING},
+            {'$set': fields, '$unset': {'lease_expires': ''}})
+        if result.matched_count != 1:
+            raise LeaseLostError(job['_id'])
+
+    def counts(self):
+        """Returns the number of jobs in every status
+
+        :rtype: Dict[str, int]
+        """
+        return dict((group['_id'], group['count']) for group in self._collection.aggregate(
+            [{'$group': {'_id': '$status', 'count': {'$sum': 1}}}]))
+
+
+def enqueue_backfill(queue, thread_id, since, until, window=timedelta(days=7)):
+    """Splits a time range of a thread into backfill jobs of one window each
+
+    :param queue: The queue to add the jobs to
+    :param thread_id: The thread to backfill
+    :param since: The start of the range
+    :param until: The end of the range
+    :param window: The length of time each job fetches
+    :type queue: JobQueue
+    :type thread_id: str
+    :type since: datetime
+    :type until: datetime
+    :type window: timedelta
+    :return: The ids of the jobs
+    :rtype: List[str]
+    """
+    job_ids = []
+    window_start = since
+    while window_start < until:
+        window_end = min(until, window_start + window)
+        job_ids.append(queue.enqueue(BACKFILL_JOB, thread_id, {'since': window_start, 'until': window_end}))
+        window_start = window_end
+    return job_ids
+
+
+class Worker:
+    """Worker claims jobs from a JobQueue and runs them with the handler registered for their kind
+
+    While a job runs a background thread renews its lease every third of the lease time.
+    """
+
+    def __init__(self, queue, handlers, worker_id=None, lease_seconds=120):
+        """The Initializer for the Worker object
+
+        Args:
+            :param queue: The queue to take jobs from
+            :param handlers: A function for every job kind this worker runs, called with the job and returning its result
+            :param worker_id: The id the worker claims jobs under, by default its host name and process id
+            :param lease_seconds: How long a job stays claimed without a heartbeat
+            :type queue: JobQueue
+            :type handlers: Dict[str, Callable[[Dict], object]]
+            :type worker_id: str
+            :type lease_seconds: float
+        """
+        self._queue = queue
+        self._handlers = handlers
+        self.worker_id = worker_id or '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self._lease_seconds = lease_seconds
+
+    def _keep_alive(self, job, done):
+        while not done.wait(self._lease_seconds / 3.0):
+            if not self._queue.heartbeat(job, self._lease_seconds):
+                return
+
+    def run_one(self):
+        """Claims and runs a single job
+
+        :return: The job that was run, None if the queue had nothing for this worker
+        :rtype: Dict
+        """
+        job = self._queue.claim(self.worker_id, self._lease_seconds, kinds=self._handlers.keys())
+        if job is None:
+            return None
+
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._keep_alive, args=(job, done))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            try:
+                result = self._handlers[job['kind']](job)
+            except Exception:
+                done.set()
+                self._queue.fail(job, traceback.format_exc())
+            else:
+                done.set()
+                self._queue.complete(job, result)
+        except LeaseLostError:
+            # The lease ran out while the handler worked and the job now belongs to another worker or has failed
+            logger.warning('Lost the lease on job %s, dropping it', job['_id'])
+        finally:
+            done.set()
+            heartbeat.join()
+        return job
+
+    def run(self, idle_seconds=10.0, should_stop=lambda: False):
+        """Runs jobs until should_stop returns True, waiting idle_seconds whenever the queue is empty"""
+        idle = threading.Event()
+        while not should_stop():
+            if self.run_one() is None:
+                idle.wait(idle_seconds)
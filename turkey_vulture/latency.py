@@ -0,0 +1,160 @@
+"""Reply latency and turn-taking analytics
+
+A turn is a run of consecutive posts by the same sender. A turn that starts within max_reply_seconds of the previous
+post is a reply to the sender of that post, and its latency is the time between the two posts. Turns that start after
+a longer silence open a new conversation and are not counted as replies.
+
+update_reply_latency streams the posts once in created_time order and keeps a QuantileSketch of reply latencies for
+every sender and for every pair of senders, so memory only grows with the number of participants. Results go to the
+<posts>_reply_latency collection along with the position of the last post seen, and the next call continues from there.
+Posts that are stored later with an older created_time, as a backfill does, are only counted after a rebuild.
+"""
+
+import pymongo
+from bson.son import SON
+
+from turkey_vulture.sketches import QuantileSketch
+
+REPLY_LATENCY_SUFFIX = '_reply_latency'
+STATE_ID = 'state'
+USER_KIND = 'user'
+PAIR_KIND = 'pair'
+QUANTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))
+
+
+def _collection(database_handler):
+    return database_handler._db()[database_handler._posts_collection_name + REPLY_LATENCY_SUFFIX]
+
+
+def _new_stats(key, relative_accuracy):
+    stats = {'posts': 0, 'turns': 0} if key['kind'] == USER_KIND else {}
+    stats['sketch'] = QuantileSketch(relative_accuracy)
+    return stats
+
+
+def _stats_document(stats):
+    document = dict((field, value) for field, value in stats.items() if field != 'sketch')
+    document['replies'] = stats['sketch'].count
+    for name, q in QUANTILES:
+        document[name] = stats['sketch'].quantile(q)
+    document['sketch'] = stats['sketch'].to_document()
+    return document
+
+
+def _read_stats(documents):
+    stats_list = []
+    for document in documents:
+        stats = dict(document.pop('_id'))
+        del stats['kind']
+        stats.update(document)
+        stats_list.append(stats)
+    return stats_list
+
+
+def update_reply_latency(database_handler, max_reply_seconds=6 * 60 * 60, relative_accuracy=0.01, batch_size=5000,
+                         rebuild=False):
+    """Adds the posts created since the last call to the reply latency collection
+
+    :param database_handler: The handler for the thread
+    :param max_reply_seconds: The longest silence a turn can follow and still count as a reply
+    :param relative_accuracy: The relative error of the stored latency quantiles
+    :param batch_size: The number of documents the cursor pulls from the server at a time
+    :param rebuild: Drop the collection and start again from the first post
+    :type database_handler: turkey_vulture.DatabaseHandler
+    :type max_reply_seconds: float
+    :type relative_accuracy: float
+    :type batch_size: int
+    :type rebuild: bool
+    :return: The number of posts processed
+    :rtype: int
+    """
+    collection = _collection(database_handler)
+    if rebuild:
+        collection.drop()
+    state = collection.find_one({'_id': STATE_ID}) or {}
+
+    stats = {}
+    for document in collection.find({'_id': {'$ne': STATE_ID}}):
+        loaded_stats = dict((field, document[field]) for field in ('posts', 'turns') if field in document)
+        loaded_stats['sketch'] = QuantileSketch.from_document(document['sketch'])
+        stats[tuple(sorted(document['_id'].items()))] = loaded_stats
+    touched = set()
+
+    def stats_for(key):
+        stats_key = tuple(sorted(key.items()))
+        if stats_key not in stats:
+            stats[stats_key] = _new_stats(key, relative_accuracy)
+        touched.add(stats_key)
+        return stats[stats_key]
+
+    query = {}
+    if state:
+        query = {'$or': [{'created_time': {'$gt': state['created_time']}},
+                         {'created_time': state['created_time'], 'seq': {'$gt': state['seq']}}]}
+    database_handler._posts_collection().create_index([('created_time', pymongo.ASCENDING),
+                                                       ('seq', pymongo.ASCENDING)])
+    posts = database_handler.scan_posts(('sender', 'created_time', 'seq'), query,
+                                        sort=[('created_time', pymongo.ASCENDING), ('seq', pymongo.ASCENDING)],
+                                        batch_size=batch_size)
+
+    last_sender = state.get('sender')
+    last_time = state.get('created_time')
+    last_seq = state.get('seq')
+    processed = 0
+    for post in posts:
+        sender = post['sender']
+        user_stats = stats_for({'kind': USER_KIND, 'sender': sender})
+        user_stats['posts'] += 1
+        if sender != last_sender:
+            user_stats['turns'] += 1
+            if last_sender is not None:
+                latency = (post['created_time'] - last_time).total_seconds()
+                if latency <= max_reply_seconds:
+                    user_stats['sketch'].add(latency)
+                    stats_for({'kind': PAIR_KIND, 'from': last_sender, 'to': sender})['sketch'].add(latency)
+        last_sender, last_time, last_seq = sender, post['created_time'], post['seq']
+        processed += 1
+
+    if processed:
+        # The position is written last, so an interrupted write is redone in full by the next call
+        collection.bulk_write([pymongo.ReplaceOne({'_id': SON(stats_key)}, _stats_document(stats[stats_key]),
+                                                  upsert=True) for stats_key in touched], ordered=False)
+        collection.replace_one({'_id': STATE_ID},
+                               {'sender': last_sender, 'created_time': last_time, 'seq': last_seq}, upsert=True)
+    return processed
+
+
+def reply_latency(database_handler, sender=None):
+    """Reads the stored turn counts and reply latency quantiles of every sender
+
+    :param database_handler: The handler for the thread
+    :param sender: Only return this sender
+    :type database_handler: turkey_vulture.DatabaseHandler
+    :type sender: str
+    :return: Documents with the sender, posts, turns, replies and the p50, p90 and p99 latencies in seconds
+    :rtype: List[Dict]
+    """
+    query = {'_id.kind': USER_KIND}
+    if sender is not None:
+        query['_id.sender'] = sender
+    return _read_stats(_collection(database_handler).find(query, {'sketch': 0}))
+
+
+def pair_latency(database_handler, from_sender=None, to_sender=None):
+    """Reads the stored reply latency quantiles of every pair of senders
+
+    :param database_handler: The handler for the thread
+    :param from_sender: Only return replies to this sender
+    :param to_sender: Only return replies by this sender
+    :type database_handler: turkey_vulture.DatabaseHandler
+    :type from_sender: str
+    :type to_sender: str
+    :return: Documents with from, to, replies and the p50, p90 and p99 latencies in seconds
+    :rtype: List[Dict]
+    """
+    query = {'_id.kind': PAIR_KIND}
+    if from_sender is not None:
+        query['_id.from'] = from_sender
+    if to_sender is not None:
+        query['_id.to'] = to_sender
+    return _read_stats(_collection(database_handler).find(query, {'sketch': 0}))
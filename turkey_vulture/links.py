@@ -0,0 +1,97 @@
+"""Canonical forms of the links found in posts
+
+The same page is shared as http://x.com/a, x.com/a/ or with a utm_source parameter glued on. canonicalize_url maps all
+of those to one form: an explicit lower case scheme, a lower case host without a default port or trailing dot, no
+trailing slash on the path, no fragment and no known tracking parameters, with the remaining query parameters sorted.
+Links repeat a lot in a thread, so canonical forms are kept in an LRU cache.
+"""
+
+import urllib
+import urlparse
+
+from turkey_vulture.cache import LRUCache
+
+# ref is left alone on purpose, many sites use it for content, like a branch in ?ref=master on GitHub
+TRACKING_PARAMETERS = frozenset(['fbclid', 'gclid', 'dclid', 'mc_cid', 'mc_eid', 'igshid', 'ref_src', 'ref_url', '_ga',
+                                 'yclid', 'msclkid'])
+TRACKING_PARAMETER_PREFIXES = ('utm_',)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def _is_tracking_parameter(name):
+    name = name.lower()
+    return name in TRACKING_PARAMETERS or name.startswith(TRACKING_PARAMETER_PREFIXES)
+
+
+def _canonicalize_url(url):
+    # Work on utf-8 bytes, so percent decoded query parameters are bytes as well and can be quoted again
+    url = url.encode('utf-8')
+    if '://' not in url:
+        url = 'http://' + url
+    parts = urlparse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').rstrip('.')
+    if ':' in host:
+        # hostname drops the brackets around an IPv6 address, which a netloc needs
+        host = '[{0}]'.format(host)
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    netloc = host if port is None or DEFAULT_PORTS.get(scheme) == port else '{0}:{1}'.format(host, port)
+    path = parts.path.rstrip('/')
+    query = sorted((name, value) for name, value in urlparse.parse_qsl(parts.query, keep_blank_values=True)
+                   if not _is_tracking_parameter(name))
+    return urlparse.urlunsplit((scheme, netloc, path, urllib.urlencode(query), '')).decode('utf-8')
+
+
+class UrlCanonicalizer:
+    """UrlCanonicalizer canonicalizes links and remembers the most recently used ones
+
+    Attributes:
+        hits (int): The number of links answered from the cache.
+        misses (int): The number of links that had to be parsed.
+
+    """
+
+    def __init__(self, capacity=10000):
+        self._cache = LRUCache(capacity)
+        self.hits = 0
+        self.misses = 0
+
+    def canonicalize(self, url):
+        """Returns the canonical form of a link
+
+        :param url: A link as it appears in a post, with or without a scheme
+        :type url: unicode
+        :rtype: unicode
+        """
+        canonical_url = self._cache.get(url)
+        if canonical_url is None:
+            self.misses += 1
+            canonical_url = _canonicalize_url(url)
+            self._cache.put(url, canonical_url)
+        else:
+            self.hits += 1
+        return canonical_url
+
+    def domain(self, url):
+        """Returns the host of a link, which for a canonical link is already lower case
+
+        :type url: unicode
+        :rtype: unicode
+        """
+        return urlparse.urlsplit(self.canonicalize(url)).hostname or u''
+
+
+_default_canonicalizer = UrlCanonicalizer()
+
+
+def canonicalize_url(url):
+    """Returns the canonical form of a link using a cache shared by the whole process, see UrlCanonicalizer"""
+    return _default_canonicalizer.canonicalize(url)
+
+
+def url_domain(url):
+    """Returns the host of a link using a cache shared by the whole process, see UrlCanonicalizer"""
+    return _default_canonicalizer.domain(url)
@@ -0,0 +1,145 @@
+"""Compact representations of thread posts and participants
+
+The Graph Api hands back every post as a dict holding a nested dict for the sender and a string for the creation time.
+Post keeps the same information in a fixed set of slots with the sequence id as an int, the creation time parsed once
+and the sender id and name shared between every post by the same person.
+"""
+
+from datetime import datetime
+
+GRAPH_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+_interned = {}
+
+
+def _intern(value):
+    # The builtin intern only takes byte strings, and sender names are unicode
+    return _interned.setdefault(value, value)
+
+
+def parse_graph_time(created_time):
+    """Parses a Graph Api timestamp such as 2010-01-23T14:00:00+0000 into a naive UTC datetime"""
+    return datetime.strptime(created_time.split("+")[0], GRAPH_TIME_FORMAT)
+
+
+def format_graph_time(created_time):
+    """Formats a naive UTC datetime the way the Graph Api does"""
+    return created_time.strftime(GRAPH_TIME_FORMAT) + "+0000"
+
+
+class Participant(object):
+    """Participant is a member of a thread
+
+    Attributes:
+        id (str): The Facebook id of the participant.
+        name (unicode): The display name of the participant.
+
+    """
+    __slots__ = ('id', 'name')
+
+    def __init__(self, id, name):
+        self.id = _intern(id)
+        self.name = _intern(name)
+
+    @classmethod
+    def from_graph(cls, participant):
+        return cls(participant['id'], participant.get('name'))
+
+    def to_graph(self):
+        return {'id': self.id, 'name': self.name}
+
+    def __eq__(self, other):
+        return isinstance(other, Participant) and self.id == other.id and self.name == other.name
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Participant({0!r}, {1!r})'.format(self.id, self.name)
+
+
+class Post(object):
+    """Post is a single message in a thread
+
+    Attributes:
+        thread_id (str): The id of the thread the post belongs to.
+        post_id (int): The sequence number of the post inside its thread.
+        sender_id (str): The Facebook id of the sender.
+        sender_name (unicode): The display name of the sender.
+        created_time (datetime): When the post was created, in UTC.
+        message (unicode): The text of the post, None for posts without text.
+
+    """
+    __slots__ = ('thread_id', 'post_id', 'sender_id', 'sender_name', 'created_time', 'message')
+
+    def __init__(self, thread_id, post_id, sender_id, sender_name, created_time, message):
+        self.thread_id = _intern(thread_id)
+        self.post_id = post_id
+        self.sender_id = _intern(sender_id)
+        self.sender_name = _intern(sender_name)
+        self.created_time = created_time
+        self.message = message
+
+    @property
+    def id(self):
+        """str: The full Graph Api id of the post, <thread_id>_<post_id>."""
+        return '{0}_{1}'.format(self.thread_id, self.post_id)
+
+    @staticmethod
+    def _split_id(full_id):
+        thread_id, post_id = full_id.split('_')
+        return thread_id, int(post_id)
+
+    @classmethod
+    def from_graph(cls, post):
+        """Builds a Post from the json the Graph Api returns
+
+        :param post: A post from a comments page
+        :type post: Dict
+        :rtype: Post
+        """
+        thread_id, post_id = cls._split_id(post['id'])
+        return cls(thread_id, post_id, post['from']['id'], post['from'].get('name'),
+                   parse_graph_time(post['created_time']), post.get('message'))
+
+    def to_graph(self):
+        post = {'id': self.id,
+                'from': {'id': self.sender_id, 'name': self.sender_name},
+                'created_time': format_graph_time(self.created_time)}
+        if self.message is not None:
+            post['message'] = self.message
+        return post
+
+    @classmethod
+    def from_document(cls, document, sender_names=None):
+        """Builds a Post from a document in the posts collection
+
+        :param document: A stored post document
+        :param sender_names: The participant names by id, used to fill in sender_name
+        :type document: Dict
+        :type sender_names: Dict[str, str]
+        :rtype: Post
+        """
+        thread_id, post_id = cls._split_id(document['_id'])
+        sender_id = document['sender']
+        return cls(thread_id, post_id, sender_id, (sender_names or {}).get(sender_id),
+                   document['created_time'], document.get('message'))
+
+    def to_document(self):
+        """Builds the document DatabaseHandler.post_transform would store for this post
+
+        :rtype: Dict
+        """
+        document = {'_id': self.id, 'seq': self.post_id, 'sender': self.sender_id, 'created_time': self.created_time}
+        if self.message is not None:
+            document['message'] = self.message
+        return document
+
+    def __eq__(self, other):
+        return isinstance(other, Post) and all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Post({0!r}, {1!r}, {2!r})'.format(self.id, self.sender_id, self.created_time)
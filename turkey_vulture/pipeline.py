@@ -0,0 +1,164 @@
+"""Runs the derived collection jobs of a thread as a small dependency graph
+
+Every AggregationJob names the collections it reads. The posts collection is the source of everything and any other
+input is the output of another job. Jobs whose inputs are ready run concurrently, and a job is skipped when none of its
+inputs has changed since its last successful run. What a job last saw is kept in the <posts>_job_state collection.
+"""
+
+import threading
+import time
+import traceback
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+import turkey_vulture
+from turkey_vulture import latency
+from turkey_vulture import sessions
+
+POSTS_INPUT = 'posts'
+
+RAN = 'ran'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+BLOCKED = 'blocked'
+
+
+class AggregationJob:
+    """AggregationJob is one derived collection and how to build it
+
+    Attributes:
+        name (str): The name of the job, which other jobs use to depend on it.
+        inputs (List[str]): POSTS_INPUT and the names of the jobs whose output this job reads.
+        run (Callable[[DatabaseHandler], None]): Builds the derived collection.
+
+    """
+
+    def __init__(self, name, inputs, run):
+        self.name = name
+        self.inputs = inputs
+        self.run = run
+
+
+def default_jobs():
+    """Returns the jobs that build every derived collection of a thread
+
+    :rtype: List[AggregationJob]
+    """
+    return [
+        AggregationJob('links', [POSTS_INPUT], turkey_vulture.DatabaseHandler.posts_links_aggregation),
+        AggregationJob('words_by_user', [POSTS_INPUT], turkey_vulture.DatabaseHandler.posts_by_user_aggregation),
+        AggregationJob('reply_latency', [POSTS_INPUT], latency.update_reply_latency),
+        AggregationJob('sessions', [POSTS_INPUT], sessions.update_sessions),
+    ]
+
+
+class AggregationRunner:
+    """AggregationRunner runs a set of jobs against one thread"""
+
+    def __init__(self, database_handler, jobs=None, max_workers=4):
+        """The Initializer for the AggregationRunner object
+
+        Args:
+            :param database_handler: The handler for the thread
+            :param jobs: The jobs to run, default_jobs() if not given
+            :param max_workers: The most jobs that run at the same time
+            :type database_handler: turkey_vulture.DatabaseHandler
+            :type jobs: List[AggregationJob]
+            :type max_workers: int
+        """
+        self._database_handler = database_handler
+        self._jobs = dict((job.name, job) for job in (jobs if jobs is not None else default_jobs()))
+        self._max_workers = max_workers
+        self._state_collection = database_handler._db()[database_handler._posts_collection_name +
+                                                         turkey_vulture.AGGREGATION_STATE_SUFFIX]
+        for job in self._jobs.values():
+            for job_input in job.inputs:
+                if job_input != POSTS_INPUT and job_input not in self._jobs:
+                    raise ValueError('Job {0} depends on unknown job {1}'.format(job.name, job_input))
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        visiting = set()
+        visited = set()
+
+        def visit(name):
+            if name in visited or name == POSTS_INPUT:
+                return
+            if name in visiting:
+                raise ValueError('Job {0} depends on itself'.format(name))
+            visiting.add(name)
+            for job_input in self._jobs[name].inputs:
+                visit(job_input)
+            visiting.remove(name)
+            visited.add(name)
+
+        for name in self._jobs:
+            visit(name)
+
+    def _input_watermark(self, job_input, posts_watermark):
+        if job_input == POSTS_INPUT:
+            return posts_watermark
+        # A job's output changes exactly when the job runs, so the time of its last run is its watermark
+        state = self._state_collection.find_one({'_id': job_input}) or {}
+        return state.get('last_run')
+
+    def run(self, force=False):
+        """Runs every job whose inputs have changed, as concurrently as the dependencies allow
+
+        :param force: Run every job even if its inputs have not changed
+        :type force: bool
+        :return: A report for every job with its name, status and the seconds it took
+        :rtype: List[Dict]
+        """
+        posts_watermark = self._database_handler.posts_watermark
+        reports = {}
+        finished = threading.Condition()
+        pool = ThreadPool(self._max_workers)
+
+        def run_job(job, watermarks):
+            start = time.time()
+            # Anything that escapes would leave the job without a report, and run would wait for it forever
+            try:
+                job.run(self._database_handler)
+                # A job whose state cannot be saved fails, and it runs again next time since its inputs look new
+                self._state_collection.replace_one(
+                    {'_id': job.name}, {'_id': job.name, 'inputs': watermarks, 'last_run': datetime.utcnow()},
+                    upsert=True)
+            except Exception:
+                report = {'name': job.name, 'status': FAILED, 'error': traceback.format_exc()}
+            else:
+                report = {'name': job.name, 'status': RAN}
+            report['seconds'] = time.time() - start
+            with finished:
+                reports[job.name] = report
+                finished.notify()
+
+        try:
+            with finished:
+                waiting = set(self._jobs)
+                running = set()
+                while waiting or running:
+                    for name in sorted(waiting):
+                        job = self._jobs[name]
+                        job_inputs = [job_input for job_input in job.inputs if job_input != POSTS_INPUT]
+                        if any(job_input in waiting or job_input in running for job_input in job_inputs):
+                            continue
+                        waiting.remove(name)
+                        if any(reports[job_input]['status'] in (FAILED, BLOCKED) for job_input in job_inputs):
+                            reports[name] = {'name': name, 'status': BLOCKED, 'seconds': 0.0}
+                            continue
+                        watermarks = dict((job_input, self._input_watermark(job_input, posts_watermark))
+                                          for job_input in job.inputs)
+                        state = self._state_collection.find_one({'_id': name})
+                        if not force and state is not None and state.get('inputs') == watermarks:
+                            reports[name] = {'name': name, 'status': SKIPPED, 'seconds': 0.0}
+                            continue
+                        running.add(name)
+                        pool.apply_async(run_job, (job, watermarks))
+                    if running:
+                        finished.wait()
+                        running.difference_update(reports)
+        finally:
+            pool.close()
+            pool.join()
+        return [reports[name] for name in sorted(reports)]
@@ -0,0 +1,42 @@
+"""Targeted repair of gaps in a stored thread
+
+Rather than dropping a posts collection and pulling the whole thread again, repair_gaps re-fetches only the time
+windows around the gaps DatabaseHandler.find_gaps reports and merges them in through the idempotent add_posts path.
+"""
+
+
+def repair_gaps(thread, database_handler, gaps, page_limit=100):
+    """Re-fetches the posts around every gap and stores the ones that are missing
+
+    Gaps that share a time window, which happens when many posts were created in the same second, are fetched once.
+
+    :param thread: The thread the gaps were found in
+    :param database_handler: The handler for the thread
+    :param gaps: Gaps returned by DatabaseHandler.find_gaps
+    :param page_limit: The number of posts to ask for in each Graph Api request
+    :type thread: turkey_vulture.FacebookThread
+    :type database_handler: turkey_vulture.DatabaseHandler
+    :type gaps: List[Dict]
+    :type page_limit: int
+    :return: The number of posts fetched
+    :rtype: int
+    """
+    windows = sorted(set((min(gap['after_time'], gap['before_time']), max(gap['after_time'], gap['before_time']))
+                         for gap in gaps))
+    fetched = 0
+    for since, until in _merge_windows(windows):
+        window_posts = thread.fetch_window(since, until, page_limit=page_limit)
+        if window_posts:
+            database_handler.add_posts(window_posts, ignore_duplicates=True)
+            fetched += len(window_posts)
+    return fetched
+
+
+def _merge_windows(windows):
+    merged = []
+    for since, until in windows:
+        if merged and since <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], until))
+        else:
+            merged.append((since, until))
+    return merged
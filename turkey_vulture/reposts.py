@@ -0,0 +1,193 @@
+"""Finds links that were already shared earlier in a thread
+
+RepostIndex keeps one document for every distinct canonical link in the <posts>_first_links collection, keyed by the
+sha1 of the link. The document holds the post that first shared the link and the number of times it has been shared,
+so finding out whether a link is a repost is a single lookup by _id. A Bloom filter of every stored key sits in front
+of the collection and answers for links that were never shared without asking the database at all. Every document is
+stamped with the time it was stored, and once the filter is older than filter_seconds it reads the keys stored since
+before it answers, so links another process stored show up at most that late.
+
+Register RepostIndex.update with DatabaseHandler.add_ingest_hook to keep the index current as posts are added. Posts
+may arrive in any order, as a backfill does, and the index still ends up pointing at the earliest share.
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import pymongo
+
+from turkey_vulture import DatabaseHandler
+from turkey_vulture.links import canonicalize_url
+from turkey_vulture.sketches import BloomFilter
+
+FIRST_LINKS_SUFFIX = '_first_links'
+# Writers stamp stored_at with their own clocks and a write can land after a later stamp was read, so catching up
+# rereads this much from before the newest stamp already loaded
+STORED_AT_OVERLAP = timedelta(minutes=5)
+
+
+def link_key(url):
+    """The key of a canonical link in the first links collection
+
+    :type url: unicode
+    :rtype: str
+    """
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+class RepostIndex:
+    """RepostIndex maintains and queries the first share of every link in one thread
+
+    The Bloom filter is filled from the collection on the first lookup and then kept current by this object's own
+    updates. Links stored by other processes, such as a worker or a tail process, are not in it, so a lookup the filter
+    would answer with never shared first adds the keys stored since the last load once it is older than filter_seconds.
+
+    Attributes:
+        lookups_skipped (int): The number of lookups the Bloom filter answered without the database.
+
+    """
+
+    def __init__(self, database_handler, expected_links=1000000, false_positive_rate=0.01, filter_seconds=60.0,
+                 clock=time.time):
+        """The Initializer for the RepostIndex object
+
+        Args:
+            :param database_handler: The handler for the thread
+            :param expected_links: The number of distinct links the Bloom filter is sized for
+            :param false_positive_rate: The share of never seen links that still cost a lookup
+            :param filter_seconds: How long a loaded Bloom filter is trusted to say a link was never shared
+            :param clock: Returns the current time in seconds
+            :type database_handler: turkey_vulture.DatabaseHandler
+            :type expected_links: int
+            :type false_positive_rate: float
+            :type filter_seconds: float
+            :type clock: Callable[[], float]
+        """
+        self._database_handler = database_handler
+        self._collection = database_handler._db()[database_handler._posts_collection_name + FIRST_LINKS_SUFFIX]
+        self._expected_links = expected_links
+        self._false_positive_rate = false_positive_rate
+        self._filter_seconds = filter_seconds
+        self._clock = clock
+        self._bloom_filter = None
+        self._bloom_filter_loaded = None
+        self._loaded_through = None
+        self.lookups_skipped = 0
+        # Catching up the Bloom filter reads the keys stored after a time
+        self._collection.create_index('stored_at')
+
+    def refresh(self):
+        """Reloads the Bloom filter from every key in the collection"""
+        self._bloom_filter = BloomFilter.for_capacity(self._expected_links, self._false_positive_rate)
+        self._loaded_through = None
+        self._load({})
+
+    def _catch_up(self):
+        """Adds the keys stored since the newest one already in the Bloom filter"""
+        # Documents without a stamp were all there for the full load, the ones written since carry one
+        self._load({'stored_at': {'$exists': True}} if self._loaded_through is None else
+                   {'stored_at': {'$gte': self._loaded_through - STORED_AT_OVERLAP}})
+
+    def _load(self, query):
+        loaded = self._clock()
+        for document in self._collection.find(query, {'_id': 1, 'stored_at': 1}):
+            self._bloom_filter.add(document['_id'])
+            if document.get('stored_at') is not None and (self._loaded_through is None or
+                                                          document['stored_at'] > self._loaded_through):
+                self._loaded_through = document['stored_at']
+        self._bloom_filter_loaded = loaded
+
+    def update(self, post_list):
+        """Adds the links of a batch of stored post documents to the index
+
+        :param post_list: Post documents as stored by add_posts
+        :type post_list: List[Dict]
+        """
+        shares = OrderedDict()
+        for post in post_list:
+            if not post.get('message'):
+                continue
+            for url in set(DatabaseHandler.find_links(post['message'])):
+                key = link_key(url)
+                first_share = {'url': url, 'post_id': post['_id'], 'sender': post['sender'],
+                               'created_time': post['created_time']}
+                if key not in shares:
+                    shares[key] = {'first': first_share, 'count': 0, 'last_seen': post['created_time']}
+                elif post['created_time'] < shares[key]['first']['created_time']:
+                    shares[key]['first'] = first_share
+                shares[key]['count'] += 1
+                shares[key]['last_seen'] = max(shares[key]['last_seen'], post['created_time'])
+
+        operations = []
+        stored_at = datetime.utcnow()
+        for key, share in shares.items():
+            operations.append(pymongo.UpdateOne({'_id': key},
+                                                {'$setOnInsert': dict(share['first'], stored_at=stored_at),
+                                                 '$inc': {'shares': share['count']},
+                                                 '$max': {'last_seen': share['last_seen']}},
+                                                upsert=True))
+            # A batch older than what is stored, such as a backfill, takes over the first share
+            operations.append(pymongo.UpdateOne({'_id': key, 'created_time': {'$gt': share['first']['created_time']}},
+                                                {'$set': share['first']}))
+        if operations:
+            self._collection.bulk_write(operations)
+        if self._bloom_filter is not None:
+            for key in shares:
+                self._bloom_filter.add(key)
+
+    def rebuild(self, batch_size=5000):
+        """Rebuilds the index in one pass over the posts"""
+        self._collection.drop()
+        self._bloom_filter = None
+        batch = []
+        fields = ('_id', 'sender', 'created_time', 'message')
+        for post in self._database_handler.scan_posts(fields, batch_size=batch_size):
+            batch.append(post)
+            if len(batch) == batch_size:
+                self.update(batch)
+                batch = []
+        self.update(batch)
+        self._collection.create_index('stored_at')
+
+    def first_share(self, url):
+        """Finds the first share of a link
+
+        :param url: A link as it appears in a post, it is canonicalized first
+        :type url: unicode
+        :return: The url, post_id, sender and created_time of the first share, the number of repeats since and when
+            the link was last shared, None if the link was never shared
+        :rtype: Dict
+        """
+        if self._bloom_filter is None:
+            self.refresh()
+        key = link_key(canonicalize_url(url))
+        if key not in self._bloom_filter and self._clock() - self._bloom_filter_loaded >= self._filter_seconds:
+            self._catch_up()
+        if key not in self._bloom_filter:
+            self.lookups_skipped += 1
+            return None
+        document = self._collection.find_one({'_id': key})
+        if document is None:
+            return None
+        first_share = dict((field, value) for field, value in document.items()
+                           if field not in ('_id', 'shares', 'stored_at'))
+        first_share['repeats'] = document['shares'] - 1
+        return first_share
+
+    def reposts_in(self, post):
+        """Finds the links of a post that were first shared by an earlier post
+
+        :param post: A stored post document
+        :type post: Dict
+        :return: Pairs of canonical link and its first share, see first_share
+        :rtype: List[Tuple[unicode, Dict]]
+        """
+        reposts = []
+        for url in DatabaseHandler.find_links(post.get('message', u'')):
+            first_share = self.first_share(url)
+            if first_share is not None and first_share['post_id'] != post['_id'] and \
+                    first_share['created_time'] <= post['created_time']:
+                reposts.append((url, first_share))
+        return reposts
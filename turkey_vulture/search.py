@@ -0,0 +1,517 @@
+"""An on-disk inverted index for searching the messages of a thread
+
+Messages are split into terms with DatabaseHandler.tokenize, the same way the word counts split them. An index
+directory holds a segments.json manifest and one directory per segment:
+
+    seq.npy             int64   The sequence id of every post in the segment, sorted
+    created_time.npy    int64   Seconds since the epoch (UTC)
+    sender.npy          int32   An index into senders.json
+    terms.json                  Every term with the offset and block sizes of its posting list in postings.bin
+    postings.bin                The posting lists back to back
+
+A posting list is three blocks of varints: the gaps between the sequence ids of the posts holding the term, the number
+of times the term occurs in each of those posts, and the gaps between those positions within each post. Queries that do
+not need positions never decode the last two blocks. Encoding and decoding are vectorized with NumPy, so a posting list
+of a million posts decodes in milliseconds, and everything is opened with mmap, so only the lists a query touches are
+read from disk.
+
+SearchIndex.update writes every batch it is given as a new segment and merges segments once merge_factor of them have
+grown to about the same size, so each post is rewritten a logarithmic number of times however large the index grows.
+Register SearchIndex.update with DatabaseHandler.add_ingest_hook to keep the index current as posts are added.
+"""
+
+import calendar
+import errno
+import fcntl
+import json
+import mmap
+import os
+import re
+import shutil
+from collections import defaultdict
+from datetime import datetime
+
+import numpy
+
+from turkey_vulture import DatabaseHandler
+
+MANIFEST_FILE = 'segments.json'
+LOCK_FILE = 'index.lock'
+SEGMENT_DIRECTORY_FORMAT = 'segment_{0:08d}'
+TERMS_FILE = 'terms.json'
+SENDERS_FILE = 'senders.json'
+POSTINGS_FILE = 'postings.bin'
+COLUMNS = ('seq', 'created_time', 'sender')
+# Positions are packed with the sequence id into one int64 for phrase matching, so longer posts are cut off here
+POSITION_LIMIT = 1 << 20
+
+QUERY_TOKEN_REGEX = re.compile(r'(-?)(?:"([^"]*)"|(\S+))')
+OR_OPERATOR = 'OR'
+
+
+def _to_timestamp(value):
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    return value
+
+
+def _encode_varints(values):
+    """Encodes non negative integers as little endian base 128 varints
+
+    :type values: numpy.ndarray
+    :rtype: str
+    """
+    values = numpy.asarray(values, dtype=numpy.int64)
+    lengths = numpy.ones(len(values), dtype=numpy.int64)
+    remaining = values >> 7
+    while remaining.any():
+        lengths += remaining > 0
+        remaining >>= 7
+    repeated = numpy.repeat(values, lengths)
+    byte_index = numpy.arange(len(repeated)) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    encoded = (repeated >> (7 * byte_index)) & 0x7f
+    encoded[byte_index < numpy.repeat(lengths, lengths) - 1] |= 0x80
+    return encoded.astype(numpy.uint8).tostring()
+
+
+def _decode_varints(data):
+    """Decodes the varints written by _encode_varints
+
+    :type data: str
+    :rtype: numpy.ndarray
+    """
+    encoded = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int64)
+    if not len(encoded):
+        return numpy.zeros(0, dtype=numpy.int64)
+    ends = (encoded & 0x80) == 0
+    starts = numpy.flatnonzero(numpy.concatenate(([True], ends[:-1])))
+    value_index = numpy.concatenate(([0], numpy.cumsum(ends)[:-1]))
+    byte_index = numpy.arange(len(encoded)) - starts[value_index]
+    return numpy.add.reduceat((encoded & 0x7f) << (7 * byte_index), starts)
+
+
+def _encode_posting_list(seqs, counts, positions):
+    """Encodes the posts holding a term, how often and where
+
+    :param seqs: The sorted sequence ids
+    :param counts: The number of positions of every post
+    :param positions: The sorted positions of every post back to back
+    :return: The seq, count and position blocks
+    :rtype: Tuple[str, str, str]
+    """
+    seq_gaps = numpy.diff(numpy.concatenate(([0], seqs)))
+    position_gaps = numpy.diff(numpy.concatenate(([0], positions)))
+    # The first position of every post is stored as is rather than as a gap from the post before
+    position_gaps[numpy.cumsum(counts) - counts] = positions[numpy.cumsum(counts) - counts]
+    return _encode_varints(seq_gaps), _encode_varints(counts), _encode_varints(position_gaps)
+
+
+def _first_of_runs(sorted_values):
+    """A mask of the values that differ from the one before them"""
+    first = numpy.ones(len(sorted_values), dtype=bool)
+    first[1:] = sorted_values[1:] != sorted_values[:-1]
+    return first
+
+
+def _positions_from_gaps(counts, position_gaps):
+    running = numpy.cumsum(position_gaps)
+    starts = numpy.cumsum(counts) - counts
+    return running - numpy.repeat(running[starts] - position_gaps[starts], counts)
+
+
+def parse_query(query):
+    """Parses a query into clauses of phrases that must and must not appear
+
+    Words next to each other must all appear, OR separates alternatives, a quoted phrase must appear as written and a
+    leading - excludes a word or phrase. Words are split like messages, so a word that splits into several terms is
+    matched as a phrase.
+
+    :param query: A query such as: pizza "friday night" OR tacos -salsa
+    :type query: unicode
+    :return: The alternatives, each a pair of required and excluded phrases, every phrase a tuple of terms
+    :rtype: List[Tuple[List[Tuple[str]], List[Tuple[str]]]]
+    """
+    clauses = [([], [])]
+    for match in QUERY_TOKEN_REGEX.finditer(query):
+        negated, quoted, word = match.groups()
+        if word == OR_OPERATOR and not negated:
+            clauses.append(([], []))
+            continue
+        phrase = tuple(DatabaseHandler.tokenize(quoted if quoted is not None else word))
+        if phrase:
+            clauses[-1][1 if negated else 0].append(phrase)
+    return [clause for clause in clauses if clause[0] or clause[1]]
+
+
+class _Segment:
+    """A read only, memory mapped segment directory"""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, TERMS_FILE)) as terms_file:
+            self.terms = json.load(terms_file)
+        with open(os.path.join(directory, SENDERS_FILE)) as senders_file:
+            self.senders = json.load(senders_file)
+        for column in COLUMNS:
+            setattr(self, column, numpy.load(os.path.join(directory, column + '.npy'), mmap_mode='r'))
+
+        self._postings_file = open(os.path.join(directory, POSTINGS_FILE), 'rb')
+        if os.fstat(self._postings_file.fileno()).st_size:
+            self._postings = mmap.mmap(self._postings_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._postings = b''
+
+    @staticmethod
+    def write(directory, seqs, created_times, senders, sender_list, postings):
+        """Writes a segment from columns sorted by seq and decoded posting lists
+
+        :param postings: The seqs, counts and positions of every term, see _encode_posting_list
+        :type postings: Dict[str, Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]]
+        """
+        os.makedirs(directory)
+        numpy.save(os.path.join(directory, 'seq.npy'), numpy.asarray(seqs, dtype=numpy.int64))
+        numpy.save(os.path.join(directory, 'created_time.npy'), numpy.asarray(created_times, dtype=numpy.int64))
+        numpy.save(os.path.join(directory, 'sender.npy'), numpy.asarray(senders, dtype=numpy.int32))
+        terms = {}
+        offset = 0
+        with open(os.path.join(directory, POSTINGS_FILE), 'wb') as postings_file:
+            for term in sorted(postings):
+                blocks = _encode_posting_list(*postings[term])
+                terms[term] = [offset] + [len(block) for block in blocks]
+                for block in blocks:
+                    postings_file.write(block)
+                offset += sum(len(block) for block in blocks)
+            postings_file.flush()
+            os.fsync(postings_file.fileno())
+        with open(os.path.join(directory, TERMS_FILE), 'w') as terms_file:
+            json.dump(terms, terms_file, separators=(',', ':'))
+        with open(os.path.join(directory, SENDERS_FILE), 'w') as senders_file:
+            json.dump(sender_list, senders_file)
+
+    def __len__(self):
+        return len(self.seq)
+
+    def _blocks(self, term):
+        offset, seq_bytes, count_bytes, position_bytes = self.terms[term]
+        count_offset = offset + seq_bytes
+        position_offset = count_offset + count_bytes
+        return (self._postings[offset:count_offset], self._postings[count_offset:position_offset],
+                self._postings[position_offset:position_offset + position_bytes])
+
+    def term_seqs(self, term):
+        """The sorted sequence ids of the posts holding a term"""
+        if term not in self.terms:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.cumsum(_decode_varints(self._blocks(term)[0]))
+
+    def posting_list(self, term):
+        """The seqs, counts and positions of a term, see _encode_posting_list"""
+        seq_block, count_block, position_block = self._blocks(term)
+        counts = _decode_varints(count_block)
+        return (numpy.cumsum(_decode_varints(seq_block)), counts,
+                _positions_from_gaps(counts, _decode_varints(position_block)))
+
+    def phrase_seqs(self, phrase):
+        """The sorted sequence ids of the posts holding every term of a phrase one after the other"""
+        if len(phrase) == 1:
+            return self.term_seqs(phrase[0])
+        if any(term not in self.terms for term in phrase):
+            return numpy.zeros(0, dtype=numpy.int64)
+        matches = None
+        # Every occurrence is keyed by its post and the position the phrase would have to start at
+        for index, term in enumerate(phrase):
+            seqs, counts, positions = self.posting_list(term)
+            starts = positions - index
+            keys = (numpy.repeat(seqs, counts) * POSITION_LIMIT + starts)[starts >= 0]
+            matches = keys if matches is None else numpy.intersect1d(matches, keys, assume_unique=True)
+            if not len(matches):
+                break
+        return numpy.unique(matches // POSITION_LIMIT)
+
+    def search(self, clauses, sender=None, start=None, end=None):
+        """The sorted sequence ids of the posts matching parsed query clauses and filters"""
+        results = []
+        for required, excluded in clauses:
+            matches = None
+            for phrase in sorted(required, key=lambda phrase: min(self.terms.get(term, [0, 0])[1] for term in phrase)):
+                seqs = self.phrase_seqs(phrase)
+                matches = seqs if matches is None else numpy.intersect1d(matches, seqs, assume_unique=True)
+                if not len(matches):
+                    break
+            if matches is None:
+                matches = numpy.asarray(self.seq)
+            for phrase in excluded:
+                if len(matches):
+                    matches = numpy.setdiff1d(matches, self.phrase_seqs(phrase), assume_unique=True)
+            results.append(matches)
+        matches = numpy.unique(numpy.concatenate(results)) if len(results) > 1 else results[0]
+
+        if sender is None and start is None and end is None:
+            return matches
+        rows = numpy.searchsorted(self.seq, matches)
+        keep = numpy.ones(len(rows), dtype=bool)
+        if sender is not None:
+            if sender not in self.senders:
+                return numpy.zeros(0, dtype=numpy.int64)
+            keep &= self.sender[rows] == self.senders.index(sender)
+        if start is not None:
+            keep &= self.created_time[rows] >= _to_timestamp(start)
+        if end is not None:
+            keep &= self.created_time[rows] < _to_timestamp(end)
+        return matches[keep]
+
+    def close(self):
+        if not isinstance(self._postings, bytes):
+            self._postings.close()
+        self._postings_file.close()
+
+
+class SearchIndex:
+    """SearchIndex maintains and queries the inverted index of one thread in a directory
+
+    Writers hold a lock on the directory, so several processes can add to the same index. The manifest is replaced
+    atomically, so readers see a batch either completely or not at all and pick up new segments on their next search.
+    """
+
+    def __init__(self, directory, merge_factor=8):
+        """The Initializer for the SearchIndex object
+
+        Args:
+            :param directory: The index directory, created if it does not exist
+            :param merge_factor: The number of segments of about the same size that are merged into one
+            :type directory: str
+            :type merge_factor: int
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self._merge_factor = merge_factor
+        self._segments = {}
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.directory, MANIFEST_FILE)) as manifest_file:
+                return json.load(manifest_file)
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return {'next_segment': 0, 'segments': []}
+
+    def _write_manifest(self, manifest):
+        temporary_path = os.path.join(self.directory, MANIFEST_FILE + '.tmp')
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.rename(temporary_path, os.path.join(self.directory, MANIFEST_FILE))
+
+    def _lock(self):
+        lock_file = open(os.path.join(self.directory, LOCK_FILE), 'a')
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        return lock_file
+
+    def _open_segments(self):
+        """Opens the segments in the manifest, closing the ones a merge has replaced"""
+        for attempt in range(2):
+            names = [segment['name'] for segment in self._read_manifest()['segments']]
+            try:
+                for name in names:
+                    if name not in self._segments:
+                        self._segments[name] = _Segment(os.path.join(self.directory, name))
+                break
+            except (IOError, OSError) as error:
+                # A merge removed a segment between reading the manifest and opening it, the next manifest has it
+                if error.errno != errno.ENOENT or attempt:
+                    raise
+        for name in set(self._segments) - set(names):
+            self._segments.pop(name).close()
+        return [self._segments[name] for name in names]
+
+    def _add_segment(self, manifest, seqs, created_times, senders, sender_list, postings):
+        name = SEGMENT_DIRECTORY_FORMAT.format(manifest['next_segment'])
+        _Segment.write(os.path.join(self.directory, name), seqs, created_times, senders, sender_list, postings)
+        manifest['next_segment'] += 1
+        manifest['segments'].append({'name': name, 'posts': len(seqs)})
+
+    def update(self, post_list):
+        """Adds a batch of stored post documents to the index as a new segment
+
+        :param post_list: Post documents as stored by add_posts
+        :type post_list: List[Dict]
+        """
+        if not post_list:
+            return
+        post_list = sorted(post_list, key=lambda post: post['seq'])
+        sender_indexes = {}
+        sender_list = []
+        senders = []
+        term_posts = defaultdict(lambda: defaultdict(list))
+        for post in post_list:
+            if post['sender'] not in sender_indexes:
+                sender_indexes[post['sender']] = len(sender_list)
+                sender_list.append(post['sender'])
+            senders.append(sender_indexes[post['sender']])
+            terms = DatabaseHandler.tokenize(post['message']) if post.get('message') else []
+            for position, term in enumerate(terms[:POSITION_LIMIT]):
+                term_posts[term][post['seq']].append(position)
+
+        postings = {}
+        for term, posts in term_posts.items():
+            seqs = sorted(posts)
+            postings[term] = (numpy.array(seqs, dtype=numpy.int64),
+                              numpy.array([len(posts[seq]) for seq in seqs], dtype=numpy.int64),
+                              numpy.array([position for seq in seqs for position in posts[seq]], dtype=numpy.int64))
+
+        lock_file = self._lock()
+        try:
+            manifest = self._read_manifest()
+            self._add_segment(manifest, [post['seq'] for post in post_list],
+                              [_to_timestamp(post['created_time']) for post in post_list], senders, sender_list,
+                              postings)
+            self._write_manifest(manifest)
+            self._merge_levels(manifest)
+        finally:
+            lock_file.close()
+
+    def _level(self, posts):
+        level = 0
+        while posts >= self._merge_factor:
+            posts //= self._merge_factor
+            level += 1
+        return level
+
+    def _merge_levels(self, manifest):
+        while True:
+            levels = defaultdict(list)
+            for segment in manifest['segments']:
+                levels[self._level(segment['posts'])].append(segment['name'])
+            full_levels = [names for names in levels.values() if len(names) >= self._merge_factor]
+            if not full_levels:
+                return
+            self._merge(manifest, full_levels[0])
+
+    def _merge(self, manifest, names):
+        """Replaces segments with a single segment holding all of their posts"""
+        segments = [_Segment(os.path.join(self.directory, name)) for name in names]
+        try:
+            sender_list = []
+            for segment in segments:
+                sender_list.extend(sender for sender in segment.senders if sender not in sender_list)
+            seqs = numpy.concatenate([segment.seq for segment in segments])
+            created_times = numpy.concatenate([segment.created_time for segment in segments])
+            senders = numpy.concatenate([numpy.array([sender_list.index(sender) for sender in segment.senders],
+                                                     dtype=numpy.int32)[segment.sender] for segment in segments])
+            order = numpy.argsort(seqs, kind='mergesort')
+            # A post indexed twice, as by an update racing a rebuild, is kept once
+            order = order[_first_of_runs(seqs[order])]
+
+            postings = {}
+            for term in set(term for segment in segments for term in segment.terms):
+                term_seqs, counts, positions = zip(*[segment.posting_list(term) for segment in segments
+                                                     if term in segment.terms])
+                term_seqs, counts, positions = (numpy.concatenate(term_seqs), numpy.concatenate(counts),
+                                                numpy.concatenate(positions))
+                # Reorder whole runs of positions along with the posts they belong to
+                term_order = numpy.argsort(term_seqs, kind='mergesort')
+                ordered_seqs = term_seqs[term_order]
+                ordered_counts = counts[term_order]
+                run_starts = (numpy.cumsum(counts) - counts)[term_order]
+                ordered_starts = numpy.cumsum(ordered_counts) - ordered_counts
+                position_order = (numpy.repeat(run_starts - ordered_starts, ordered_counts) +
+                                  numpy.arange(len(positions)))
+                first = _first_of_runs(ordered_seqs)
+                postings[term] = (ordered_seqs[first], ordered_counts[first],
+                                  positions[position_order][numpy.repeat(first, ordered_counts)])
+
+            self._add_segment(manifest, seqs[order], created_times[order], senders[order], sender_list, postings)
+        finally:
+            for segment in segments:
+                segment.close()
+        manifest['segments'] = [segment for segment in manifest['segments'] if segment['name'] not in names]
+        self._write_manifest(manifest)
+        for name in names:
+            shutil.rmtree(os.path.join(self.directory, name))
+
+    def optimize(self):
+        """Merges every segment into one, which makes searches as fast as they get"""
+        lock_file = self._lock()
+        try:
+            manifest = self._read_manifest()
+            if len(manifest['segments']) > 1:
+                self._merge(manifest, [segment['name'] for segment in manifest['segments']])
+        finally:
+            lock_file.close()
+
+    def rebuild(self, database_handler, batch_size=5000):
+        """Rebuilds the index in one pass over the posts of a thread
+
+        The ingest hook keeps adding posts while the rebuild runs, so a post can be indexed by both. Merges and
+        searches drop the second copy.
+
+        :param database_handler: The handler for the thread
+        :type database_handler: turkey_vulture.DatabaseHandler
+        """
+        lock_file = self._lock()
+        try:
+            manifest = self._read_manifest()
+            old_names = [segment['name'] for segment in manifest['segments']]
+            manifest['segments'] = []
+            self._write_manifest(manifest)
+            for name in old_names:
+                shutil.rmtree(os.path.join(self.directory, name))
+        finally:
+            lock_file.close()
+
+        batch = []
+        for post in database_handler.scan_posts(('seq', 'sender', 'created_time', 'message'), batch_size=batch_size):
+            batch.append(post)
+            if len(batch) == batch_size:
+                self.update(batch)
+                batch = []
+        self.update(batch)
+        self.optimize()
+
+    def __len__(self):
+        return sum(segment['posts'] for segment in self._read_manifest()['segments'])
+
+    def search(self, query, sender=None, start=None, end=None, limit=None):
+        """Finds the posts matching a query, see parse_query for the syntax
+
+        :param query: The query
+        :param sender: The id of the sender the posts must be from, None for anyone
+        :param start: The inclusive start of the time range as a datetime or epoch seconds, None for no lower bound
+        :param end: The exclusive end of the time range as a datetime or epoch seconds, None for no upper bound
+        :param limit: The most sequence ids to return, None for all of them
+        :type query: unicode
+        :type sender: str
+        :type limit: int
+        :return: The sequence ids of the matching posts, newest first
+        :rtype: List[int]
+        """
+        clauses = parse_query(query)
+        if not clauses:
+            return []
+        matches = [segment.search(clauses, sender, start, end) for segment in self._open_segments()]
+        if not matches:
+            return []
+        # A post is in two segments when an update raced a rebuild, until the segments are merged
+        seqs = numpy.unique(numpy.concatenate(matches))[::-1]
+        return [int(seq) for seq in seqs[:limit]]
+
+    def close(self):
+        for segment in self._segments.values():
+            segment.close()
+        self._segments = {}
+
+
+def find_posts(database_handler, seqs):
+    """Reads the posts found by SearchIndex.search from the database
+
+    :param database_handler: The handler for the thread
+    :param seqs: Sequence ids as returned by SearchIndex.search
+    :type database_handler: turkey_vulture.DatabaseHandler
+    :type seqs: List[int]
+    :return: The post documents in the order of seqs
+    :rtype: List[Dict]
+    """
+    posts = dict((post['seq'], post) for post in database_handler._posts_collection().find({'seq': {'$in': seqs}}))
+    return [posts[seq] for seq in seqs if seq in posts]
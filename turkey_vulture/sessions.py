@@ -0,0 +1,129 @@
+"""Splits a thread into conversation sessions
+
+A session is a run of posts where no post comes more than gap_seconds after the one before it. update_sessions streams
+the posts once in created_time order, stores the number of its session in the session field of every post and keeps one
+summary document per session in the <posts>_sessions collection. Session numbers start at 0 and follow time order.
+
+Only the last session can still grow, so a later call continues from the end of the last stored session and either
+extends it or starts new ones. Posts that are stored later with an older created_time, as a backfill does, are only
+placed in a session after a rebuild.
+"""
+
+from datetime import timedelta
+
+import pymongo
+
+from turkey_vulture import DatabaseHandler
+
+SESSIONS_SUFFIX = '_sessions'
+DEFAULT_GAP_SECONDS = 30 * 60
+
+
+def _collection(database_handler):
+    return database_handler._db()[database_handler._posts_collection_name + SESSIONS_SUFFIX]
+
+
+def update_sessions(database_handler, gap_seconds=DEFAULT_GAP_SECONDS, batch_size=5000, rebuild=False):
+    """Places the posts created since the last call into sessions
+
+    Every summary document holds the start and end time of the session, the seq of its first and last post, the sorted
+    ids of its participants, its number of posts and the links posted in it.
+
+    :param database_handler: The handler for the thread
+    :param gap_seconds: The longest silence inside a session
+    :param batch_size: The number of posts read and labelled at a time
+    :param rebuild: Drop the summaries and split the whole thread again
+    :type database_handler: turkey_vulture.DatabaseHandler
+    :type gap_seconds: float
+    :type batch_size: int
+    :type rebuild: bool
+    :return: The number of posts processed
+    :rtype: int
+    """
+    collection = _collection(database_handler)
+    posts_collection = database_handler._posts_collection()
+    if rebuild:
+        collection.drop()
+
+    session = collection.find_one(sort=[('_id', pymongo.DESCENDING)])
+    query = {}
+    if session is not None:
+        query = {'$or': [{'created_time': {'$gt': session['end']}},
+                         {'created_time': session['end'], 'seq': {'$gt': session['last_seq']}}]}
+        session['participants'] = set(session['participants'])
+    posts_collection.create_index([('created_time', pymongo.ASCENDING), ('seq', pymongo.ASCENDING)])
+    cursor = database_handler.scan_posts(('_id', 'sender', 'created_time', 'seq', 'message'), query,
+                                         sort=[('created_time', pymongo.ASCENDING), ('seq', pymongo.ASCENDING)],
+                                         batch_size=batch_size)
+
+    gap = timedelta(seconds=gap_seconds)
+    post_ids = []
+    processed = 0
+
+    def label_posts():
+        if post_ids:
+            posts_collection.update_many({'_id': {'$in': post_ids}}, {'$set': {'session': session['_id']}})
+            del post_ids[:]
+
+    def save_session():
+        # Posts are labelled before their summary is saved, so a crash in between is repaired by running again
+        label_posts()
+        collection.replace_one({'_id': session['_id']}, dict(session, participants=sorted(session['participants'])),
+                               upsert=True)
+
+    for post in cursor:
+        if session is None or post['created_time'] - session['end'] > gap:
+            if processed:
+                save_session()
+            session = {'_id': 0 if session is None else session['_id'] + 1,
+                       'start': post['created_time'], 'first_seq': post['seq'],
+                       'participants': set(), 'posts': 0, 'links': []}
+        session['end'] = post['created_time']
+        session['last_seq'] = post['seq']
+        session['participants'].add(post['sender'])
+        session['posts'] += 1
+        if 'message' in post:
+            session['links'].extend(DatabaseHandler.find_links(post['message']))
+        post_ids.append(post['_id'])
+        if len(post_ids) == batch_size:
+            label_posts()
+        processed += 1
+
+    if processed:
+        save_session()
+    posts_collection.create_index('session')
+    collection.create_index('start')
+    return processed
+
+
+def sessions_in_range(database_handler, start=None, end=None):
+    """Reads the summaries of the sessions that overlap [start, end)
+
+    :param database_handler: The handler for the thread
+    :param start: The inclusive start of the range, None for no lower bound
+    :param end: The exclusive end of the range, None for no upper bound
+    :type database_handler: turkey_vulture.DatabaseHandler
+    :type start: datetime
+    :type end: datetime
+    :return: The session summaries, oldest first
+    :rtype: List[Dict]
+    """
+    query = {}
+    if start is not None:
+        query['end'] = {'$gte': start}
+    if end is not None:
+        query['start'] = {'$lt': end}
+    return list(_collection(database_handler).find(query, sort=[('_id', pymongo.ASCENDING)]))
+
+
+def session_posts(database_handler, session_id):
+    """Reads the posts of one session in time order
+
+    :param database_handler: The handler for the thread
+    :param session_id: The number of the session
+    :type database_handler: turkey_vulture.DatabaseHandler
+    :type session_id: int
+    :rtype: pymongo.cursor.Cursor
+    """
+    return database_handler._posts_collection().find(
+        {'session': session_id}, sort=[('created_time', pymongo.ASCENDING), ('seq', pymongo.ASCENDING)])
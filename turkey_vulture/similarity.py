@@ -0,0 +1,256 @@
+"""Who writes like whom: TF-IDF vocabulary similarity between a thread's participants
+
+VocabularySimilarity holds a sparse sender x term matrix of word counts, split with DatabaseHandler.tokenize like every
+other word count. Rows are TF-IDF weighted and scaled to unit length, so the cosine similarity of every pair of senders
+is a single sparse matrix product. The counts come either from the _words_by_user collection that
+posts_by_user_aggregation writes, or straight from the posts of a time range.
+
+Results are saved as compressed .npz files. VocabularySimilarity.cached keeps one file per time range and only rebuilds
+it when the number of posts in that range has changed, so recomputing a series of windows only rereads the windows new
+posts landed in.
+"""
+
+import hashlib
+import os
+from datetime import timedelta
+
+import numpy
+import pymongo
+import scipy.sparse
+
+from turkey_vulture import SCAN_BATCH_SIZE, DatabaseHandler
+
+DEFAULT_WINDOW = timedelta(days=30)
+
+
+def _range_query(start, end):
+    query = {}
+    if start is not None:
+        query['$gte'] = start
+    if end is not None:
+        query['$lt'] = end
+    return {'created_time': query} if query else {}
+
+
+class VocabularySimilarity:
+    """VocabularySimilarity is the word usage of every sender of one thread over a time range
+
+    Attributes:
+        sender_ids (List[str]): The id of every sender, in row order.
+        terms (List[unicode]): Every term, in column order.
+        counts (scipy.sparse.csr_matrix): counts[i, j] is how often sender i used term j.
+        posts (int): The number of posts the counts were taken from, -1 when they came from _words_by_user.
+
+    """
+
+    def __init__(self, sender_ids, terms, counts, posts=-1):
+        self.sender_ids = list(sender_ids)
+        self.terms = list(terms)
+        self.counts = scipy.sparse.csr_matrix(counts, dtype=numpy.int64)
+        self.posts = posts
+        self._sender_indexes = dict((sender_id, index) for index, sender_id in enumerate(self.sender_ids))
+        self._similarity = None
+
+    @classmethod
+    def _from_pairs(cls, pairs, posts=-1):
+        """Builds the matrix from (sender, term, count) triples, repeated pairs are summed"""
+        sender_indexes = {}
+        term_indexes = {}
+        rows = []
+        columns = []
+        values = []
+        for sender, term, count in pairs:
+            rows.append(sender_indexes.setdefault(sender, len(sender_indexes)))
+            columns.append(term_indexes.setdefault(term, len(term_indexes)))
+            values.append(count)
+        sender_ids = sorted(sender_indexes, key=sender_indexes.get)
+        terms = sorted(term_indexes, key=term_indexes.get)
+        counts = scipy.sparse.coo_matrix((numpy.array(values, dtype=numpy.int64), (rows, columns)),
+                                         shape=(len(sender_ids), len(terms))).tocsr()
+        return cls(sender_ids, terms, counts, posts)
+
+    @classmethod
+    def from_words_by_user(cls, database_handler):
+        """Builds the matrix from the _words_by_user collection written by posts_by_user_aggregation
+
+        :param database_handler: The handler for the thread
+        :type database_handler: turkey_vulture.DatabaseHandler
+        :rtype: VocabularySimilarity
+        """
+        collection = database_handler._db()[database_handler._posts_collection_name + '_words_by_user']
+        return cls._from_pairs((document['_id']['sender'], document['_id']['word'], document['count'])
+                               for document in collection.find({}, {'count': 1}))
+
+    @classmethod
+    def build(cls, database_handler, start=None, end=None, batch_size=SCAN_BATCH_SIZE):
+        """Builds the matrix from the posts created in [start, end)
+
+        :param database_handler: The handler for the thread
+        :param start: The inclusive start of the range, None for the first post
+        :param end: The exclusive end of the range, None for the last post
+        :param batch_size: The number of documents the cursor pulls from the server at a time
+        :type database_handler: turkey_vulture.DatabaseHandler
+        :type start: datetime
+        :type end: datetime
+        :type batch_size: int
+        :rtype: VocabularySimilarity
+        """
+        posts = [0]
+
+        def pairs():
+            for document in database_handler.scan_posts(('sender', 'message'), _range_query(start, end),
+                                                        batch_size=batch_size):
+                posts[0] += 1
+                for term in DatabaseHandler.tokenize(document.get('message') or u''):
+                    yield document['sender'], term, 1
+
+        similarity = cls._from_pairs(pairs())
+        similarity.posts = posts[0]
+        return similarity
+
+    def tfidf(self, sublinear_tf=True):
+        """Weights the counts by TF-IDF and scales every row to unit length
+
+        Each sender is one document. Terms every sender uses get the lowest weight, and with sublinear_tf a word used a
+        thousand times does not drown out the rest of a sender's vocabulary.
+
+        :param sublinear_tf: Use 1 + log(count) rather than the count as the term frequency
+        :type sublinear_tf: bool
+        :rtype: scipy.sparse.csr_matrix
+        """
+        weights = self.counts.astype(numpy.float64)
+        if sublinear_tf:
+            weights.data = 1 + numpy.log(weights.data)
+        senders = self.counts.shape[0]
+        document_frequency = numpy.bincount(self.counts.indices, minlength=self.counts.shape[1])
+        idf = numpy.log((1.0 + senders) / (1.0 + document_frequency)) + 1
+        if not senders:
+            return weights
+        weights = weights.dot(scipy.sparse.diags(idf, 0)).tocsr()
+        lengths = numpy.sqrt(numpy.asarray(weights.multiply(weights).sum(axis=1)).ravel())
+        return scipy.sparse.diags(1.0 / numpy.maximum(lengths, 1e-300), 0).dot(weights).tocsr()
+
+    def similarity(self):
+        """The cosine similarity of every pair of senders
+
+        :return: A square matrix in sender_ids order with ones on the diagonal for every sender with any words
+        :rtype: numpy.ndarray
+        """
+        if self._similarity is None:
+            weights = self.tfidf()
+            self._similarity = weights.dot(weights.T).toarray()
+        return self._similarity
+
+    def most_similar(self, sender_id, k=10):
+        """Finds the senders whose vocabulary is closest to that of sender_id
+
+        :param sender_id: The sender to compare the others to
+        :param k: The number of senders to return
+        :type sender_id: str
+        :type k: int
+        :return: Pairs of sender id and cosine similarity, most similar first
+        :rtype: List[Tuple[str, float]]
+        """
+        if sender_id not in self._sender_indexes:
+            return []
+        scores = self.similarity()[self._sender_indexes[sender_id]].copy()
+        scores[self._sender_indexes[sender_id]] = -1
+        order = numpy.argsort(-scores, kind='mergesort')[:k]
+        return [(self.sender_ids[index], float(scores[index])) for index in order if scores[index] > 0]
+
+    def distinctive_terms(self, sender_id, k=10):
+        """Finds the terms with the highest TF-IDF weight for a sender, the words that set them apart
+
+        :type sender_id: str
+        :type k: int
+        :return: Pairs of term and weight, highest first
+        :rtype: List[Tuple[unicode, float]]
+        """
+        if sender_id not in self._sender_indexes:
+            return []
+        row = self.tfidf().getrow(self._sender_indexes[sender_id])
+        order = numpy.argsort(-row.data, kind='mergesort')[:k]
+        return [(self.terms[row.indices[index]], float(row.data[index])) for index in order]
+
+    def save(self, path):
+        """Writes the counts and the similarity matrix to a compressed .npz file"""
+        numpy.savez_compressed(path, sender_ids=numpy.array(self.sender_ids, dtype=numpy.unicode_),
+                               terms=numpy.array(self.terms, dtype=numpy.unicode_),
+                               data=self.counts.data, indices=self.counts.indices, indptr=self.counts.indptr,
+                               shape=numpy.array(self.counts.shape), posts=numpy.array(self.posts),
+                               similarity=self.similarity())
+
+    @classmethod
+    def load(cls, path):
+        """Reads a file written by save
+
+        :param path: The .npz file
+        :type path: str
+        :rtype: VocabularySimilarity
+        """
+        saved = numpy.load(path)
+        try:
+            counts = scipy.sparse.csr_matrix((saved['data'], saved['indices'], saved['indptr']),
+                                             shape=tuple(saved['shape']))
+            similarity = cls([unicode(sender_id) for sender_id in saved['sender_ids']],
+                             [unicode(term) for term in saved['terms']], counts, int(saved['posts']))
+            similarity._similarity = saved['similarity']
+            return similarity
+        finally:
+            saved.close()
+
+    @classmethod
+    def cached(cls, database_handler, directory, start=None, end=None):
+        """Loads the saved result for [start, end) from directory, rebuilding it if the range holds other posts now
+
+        :param database_handler: The handler for the thread
+        :param directory: The directory results are saved in, created if it does not exist
+        :param start: The inclusive start of the range, None for the first post
+        :param end: The exclusive end of the range, None for the last post
+        :type database_handler: turkey_vulture.DatabaseHandler
+        :type directory: str
+        :type start: datetime
+        :type end: datetime
+        :rtype: VocabularySimilarity
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        range_key = hashlib.sha1(repr((database_handler._posts_collection_name, start, end))).hexdigest()
+        path = os.path.join(directory, 'similarity_{0}.npz'.format(range_key))
+        posts = database_handler._posts_collection().find(_range_query(start, end)).count()
+        if os.path.exists(path):
+            similarity = cls.load(path)
+            if similarity.posts == posts:
+                return similarity
+        similarity = cls.build(database_handler, start, end)
+        temp_path = '{0}.{1}.tmp.npz'.format(path[:-len('.npz')], os.getpid())
+        similarity.save(temp_path)
+        os.rename(temp_path, path)
+        return similarity
+
+    @classmethod
+    def windows(cls, database_handler, directory, window=DEFAULT_WINDOW):
+        """Computes the similarity of every window of a thread, oldest first, see cached
+
+        Windows start at midnight of the day of the first post and are window long.
+
+        :param database_handler: The handler for the thread
+        :param directory: The directory results are saved in
+        :param window: The length of every window
+        :type database_handler: turkey_vulture.DatabaseHandler
+        :type directory: str
+        :type window: timedelta
+        :return: Pairs of window start and its similarity
+        :rtype: List[Tuple[datetime, VocabularySimilarity]]
+        """
+        posts_collection = database_handler._posts_collection()
+        first_post = posts_collection.find_one({}, {'created_time': 1}, sort=[('created_time', pymongo.ASCENDING)])
+        if first_post is None:
+            return []
+        last_post = posts_collection.find_one({}, {'created_time': 1}, sort=[('created_time', pymongo.DESCENDING)])
+        start = first_post['created_time'].replace(hour=0, minute=0, second=0, microsecond=0)
+        results = []
+        while start <= last_post['created_time']:
+            results.append((start, cls.cached(database_handler, directory, start, start + window)))
+            start += window
+        return results
@@ -0,0 +1,445 @@
+"""Small mergeable summaries of streams that are too long to keep in memory
+
+Every sketch here takes values one at a time, can be merged with another sketch of the same kind and can be stored in
+a Mongo document and read back, so a job can pick up where it left off. update_partitions merges new values into
+stored sketch documents without losing the writes of other processes doing the same.
+"""
+
+import hashlib
+import heapq
+import math
+import struct
+
+import numpy
+from bson.binary import Binary
+from pymongo.errors import DuplicateKeyError
+
+
+class QuantileSketch:
+    """QuantileSketch estimates quantiles of positive values with a bounded relative error
+
+    Values are counted in buckets whose bounds grow geometrically, so any quantile it returns is within
+    relative_accuracy of the true value. The number of buckets only grows with the logarithm of the range of the
+    values: with the default accuracy of 1%, values from one second to a year fit in under 900 buckets.
+
+    Attributes:
+        relative_accuracy (float): The largest relative error of a returned quantile.
+        count (int): The number of values added.
+        zero_count (int): The number of values that were zero or less.
+
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._buckets = {}
+        self.count = 0
+        self.zero_count = 0
+
+    def _bucket_index(self, value):
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _bucket_value(self, index):
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def add(self, value, count=1):
+        """Adds a value, count times
+
+        :param value: The value to add
+        :param count: The number of times to add it
+        :type value: float
+        :type count: int
+        """
+        if value <= 0:
+            self.zero_count += count
+        else:
+            index = self._bucket_index(value)
+            self._buckets[index] = self._buckets.get(index, 0) + count
+        self.count += count
+
+    def merge(self, other):
+        """Adds every value counted by another sketch with the same relative_accuracy"""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Cannot merge sketches with different accuracies')
+        for index, count in other._buckets.items():
+            self._buckets[index] = self._buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q):
+        """Estimates a quantile of the added values
+
+        :param q: The quantile, from 0 to 1
+        :type q: float
+        :return: The estimate, None if no values were added
+        :rtype: float
+        """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if rank < seen:
+                return self._bucket_value(index)
+        return self._bucket_value(max(self._buckets))
+
+    def to_document(self):
+        """Builds a document that from_document turns back into an equal sketch
+
+        :rtype: Dict
+        """
+        indexes = sorted(self._buckets)
+        return {'relative_accuracy': self.relative_accuracy, 'count': self.count, 'zero_count': self.zero_count,
+                'indexes': indexes, 'counts': [self._buckets[index] for index in indexes]}
+
+    @classmethod
+    def from_document(cls, document):
+        sketch = cls(document['relative_accuracy'])
+        sketch._buckets = dict(zip(document['indexes'], document['counts']))
+        sketch.count = document['count']
+        sketch.zero_count = document['zero_count']
+        return sketch
+
+
+def update_partitions(collection, partition_ids, merge):
+    """Rewrites the stored document of every partition, retrying the partitions another process wrote meanwhile
+
+    Each document carries a version. A partition is read, merged and written back only if its version is still the one
+    that was read, or inserted only if it still does not exist, so two workers merging into the same partition at once
+    cannot overwrite each other's counts. The partitions that lose the race are read again and merged again.
+
+    :param collection: The collection holding the partition documents
+    :param partition_ids: The _id of every partition to update
+    :param merge: Called with a partition id and its stored document, or None, returns the fields of the new document
+    :type collection: pymongo.collection.Collection
+    :type partition_ids: List[Dict]
+    :type merge: Callable[[Dict, Dict], Dict]
+    """
+    pending = list(partition_ids)
+    while pending:
+        stored = dict((frozenset(document['_id'].items()), document)
+                      for document in collection.find({'_id': {'$in': pending}}))
+        conflicts = []
+        for partition_id in pending:
+            document = stored.get(frozenset(partition_id.items()))
+            fields = merge(partition_id, document)
+            if document is None:
+                try:
+                    collection.insert_one(dict(fields, _id=partition_id, version=1))
+                except DuplicateKeyError:
+                    conflicts.append(partition_id)
+            else:
+                version = document.get('version')
+                result = collection.replace_one({'_id': partition_id, 'version': version},
+                                                dict(fields, version=(version or 0) + 1))
+                if result.matched_count == 0:
+                    conflicts.append(partition_id)
+        pending = conflicts
+
+
+def _hash_pair(item):
+    """Two independent 64 bit hashes of an item that stay the same across processes and runs"""
+    return struct.unpack('<QQ', hashlib.md5(item.encode('utf-8')).digest())
+
+
+class CountMinSketch:
+    """CountMinSketch estimates how often items were added using a fixed amount of memory
+
+    An estimate is never too low, and with probability 1 - delta it is too high by at most epsilon times the total
+    count.
+
+    Attributes:
+        width (int): The number of counters in every row.
+        depth (int): The number of rows, each with its own hash function.
+        total (int): The sum of every count added.
+
+    """
+
+    def __init__(self, width, depth):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self._counts = numpy.zeros((depth, width), dtype=numpy.int64)
+        self._rows = numpy.arange(depth, dtype=numpy.uint64)
+
+    @classmethod
+    def from_error(cls, epsilon=0.005, delta=0.01):
+        """Builds a sketch that overestimates by at most epsilon times the total count with probability 1 - delta"""
+        return cls(int(math.ceil(math.e / epsilon)), int(math.ceil(math.log(1 / delta))))
+
+    def _columns(self, item):
+        first_hash, second_hash = _hash_pair(item)
+        # Double hashing gives every row its own hash function out of just two
+        return (numpy.uint64(first_hash) + self._rows * numpy.uint64(second_hash)) % numpy.uint64(self.width)
+
+    def add(self, item, count=1):
+        self._counts[numpy.arange(self.depth), self._columns(item).astype(numpy.intp)] += count
+        self.total += count
+
+    def update(self, counts):
+        """Adds many items at once
+
+        :param counts: The number of times to add every item
+        :type counts: Dict[unicode, int]
+        """
+        if not counts:
+            return
+        items = list(counts)
+        hashes = numpy.array([_hash_pair(item) for item in items], dtype=numpy.uint64)
+        columns = (hashes[:, 0:1] + hashes[:, 1:2] * self._rows) % numpy.uint64(self.width)
+        rows = numpy.tile(numpy.arange(self.depth), len(items))
+        numpy.add.at(self._counts, (rows, columns.ravel().astype(numpy.intp)),
+                     numpy.repeat([counts[item] for item in items], self.depth))
+        self.total += sum(counts.values())
+
+    def estimate(self, item):
+        """Estimates how often item was added
+
+        :type item: unicode
+        :rtype: int
+        """
+        return int(self._counts[numpy.arange(self.depth), self._columns(item).astype(numpy.intp)].min())
+
+    def merge(self, other):
+        """Adds every count of another sketch with the same dimensions"""
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError('Cannot merge sketches with different dimensions')
+        self._counts += other._counts
+        self.total += other.total
+
+    def to_document(self):
+        return {'width': self.width, 'depth': self.depth, 'total': self.total,
+                'counts': Binary(self._counts.astype('<i8').tostring())}
+
+    @classmethod
+    def from_document(cls, document):
+        sketch = cls(document['width'], document['depth'])
+        sketch._counts = numpy.frombuffer(bytes(document['counts']), dtype='<i8').astype(numpy.int64).reshape(
+            (sketch.depth, sketch.width))
+        sketch.total = document['total']
+        return sketch
+
+
+class SpaceSaving:
+    """SpaceSaving keeps the capacity most frequent items of a stream along with their approximate counts
+
+    Every item counted more than total / capacity times is guaranteed to be kept. A kept count is never too low, and is
+    too high by at most the error recorded with it, which is itself at most total / capacity.
+
+    Attributes:
+        capacity (int): The number of items kept.
+        total (int): The sum of every count added.
+
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.total = 0
+        self._counts = {}
+        self._errors = {}
+        # A heap of (count, item) that may hold outdated entries, which are skipped when they come up
+        self._heap = []
+
+    def _push(self, item):
+        heapq.heappush(self._heap, (self._counts[item], item))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(count, kept_item) for kept_item, count in self._counts.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            count, item = heapq.heappop(self._heap)
+            if self._counts.get(item) == count:
+                return item
+
+    def min_count(self):
+        """The count an item that is not kept may have at most"""
+        if len(self._counts) < self.capacity:
+            return 0
+        while self._counts.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0]
+
+    def add(self, item, count=1):
+        self.total += count
+        if item in self._counts:
+            self._counts[item] += count
+        elif len(self._counts) < self.capacity:
+            self._counts[item] = count
+            self._errors[item] = 0
+        else:
+            # The new item takes over the least counted one and inherits its count as possible error
+            evicted = self._pop_min()
+            evicted_count = self._counts.pop(evicted)
+            del self._errors[evicted]
+            self._counts[item] = evicted_count + count
+            self._errors[item] = evicted_count
+        self._push(item)
+
+    def top(self, k=None):
+        """Returns the most frequent items
+
+        :param k: The number of items to return, all kept items if None
+        :type k: int
+        :return: Tuples of item, count and maximum overestimate, most frequent first
+        :rtype: List[Tuple[unicode, int, int]]
+        """
+        items = heapq.nlargest(k or len(self._counts), self._counts.items(), key=lambda entry: (entry[1], entry[0]))
+        return [(item, count, self._errors[item]) for item, count in items]
+
+    def merge(self, other):
+        """Combines another summary into this one, keeping the bounds of a summary over both streams
+
+        Items kept by only one summary may have been counted up to the smallest kept count of the other one, so that
+        much is added to their count and their error.
+        """
+        own_min = self.min_count()
+        other_min = other.min_count()
+        counts = {}
+        errors = {}
+        for item in set(self._counts) | set(other._counts):
+            counts[item] = self._counts.get(item, own_min) + other._counts.get(item, other_min)
+            errors[item] = self._errors.get(item, own_min) + other._errors.get(item, other_min)
+        kept = heapq.nlargest(self.capacity, counts.items(), key=lambda entry: (entry[1], entry[0]))
+        self._counts = dict(kept)
+        self._errors = dict((item, errors[item]) for item, _ in kept)
+        self._heap = [(count, item) for item, count in kept]
+        heapq.heapify(self._heap)
+        self.total += other.total
+
+    def to_document(self):
+        """Packs the kept items into a document of three binary fields"""
+        items = list(self._counts)
+        return {'capacity': self.capacity, 'total': self.total,
+                'items': Binary(u'\0'.join(items).encode('utf-8')),
+                'counts': Binary(numpy.array([self._counts[item] for item in items], dtype='<i8').tostring()),
+                'errors': Binary(numpy.array([self._errors[item] for item in items], dtype='<i8').tostring())}
+
+    @classmethod
+    def from_document(cls, document):
+        summary = cls(document['capacity'])
+        summary.total = document['total']
+        items_blob = bytes(document['items'])
+        items = items_blob.decode('utf-8').split(u'\0') if items_blob else []
+        counts = numpy.frombuffer(bytes(document['counts']), dtype='<i8').tolist()
+        errors = numpy.frombuffer(bytes(document['errors']), dtype='<i8').tolist()
+        summary._counts = dict(zip(items, counts))
+        summary._errors = dict(zip(items, errors))
+        summary._heap = [(count, item) for item, count in summary._counts.items()]
+        heapq.heapify(summary._heap)
+        return summary
+
+
+class HyperLogLog:
+    """HyperLogLog estimates the number of distinct items added with 2 ** precision one byte registers
+
+    The standard error of an estimate is about 1.04 / sqrt(2 ** precision), which is 1.6% for the default precision of
+    12 and its 4 KB of registers. Merging keeps the larger of every pair of registers, which gives exactly the sketch of
+    both streams together.
+
+    Attributes:
+        precision (int): The number of hash bits that pick a register.
+
+    """
+
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError('precision must be between 4 and 16')
+        self.precision = precision
+        self._registers = numpy.zeros(1 << precision, dtype=numpy.uint8)
+
+    def update(self, items):
+        """Adds every item of an iterable"""
+        value_bits = 64 - self.precision
+        value_mask = (1 << value_bits) - 1
+        indexes = []
+        ranks = []
+        for item in items:
+            item_hash = _hash_pair(item)[0]
+            indexes.append(item_hash >> value_bits)
+            # The position of the first set bit of what is left of the hash
+            ranks.append(value_bits - (item_hash & value_mask).bit_length() + 1)
+        if indexes:
+            numpy.maximum.at(self._registers, numpy.array(indexes, dtype=numpy.intp),
+                             numpy.array(ranks, dtype=numpy.uint8))
+
+    def add(self, item):
+        self.update([item])
+
+    def estimate(self):
+        """Estimates the number of distinct items added
+
+        :rtype: int
+        """
+        size = len(self._registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(size, 0.7213 / (1 + 1.079 / size))
+        raw_estimate = alpha * size * size / numpy.power(2.0, -self._registers.astype(numpy.float64)).sum()
+        empty_registers = int((self._registers == 0).sum())
+        if raw_estimate <= 2.5 * size and empty_registers:
+            # Linear counting is far more accurate while most registers are still empty
+            return int(round(size * math.log(float(size) / empty_registers)))
+        return int(round(raw_estimate))
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge sketches with different precisions')
+        numpy.maximum(self._registers, other._registers, out=self._registers)
+
+    def to_document(self):
+        return {'precision': self.precision, 'registers': Binary(self._registers.tostring())}
+
+    @classmethod
+    def from_document(cls, document):
+        sketch = cls(document['precision'])
+        sketch._registers = numpy.frombuffer(bytes(document['registers']), dtype=numpy.uint8).copy()
+        return sketch
+
+
+class BloomFilter:
+    """BloomFilter answers whether an item may have been added, without false negatives
+
+    Attributes:
+        size (int): The number of bits.
+        hash_count (int): The number of bits set for every item.
+
+    """
+
+    def __init__(self, size, hash_count):
+        self.size = size
+        self.hash_count = hash_count
+        self._bits = numpy.zeros((size + 7) // 8, dtype=numpy.uint8)
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate=0.01):
+        """Builds a filter that keeps false_positive_rate once capacity items have been added"""
+        size = int(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        return cls(size, max(1, int(round(float(size) / capacity * math.log(2)))))
+
+    def _positions(self, item):
+        first_hash, second_hash = _hash_pair(item)
+        return [(first_hash + index * second_hash) % self.size for index in range(self.hash_count)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def merge(self, other):
+        if (other.size, other.hash_count) != (self.size, self.hash_count):
+            raise ValueError('Cannot merge filters with different dimensions')
+        numpy.bitwise_or(self._bits, other._bits, out=self._bits)
+
+    def to_document(self):
+        return {'size': self.size, 'hash_count': self.hash_count, 'bits': Binary(self._bits.tostring())}
+
+    @classmethod
+    def from_document(cls, document):
+        bloom_filter = cls(document['size'], document['hash_count'])
+        bloom_filter._bits = numpy.frombuffer(bytes(document['bits']), dtype=numpy.uint8).copy()
+        return bloom_filter
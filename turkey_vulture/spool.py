@@ -0,0 +1,258 @@
+"""A local write-ahead spool between the Graph Api fetchers and the database
+
+Fetchers append every page they retrieve to PostSpool, which writes it to an append only segment file and fsyncs it
+before the append returns. SpoolDrainer replays the spool into the database in large batches and records how far it
+got in a checkpoint file. Fetching never waits on the database, so a slow or unreachable database only makes the spool
+grow.
+
+Replays are exactly-once in effect: the checkpoint is only moved after a batch is written, and a batch that is replayed
+after a crash is written with duplicates ignored, so posts that made it in the first time are skipped.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import time
+
+import pymongo.errors
+
+from turkey_vulture.models import Participant, Post
+
+SEGMENT_FILE_FORMAT = 'segment_{0:08d}.ndjson'
+SEGMENT_FILE_PREFIX = 'segment_'
+CHECKPOINT_FILE = 'checkpoint.json'
+POSTS_RECORD = 'posts'
+PARTICIPANTS_RECORD = 'participants'
+
+
+def _segment_numbers(directory):
+    return sorted(int(file_name[len(SEGMENT_FILE_PREFIX):].split('.')[0])
+                  for file_name in os.listdir(directory) if file_name.startswith(SEGMENT_FILE_PREFIX))
+
+
+def _segment_in_use(path):
+    """Checks if a PostSpool still holds the lock it takes on the segment it is writing"""
+    with open(path, 'rb') as segment:
+        try:
+            fcntl.flock(segment.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as error:
+            if error.errno in (errno.EAGAIN, errno.EACCES):
+                return True
+            raise
+        fcntl.flock(segment.fileno(), fcntl.LOCK_UN)
+        return False
+
+
+def _fsync_directory(directory):
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+class PostSpool:
+    """PostSpool appends fetched pages to segment files in a spool directory
+
+    Every process that opens a spool starts a new segment and holds a lock on it while writing, so a segment is only
+    ever written by one writer and a record torn by a crash can only be at the end of a segment that nobody holds.
+
+    By default every append is fsynced before it returns, so a page counts as accepted only once it is durable. With
+    fsync_records above one, fsyncs are batched and the records appended since the last fsync, at most fsync_records
+    of them and none older than fsync_seconds, are lost if the machine crashes. Callers that batch call flush at the
+    points where everything appended so far has to be durable.
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, fsync_records=1, fsync_seconds=1.0):
+        """The Initializer for the PostSpool object
+
+        Args:
+            :param directory: The spool directory, created if it does not exist
+            :param segment_bytes: The size after which a new segment file is started
+            :param fsync_records: The most records appended between two fsyncs, 1 to fsync every record
+            :param fsync_seconds: The longest time an appended record waits for an fsync when they are batched
+            :type directory: str
+            :type segment_bytes: int
+            :type fsync_records: int
+            :type fsync_seconds: float
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self._segment_bytes = segment_bytes
+        self._fsync_records = fsync_records
+        self._fsync_seconds = fsync_seconds
+        self._segment_file = None
+        self._unsynced_records = 0
+        self._last_sync = time.time()
+        segment_numbers = _segment_numbers(directory)
+        self._open_segment(segment_numbers[-1] + 1 if segment_numbers else 0)
+
+    def _open_segment(self, segment_number):
+        if self._segment_file is not None:
+            self.flush()
+            self._segment_file.close()
+        self._segment_number = segment_number
+        self._segment_file = open(os.path.join(self.directory, SEGMENT_FILE_FORMAT.format(segment_number)), 'ab')
+        fcntl.flock(self._segment_file.fileno(), fcntl.LOCK_EX)
+        _fsync_directory(self.directory)
+
+    def _append(self, kind, values):
+        line = json.dumps({'kind': kind, 'values': values}, separators=(',', ':'))
+        self._segment_file.write(line + '\n')
+        self._segment_file.flush()
+        self._unsynced_records += 1
+        if self._unsynced_records >= self._fsync_records or time.time() - self._last_sync >= self._fsync_seconds:
+            self.flush()
+        if self._segment_file.tell() >= self._segment_bytes:
+            self._open_segment(self._segment_number + 1)
+
+    def append_posts(self, post_list):
+        """Appends a page of posts in the Graph Api shape or as Post objects
+
+        :param post_list: The posts to spool
+        :type post_list: List
+        """
+        self._append(POSTS_RECORD, [post.to_graph() if isinstance(post, Post) else post for post in post_list])
+
+    def append_participants(self, participants_list):
+        """Appends the current participants of the thread, which replace the stored ones when drained
+
+        :param participants_list: The participants json or Participant objects
+        :type participants_list: List
+        """
+        self._append(PARTICIPANTS_RECORD, [participant.to_graph() if isinstance(participant, Participant)
+                                           else participant for participant in participants_list])
+
+    def flush(self):
+        """Makes every appended record durable, for checkpoints when fsyncs are batched"""
+        if self._unsynced_records:
+            os.fsync(self._segment_file.fileno())
+            self._unsynced_records = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        self.flush()
+        self._segment_file.close()
+
+
+class SpoolDrainer:
+    """SpoolDrainer replays a spool directory into a DatabaseHandler
+
+    Attributes:
+        drained_posts (int): The number of posts replayed into the database by this drainer.
+
+    """
+
+    def __init__(self, directory, database_handler, batch_posts=5000):
+        """The Initializer for the SpoolDrainer object
+
+        Args:
+            :param directory: The spool directory
+            :param database_handler: The handler the spooled posts are written to
+            :param batch_posts: The most posts written to the database at once
+            :type directory: str
+            :type database_handler: turkey_vulture.DatabaseHandler
+            :type batch_posts: int
+        """
+        self.directory = directory
+        self._database_handler = database_handler
+        self._batch_posts = batch_posts
+        self._checkpoint_path = os.path.join(directory, CHECKPOINT_FILE)
+        self.drained_posts = 0
+
+    def _read_checkpoint(self):
+        if not os.path.exists(self._checkpoint_path):
+            return {'segment': 0, 'offset': 0}
+        with open(self._checkpoint_path) as checkpoint_file:
+            return json.load(checkpoint_file)
+
+    def _write_checkpoint(self, segment_number, offset):
+        temp_path = self._checkpoint_path + '.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump({'segment': segment_number, 'offset': offset}, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(temp_path, self._checkpoint_path)
+
+    def _iter_records(self, checkpoint):
+        """Yields each complete record after checkpoint with the position just past it"""
+        for segment_number in _segment_numbers(self.directory):
+            if segment_number < checkpoint['segment']:
+                continue
+            offset = checkpoint['offset'] if segment_number == checkpoint['segment'] else 0
+            segment_path = os.path.join(self.directory, SEGMENT_FILE_FORMAT.format(segment_number))
+            with open(segment_path, 'rb') as segment:
+                segment.seek(offset)
+                for line in iter(segment.readline, b''):
+                    if not line.endswith(b'\n'):
+                        # Either a record that is still being written or one torn by a crash
+                        break
+                    offset += len(line)
+                    yield json.loads(line), segment_number, offset
+            if _segment_in_use(segment_path):
+                # A writer may still add to this segment, so moving the checkpoint past it would lose those records
+                return
+
+    def _write(self, records):
+        posts = []
+        for record in records:
+            if record['kind'] == PARTICIPANTS_RECORD:
+                # Keep the order of the spool, posts spooled before the participants go in first
+                if posts:
+                    self._database_handler.add_posts(posts, ignore_duplicates=True)
+                    self.drained_posts += len(posts)
+                    posts = []
+                self._database_handler.set_participants(record['values'])
+            else:
+                posts.extend(record['values'])
+        if posts:
+            self._database_handler.add_posts(posts, ignore_duplicates=True)
+            self.drained_posts += len(posts)
+
+    def drain(self):
+        """Writes every complete record in the spool to the database
+
+        :return: False if the database could not be reached, in which case the records are kept for the next drain
+        :rtype: bool
+        """
+        checkpoint = self._read_checkpoint()
+        batch = []
+        batch_size = 0
+        try:
+            for record, segment_number, offset in self._iter_records(checkpoint):
+                batch.append(record)
+                batch_size += len(record['values'])
+                if batch_size >= self._batch_posts:
+                    self._write(batch)
+                    self._write_checkpoint(segment_number, offset)
+                    batch = []
+                    batch_size = 0
+            if batch:
+                self._write(batch)
+                self._write_checkpoint(segment_number, offset)
+        except pymongo.errors.ConnectionFailure:
+            return False
+        self._remove_drained_segments()
+        return True
+
+    def _remove_drained_segments(self):
+        checkpoint = self._read_checkpoint()
+        segment_numbers = _segment_numbers(self.directory)
+        for segment_number in segment_numbers[:-1]:
+            # Segments before the newest one are finished, so once the checkpoint is past them they are done
+            if segment_number < checkpoint['segment']:
+                os.remove(os.path.join(self.directory, SEGMENT_FILE_FORMAT.format(segment_number)))
+
+    def run(self, poll_seconds=5.0, should_stop=lambda: False):
+        """Drains the spool every poll_seconds until should_stop returns True
+
+        :param poll_seconds: The time to wait between drains
+        :param should_stop: Checked before every drain
+        :type poll_seconds: float
+        :type should_stop: Callable[[], bool]
+        """
+        while not should_stop():
+            self.drain()
+            time.sleep(poll_seconds)
@@ -0,0 +1,194 @@
+"""Continuously tails Facebook threads into the database
+
+TailDaemon keeps every thread on its own polling interval. The interval tightens each time a poll finds new posts and
+backs off while a thread stays quiet, so busy threads are flushed within seconds and idle ones cost almost nothing.
+Every poll is paid for out of a shared RequestBudget, which keeps the whole daemon inside the Graph Api quota.
+
+A failure only affects its own thread, every other thread keeps its schedule. A failed Graph Api request is logged and
+the thread backs off fully before it is tried again. A failed write is logged and backs off a single step like a quiet
+poll, and the posts stay queued on the thread for the next poll to write.
+"""
+
+import copy
+import heapq
+import logging
+import time
+
+import facebook
+
+# The Graph Api error code for rate limiting
+RATE_LIMIT_ERROR = 613
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class RequestBudget:
+    """RequestBudget is a token bucket shared by every tailed thread
+
+    Attributes:
+        requests_per_hour (float): The long term request rate the bucket refills at.
+        burst (int): The most requests that can be made back to back.
+
+    """
+
+    def __init__(self, requests_per_hour, burst=10, clock=time.time):
+        self.requests_per_hour = float(requests_per_hour)
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._last_refill = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.requests_per_hour / 3600.0)
+        self._last_refill = now
+
+    def wait_time(self, requests=1):
+        """Returns how many seconds to wait before requests can be made
+
+        :param requests: The number of requests that are about to be made
+        :type requests: int
+        :rtype: float
+        """
+        self._refill()
+        missing = min(requests, self.burst) - self._tokens
+        return max(0.0, missing * 3600.0 / self.requests_per_hour)
+
+    def spend(self, requests=1):
+        """Takes requests out of the bucket. The bucket may go negative, which delays the requests that follow."""
+        self._refill()
+        self._tokens -= requests
+
+    def drain(self):
+        """Empties the bucket, used when the Graph Api says the quota is already used up"""
+        self._refill()
+        self._tokens = min(self._tokens, 0.0)
+
+
+class AdaptiveInterval:
+    """AdaptiveInterval is the polling interval of a single thread
+
+    Attributes:
+        seconds (float): The current number of seconds between polls.
+
+    """
+
+    def __init__(self, min_seconds=5.0, max_seconds=3600.0, tighten_factor=0.25, backoff_factor=2.0):
+        self.min_seconds = float(min_seconds)
+        self.max_seconds = float(max_seconds)
+        self.tighten_factor = tighten_factor
+        self.backoff_factor = backoff_factor
+        self.seconds = self.min_seconds
+
+    def record(self, new_post_count):
+        """Adjusts the interval after a poll
+
+        :param new_post_count: The number of new posts the poll found
+        :type new_post_count: int
+        :return: The new interval in seconds
+        :rtype: float
+        """
+        if new_post_count:
+            self.seconds = max(self.min_seconds, self.seconds * self.tighten_factor)
+        else:
+            self.seconds = min(self.max_seconds, self.seconds * self.backoff_factor)
+        return self.seconds
+
+    def back_off_fully(self):
+        self.seconds = self.max_seconds
+
+
+class TailDaemon:
+    """TailDaemon polls a set of threads forever and writes their new posts as soon as they arrive
+
+    Threads are kept in a heap ordered by when they are next due, so each step only looks at the one thread that
+    needs polling next.
+    """
+
+    def __init__(self, budget, page_limit=100, interval_factory=AdaptiveInterval, clock=time.time, sleep=time.sleep):
+        """The Initializer for the TailDaemon object
+
+        Args:
+            :param budget: The request budget shared by every thread
+            :param page_limit: The number of posts asked for in each Graph Api request
+            :param interval_factory: Builds the polling interval for each new thread
+            :param clock: Returns the current time in seconds
+            :param sleep: Sleeps for a number of seconds
+            :type budget: RequestBudget
+            :type page_limit: int
+        """
+        self._budget = budget
+        self._page_limit = page_limit
+        self._interval_factory = interval_factory
+        self._clock = clock
+        self._sleep = sleep
+        self._schedule = []
+        self.intervals = {}
+
+    def add_thread(self, thread, database_handler):
+        """Starts tailing a thread, with its first poll due right away
+
+        :param thread: A thread built with the id and time of the latest stored post
+        :param database_handler: The handler the thread's new posts are written to
+        :type thread: turkey_vulture.FacebookThread
+        :type database_handler: turkey_vulture.DatabaseHandler
+        """
+        self.intervals[thread.thread_id] = self._interval_factory()
+        heapq.heappush(self._schedule, (self._clock(), thread.thread_id, thread, database_handler))
+
+    def poll_next(self):
+        """Waits for the next due thread, polls it and schedules its next poll
+
+        :return: The id of the polled thread and the number of new posts it had
+        :rtype: Tuple[str, int]
+        """
+        due_time, thread_id, thread, database_handler = heapq.heappop(self._schedule)
+        interval = self.intervals[thread_id]
+        try:
+            wait = max(due_time - self._clock(), self._budget.wait_time())
+            if wait > 0:
+                self._sleep(wait)
+
+            try:
+                new_posts = thread.delta_update(page_limit=self._page_limit)
+                # One request for the first page plus one for every further page of new posts
+                self._budget.spend(1 + len(new_posts) // self._page_limit)
+            except facebook.GraphAPIError as fb_error:
+                if fb_error.result.get('error', {}).get('code') == RATE_LIMIT_ERROR:
+                    self._budget.drain()
+                else:
+                    logger.exception('Polling thread %s failed', thread_id)
+                interval.back_off_fully()
+                return thread_id, 0
+            except Exception:
+                # A lost connection must not stop the other threads from being tailed
+                logger.exception('Polling thread %s failed', thread_id)
+                interval.back_off_fully()
+                return thread_id, 0
+
+            if thread.posts:
+                try:
+                    # add_posts transforms the posts in place, so a copy is written and the posts stay on the thread
+                    # until the write succeeds
+                    database_handler.add_posts(copy.deepcopy(thread.posts), ignore_duplicates=True)
+                    thread.pop_posts()
+                except Exception:
+                    # The posts are still queued, so a failed write only backs off a step and the next poll retries it
+                    # within seconds rather than after max_seconds
+                    logger.exception('Writing the posts of thread %s failed', thread_id)
+                    interval.record(0)
+                    return thread_id, 0
+            interval.record(len(new_posts))
+            return thread_id, len(new_posts)
+        finally:
+            heapq.heappush(self._schedule, (self._clock() + interval.seconds, thread_id, thread, database_handler))
+
+    def run(self, should_stop=lambda: False):
+        """Polls threads until should_stop returns True
+
+        :param should_stop: Checked before every poll
+        :type should_stop: Callable[[], bool]
+        """
+        while self._schedule and not should_stop():
+            self.poll_next()
@@ -0,0 +1,210 @@
+"""Streaming export and import of a thread's posts as chunked, gzip compressed NDJSON files
+
+An export directory holds a manifest.json file, a participants.json file and one chunk_<n>.ndjson.gz file for every
+CHUNK_SIZE posts. Posts are written in the Graph Api shape so that an import goes through the same
+DatabaseHandler.add_posts transform path as a fresh pull. Both directions only keep a bounded number of chunks in
+memory and both can be restarted: an export continues after the last chunk in the manifest and an import skips the
+chunks it has already loaded.
+
+Exports are written in seq order and resume after the highest seq already exported, so posts that arrive while an
+export is interrupted are picked up when it continues. Posts merged in below that seq, such as the older posts a
+repair fills a hole with, are not: export into a fresh directory after a repair.
+"""
+
+import gzip
+import json
+import multiprocessing
+import os
+from collections import deque
+
+from turkey_vulture import DatabaseHandler
+
+CHUNK_SIZE = 50000
+COMPRESSION_LEVEL = 6
+MANIFEST_FILE = 'manifest.json'
+PARTICIPANTS_FILE = 'participants.json'
+IMPORT_STATE_FILE = 'import_state.json'
+CHUNK_FILE_FORMAT = 'chunk_{0:06d}.ndjson.gz'
+# seq is kept for resuming and dropped from every exported post by post_untransform
+EXPORT_PROJECTION = {'session': 0, 'hooks_pending': 0}
+
+
+def _read_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as json_file:
+        return json.load(json_file)
+
+
+def _write_json(path, value):
+    # Write then rename so a crash never leaves a half written manifest behind
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as json_file:
+        json.dump(value, json_file, indent=2)
+    os.rename(temp_path, path)
+
+
+def _compress_chunk(path, lines, compression_level):
+    """Compresses one chunk of NDJSON lines into path. This runs inside the worker processes."""
+    temp_path = path + '.tmp'
+    with gzip.open(temp_path, 'wb', compression_level) as chunk_file:
+        chunk_file.write('\n'.join(lines))
+        chunk_file.write('\n')
+    os.rename(temp_path, path)
+
+
+def _iter_chunks(database_handler, after_seq, chunk_size):
+    lines = []
+    last_seq = None
+    sender_names = database_handler.sender_names
+    # seq, session and hooks_pending are derived when posts are stored, so they are not exported and imported back
+    for document in database_handler.iter_posts(after_seq=after_seq, projection=EXPORT_PROJECTION):
+        last_seq = document['seq']
+        lines.append(json.dumps(DatabaseHandler.post_untransform(document, sender_names), separators=(',', ':')))
+        if len(lines) == chunk_size:
+            yield lines, last_seq
+            lines = []
+    if lines:
+        yield lines, last_seq
+
+
+def _last_seq(chunk):
+    # Manifests written before exports resumed on seq only record the _id of the last post
+    if 'last_seq' in chunk:
+        return chunk['last_seq']
+    return int(chunk['last_id'].split('_')[1])
+
+
+def export_thread(database_handler, directory, chunk_size=CHUNK_SIZE, processes=None,
+                  compression_level=COMPRESSION_LEVEL):
+    """Exports every post of a thread into directory
+
+    Chunks are serialized in the calling process and compressed in a pool of worker processes. At most two chunks per
+    worker are in flight at once, which keeps memory bounded no matter how large the thread is. Running the export
+    again on the same directory picks up after the last chunk that was completely written.
+
+    :param database_handler: The handler for the thread to export
+    :param directory: The directory to write the export into
+    :param chunk_size: The number of posts in each chunk file
+    :param processes: The number of compression processes, defaults to the number of cpus
+    :param compression_level: The gzip compression level from 1 to 9
+    :type database_handler: turkey_vulture.DatabaseHandler
+    :type directory: str
+    :type chunk_size: int
+    :type processes: int
+    :type compression_level: int
+    :return: The number of posts exported by this call
+    :rtype: int
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    manifest = _read_json(manifest_path, {'chunk_size': chunk_size, 'chunks': []})
+    after_seq = _last_seq(manifest['chunks'][-1]) if manifest['chunks'] else None
+    _write_json(os.path.join(directory, PARTICIPANTS_FILE), database_handler.get_participants(include_former=True))
+
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    pending = deque()
+    exported = 0
+
+    def finish_oldest():
+        # Chunks are recorded strictly in order, so a resumed export never skips over an unfinished chunk
+        chunk, result = pending.popleft()
+        result.get()
+        manifest['chunks'].append(chunk)
+        _write_json(manifest_path, manifest)
+
+    try:
+        chunk_number = len(manifest['chunks'])
+        for lines, last_seq in _iter_chunks(database_handler, after_seq, chunk_size):
+            if len(pending) >= processes * 2:
+                finish_oldest()
+            file_name = CHUNK_FILE_FORMAT.format(chunk_number)
+            result = pool.apply_async(_compress_chunk,
+                                      (os.path.join(directory, file_name), lines, compression_level))
+            pending.append(({'file': file_name, 'posts': len(lines), 'last_seq': last_seq}, result))
+            exported += len(lines)
+            chunk_number += 1
+        while pending:
+            finish_oldest()
+    finally:
+        pool.close()
+        pool.join()
+    return exported
+
+
+def iter_export(directory):
+    """Reads the posts of an export back in seq order
+
+    :param directory: A directory written by export_thread
+    :type directory: str
+    :return: The exported posts in the Graph Api shape
+    :rtype: Iterator[Dict]
+    """
+    manifest = _read_json(os.path.join(directory, MANIFEST_FILE), {'chunks': []})
+    for chunk in manifest['chunks']:
+        for post in _iter_chunk_file(os.path.join(directory, chunk['file'])):
+            yield post
+
+
+def read_participants(directory):
+    """Reads the participants of an export
+
+    :param directory: A directory written by export_thread
+    :type directory: str
+    :return: The participants in the Graph Api shape
+    :rtype: List[Dict]
+    """
+    return _read_json(os.path.join(directory, PARTICIPANTS_FILE), [])
+
+
+def _iter_chunk_file(path):
+    with gzip.open(path, 'rb') as chunk_file:
+        for line in chunk_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def import_thread(database_handler, directory, batch_size=5000):
+    """Bulk loads an export into the posts collection of database_handler
+
+    Each chunk is streamed and inserted in batches through add_posts with duplicates ignored. Finished chunks are
+    recorded in an import state file so an interrupted import can simply be started again.
+
+    :param database_handler: The handler for the thread to import into
+    :param directory: A directory written by export_thread
+    :param batch_size: The number of posts sent to the database in one insert
+    :type database_handler: turkey_vulture.DatabaseHandler
+    :type directory: str
+    :type batch_size: int
+    :return: The number of posts read by this call
+    :rtype: int
+    """
+    manifest = _read_json(os.path.join(directory, MANIFEST_FILE), {'chunks': []})
+    state_path = os.path.join(directory, IMPORT_STATE_FILE)
+    state = _read_json(state_path, {'imported_chunks': []})
+    imported_chunks = set(state['imported_chunks'])
+
+    participants = read_participants(directory)
+    if participants and not imported_chunks:
+        database_handler.update_participants(participants)
+
+    imported = 0
+    for chunk in manifest['chunks']:
+        if chunk['file'] in imported_chunks:
+            continue
+        batch = []
+        for post in _iter_chunk_file(os.path.join(directory, chunk['file'])):
+            batch.append(post)
+            if len(batch) == batch_size:
+                database_handler.add_posts(batch, ignore_duplicates=True)
+                imported += len(batch)
+                batch = []
+        if batch:
+            database_handler.add_posts(batch, ignore_duplicates=True)
+            imported += len(batch)
+        state['imported_chunks'].append(chunk['file'])
+        _write_json(state_path, state)
+    return imported
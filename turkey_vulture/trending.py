@@ -0,0 +1,156 @@
+"""Terms a thread is talking about right now, compared to how it usually talks
+
+TrendingTerms keeps two collections up to date as posts are added:
+
+    <posts>_trending            The count of every term in every time bucket, for the newest ring_buckets buckets only
+    <posts>_term_baseline       The count of every term over the whole thread
+
+Both also hold the count of all terms under TOTAL_TERM. An update only touches the buckets and terms of the new posts
+and drops the buckets that fell out of the ring, so it costs in proportion to the new posts, never the history. A term
+trends when its count over the most recent buckets is well above what its share of the rest of the thread predicts.
+Terms are split with DatabaseHandler.tokenize, like every other word count.
+
+Register TrendingTerms.update with DatabaseHandler.add_ingest_hook to keep the counts current as posts are added.
+"""
+
+import calendar
+import math
+from collections import Counter
+
+import pymongo
+from bson.son import SON
+
+from turkey_vulture import DatabaseHandler
+
+TRENDING_SUFFIX = '_trending'
+BASELINE_SUFFIX = '_term_baseline'
+# tokenize never returns an empty term, so the empty term can hold the count of all terms
+TOTAL_TERM = u''
+
+
+class TrendingTerms:
+    """TrendingTerms maintains and queries the trending terms of one thread
+
+    Attributes:
+        bucket_seconds (int): The length of a bucket.
+        ring_buckets (int): The number of most recent buckets that are kept.
+
+    """
+
+    def __init__(self, database_handler, bucket_seconds=3600, ring_buckets=7 * 24):
+        """The Initializer for the TrendingTerms object
+
+        Args:
+            :param database_handler: The handler for the thread
+            :param bucket_seconds: The length of a bucket
+            :param ring_buckets: The number of most recent buckets that are kept, which bounds the recent window
+            :type database_handler: turkey_vulture.DatabaseHandler
+            :type bucket_seconds: int
+            :type ring_buckets: int
+        """
+        self._database_handler = database_handler
+        self._buckets = database_handler._db()[database_handler._posts_collection_name + TRENDING_SUFFIX]
+        self._baseline = database_handler._db()[database_handler._posts_collection_name + BASELINE_SUFFIX]
+        self.bucket_seconds = bucket_seconds
+        self.ring_buckets = ring_buckets
+        # Every update looks up the newest bucket and drops the oldest ones
+        self._buckets.create_index('_id.bucket')
+
+    def _bucket(self, created_time):
+        return calendar.timegm(created_time.utctimetuple()) // self.bucket_seconds
+
+    def _newest_bucket(self):
+        newest = self._buckets.find_one({}, {'_id': 1}, sort=[('_id.bucket', pymongo.DESCENDING)])
+        return newest['_id']['bucket'] if newest else None
+
+    def update(self, post_list):
+        """Adds the terms of a batch of stored post documents to the bucket and baseline counts
+
+        :param post_list: Post documents as stored by add_posts
+        :type post_list: List[Dict]
+        """
+        bucket_counts = Counter()
+        term_counts = Counter()
+        for post in post_list:
+            if not post.get('message'):
+                continue
+            terms = DatabaseHandler.tokenize(post['message'])
+            bucket = self._bucket(post['created_time'])
+            for term in terms:
+                bucket_counts[(bucket, term)] += 1
+            bucket_counts[(bucket, TOTAL_TERM)] += len(terms)
+            term_counts.update(terms)
+            term_counts[TOTAL_TERM] += len(terms)
+        if not term_counts:
+            return
+
+        newest = max(bucket for bucket, _ in bucket_counts)
+        stored_newest = self._newest_bucket()
+        if stored_newest is not None:
+            newest = max(newest, stored_newest)
+        oldest_kept = newest - self.ring_buckets + 1
+
+        # A backfill of posts older than the ring only moves the baseline
+        bucket_operations = [pymongo.UpdateOne({'_id': SON([('bucket', bucket), ('term', term)])},
+                                               {'$inc': {'count': count}}, upsert=True)
+                             for (bucket, term), count in bucket_counts.items() if bucket >= oldest_kept]
+        if bucket_operations:
+            self._buckets.bulk_write(bucket_operations, ordered=False)
+        self._baseline.bulk_write([pymongo.UpdateOne({'_id': term}, {'$inc': {'count': count}}, upsert=True)
+                                   for term, count in term_counts.items()], ordered=False)
+        if stored_newest is not None and newest > stored_newest:
+            self._buckets.delete_many({'_id.bucket': {'$lt': oldest_kept}})
+
+    def rebuild(self, batch_size=5000):
+        """Rebuilds both collections in one pass over the posts"""
+        self._buckets.drop()
+        self._baseline.drop()
+        self._buckets.create_index('_id.bucket')
+        batch = []
+        sort = [('created_time', pymongo.ASCENDING)]
+        for post in self._database_handler.scan_posts(('created_time', 'message'), sort=sort, batch_size=batch_size):
+            batch.append(post)
+            if len(batch) == batch_size:
+                self.update(batch)
+                batch = []
+        self.update(batch)
+
+    def trending(self, recent_buckets=24, limit=10, min_count=3, now=None):
+        """Finds the terms used most above their usual share over the most recent buckets
+
+        Each term is scored by how many standard deviations its recent count is above the count its share of the rest
+        of the thread predicts, counting terms as Poisson arrivals. A term new to the thread is predicted a share of
+        one use.
+
+        :param recent_buckets: The number of buckets that count as recent, at most ring_buckets
+        :param limit: The number of terms to return
+        :param min_count: The fewest recent uses for a term to trend
+        :param now: The end of the recent window, None for the newest post
+        :type recent_buckets: int
+        :type limit: int
+        :type min_count: int
+        :type now: datetime
+        :return: Triples of term, recent count and score, highest score first
+        :rtype: List[Tuple[unicode, int, float]]
+        """
+        newest = self._newest_bucket() if now is None else self._bucket(now)
+        if newest is None:
+            return []
+        recent_counts = Counter()
+        window = {'$gt': newest - min(recent_buckets, self.ring_buckets), '$lte': newest}
+        for document in self._buckets.find({'_id.bucket': window}):
+            recent_counts[document['_id']['term']] += document['count']
+        recent_total = recent_counts.pop(TOTAL_TERM, 0)
+        candidates = [term for term, count in recent_counts.items() if count >= min_count]
+        if not recent_total or not candidates:
+            return []
+
+        baseline_counts = dict((document['_id'], document['count'])
+                               for document in self._baseline.find({'_id': {'$in': candidates + [TOTAL_TERM]}}))
+        earlier_total = baseline_counts.get(TOTAL_TERM, 0) - recent_total
+        scores = []
+        for term in candidates:
+            earlier_count = baseline_counts.get(term, 0) - recent_counts[term]
+            expected = recent_total * (earlier_count + 1.0) / (earlier_total + 1.0)
+            scores.append((term, recent_counts[term], (recent_counts[term] - expected) / math.sqrt(expected)))
+        return sorted((score for score in scores if score[2] > 0), key=lambda score: (-score[2], score[0]))[:limit]
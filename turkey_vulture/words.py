@@ -0,0 +1,139 @@
+"""Approximate word counts in a fixed amount of memory
+
+posts_by_user_aggregation keeps one document for every word every sender has ever used, typos included. WordSketches
+instead keeps, for every sender and for the whole thread, one document per calendar month holding a SpaceSaving summary
+of the most used words and a CountMinSketch of every word. Both are stored as binary fields and both merge, so a query
+over any range of months reads a handful of documents and holds at most capacity words no matter how large the thread
+is. Words are split with DatabaseHandler.tokenize, the same way the exact aggregation splits them.
+
+Register WordSketches.update with DatabaseHandler.add_ingest_hook to keep the sketches current as posts are added.
+Several workers can run the hook at once; update_partitions retries a month another worker wrote in the meantime.
+"""
+
+from collections import Counter, defaultdict
+
+import pymongo
+from bson.son import SON
+
+from turkey_vulture import DatabaseHandler
+from turkey_vulture.sketches import CountMinSketch, SpaceSaving, update_partitions
+
+WORD_SKETCHES_SUFFIX = '_word_sketches'
+MONTH_FORMAT = '%Y-%m'
+
+
+class WordSketches:
+    """WordSketches maintains and queries the word sketches of one thread
+
+    Attributes:
+        capacity (int): The number of words each SpaceSaving summary keeps. A kept count is at most the number of words
+            in its partition divided by capacity too high.
+        epsilon (float): The CountMinSketch error as a fraction of the number of words.
+        delta (float): The probability that a CountMinSketch estimate is off by more than epsilon.
+
+    """
+
+    def __init__(self, database_handler, capacity=1000, epsilon=0.005, delta=0.01):
+        """The Initializer for the WordSketches object
+
+        Args:
+            :param database_handler: The handler for the thread
+            :param capacity: The number of words each SpaceSaving summary keeps
+            :param epsilon: The CountMinSketch error as a fraction of the number of words
+            :param delta: The probability that a CountMinSketch estimate is off by more than epsilon
+            :type database_handler: turkey_vulture.DatabaseHandler
+            :type capacity: int
+            :type epsilon: float
+            :type delta: float
+        """
+        self._database_handler = database_handler
+        self._collection = database_handler._db()[database_handler._posts_collection_name + WORD_SKETCHES_SUFFIX]
+        self.capacity = capacity
+        self.epsilon = epsilon
+        self.delta = delta
+
+    def _new_sketches(self):
+        return SpaceSaving(self.capacity), CountMinSketch.from_error(self.epsilon, self.delta)
+
+    def update(self, post_list):
+        """Adds the words of a batch of stored post documents to the sketches of their senders and months
+
+        :param post_list: Post documents as stored by add_posts
+        :type post_list: List[Dict]
+        """
+        word_counts = defaultdict(Counter)
+        for post in post_list:
+            if post.get('message'):
+                words = DatabaseHandler.tokenize(post['message'])
+                month = post['created_time'].strftime(MONTH_FORMAT)
+                word_counts[(post['sender'], month)].update(words)
+                word_counts[(None, month)].update(words)
+
+        def merge(partition_id, document):
+            counts = word_counts[(partition_id['sender'], partition_id['month'])]
+            if document is None:
+                top_words, word_frequencies = self._new_sketches()
+            else:
+                top_words = SpaceSaving.from_document(document['top_words'])
+                word_frequencies = CountMinSketch.from_document(document['word_frequencies'])
+            for word, count in counts.items():
+                top_words.add(word, count)
+            word_frequencies.update(counts)
+            return {'top_words': top_words.to_document(), 'word_frequencies': word_frequencies.to_document()}
+
+        update_partitions(self._collection, [SON([('sender', sender), ('month', month)])
+                                             for sender, month in word_counts], merge)
+
+    def rebuild(self, batch_size=5000):
+        """Rebuilds every sketch in one pass over the posts"""
+        self._collection.drop()
+        batch = []
+        for post in self._database_handler.scan_posts(('sender', 'created_time', 'message'), batch_size=batch_size):
+            batch.append(post)
+            if len(batch) == batch_size:
+                self.update(batch)
+                batch = []
+        self.update(batch)
+        self._collection.create_index([('_id.sender', pymongo.ASCENDING), ('_id.month', pymongo.ASCENDING)])
+
+    def _merged(self, sender, start, end):
+        query = {'_id.sender': sender}
+        month_range = {}
+        if start is not None:
+            month_range['$gte'] = start.strftime(MONTH_FORMAT)
+        if end is not None:
+            month_range['$lt'] = end.strftime(MONTH_FORMAT)
+        if month_range:
+            query['_id.month'] = month_range
+        top_words, word_frequencies = self._new_sketches()
+        for document in self._collection.find(query):
+            top_words.merge(SpaceSaving.from_document(document['top_words']))
+            word_frequencies.merge(CountMinSketch.from_document(document['word_frequencies']))
+        return top_words, word_frequencies
+
+    def top_words(self, sender=None, start=None, end=None, limit=10):
+        """Estimates the most used words of a sender, or of the whole thread, over a range of months
+
+        Each count is the smaller of the SpaceSaving and CountMinSketch estimates, which are both never too low.
+
+        :param sender: The id of the sender, None for the whole thread
+        :param start: A time in the first month to count, None for no lower bound
+        :param end: A time in the month after the last one to count, None for no upper bound
+        :param limit: The number of words to return
+        :type sender: str
+        :type start: datetime
+        :type end: datetime
+        :type limit: int
+        :return: Pairs of word and estimated count, most used first
+        :rtype: List[Tuple[str, int]]
+        """
+        top_words, word_frequencies = self._merged(sender, start, end)
+        estimates = [(word, min(count, word_frequencies.estimate(word))) for word, count, _ in top_words.top()]
+        return sorted(estimates, key=lambda estimate: (-estimate[1], estimate[0]))[:limit]
+
+    def word_count(self, word, sender=None, start=None, end=None):
+        """Estimates how often a single word was used, see top_words for the parameters
+
+        :rtype: int
+        """
+        return self._merged(sender, start, end)[1].estimate(word.lower())